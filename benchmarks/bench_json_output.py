@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Size and time benchmark of the JSON outputs.
+
+Writes a synthetic all_videocomp.json (videos with multi-language
+transcripts) with the previous pretty-printed json.dumps and with the
+streaming writer of lib.jsonio in its pretty, compact, gzip and zstd
+variants, and reads every file back with lib.jsonio.load_json.
+
+  python benchmarks/bench_json_output.py [--videos 2000] [--languages 3]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.jsonio import load_json, write_json, zstandard  # noqa: E402
+
+
+WORDS = ('the', 'plate', 'magma', 'earth', 'crust', 'ocean', 'volcano', 'energy',
+         'wave', 'rock', 'layer', 'mantle', u'地震', u'火山', u'プレート')
+
+
+def build_videos(videos, languages, segments):
+    rng = random.Random(0)
+    records = {}
+    for i in range(videos):
+        video = {'section': '%02d-Section' % (i // 50), 'subsection': 'Subsection %d' % (i // 10),
+                 'unit': 'Unit %d' % i, 'youtube_url': 'https://youtu.be/%011d' % i,
+                 'video_source': 'n/a', 'video_duration': rng.randint(60, 1200)}
+        for language in ('en', 'ja', 'zh', 'fr', 'es')[:languages]:
+            video['transcript_' + language] = [' '.join(rng.choice(WORDS) for _ in range(12))
+                                               for _ in range(segments)]
+        video['speech_period'] = [round(rng.uniform(0.5, 6), 3) for _ in range(segments)]
+        records['video_block_' + str(i + 1).zfill(4)] = video
+    return records
+
+
+def legacy_write(records, path):
+    data = json.dumps(records, sort_keys=True, indent=4, separators=(',', ': '))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--videos', type=int, default=2000)
+    parser.add_argument('--languages', type=int, default=3)
+    parser.add_argument('--segments', type=int, default=150)
+    args = parser.parse_args()
+
+    records = build_videos(args.videos, args.languages, args.segments)
+    variants = [('json.dumps indent=4', lambda path: legacy_write(records, path)),
+                ('stream pretty', lambda path: write_json(records, path)),
+                ('stream compact', lambda path: write_json(records, path, compact=True)),
+                ('stream pretty gz', lambda path: write_json(records, path, 'gz')),
+                ('stream compact gz', lambda path: write_json(records, path, 'gz', True))]
+    if zstandard is not None:
+        variants += [('stream pretty zst', lambda path: write_json(records, path, 'zst')),
+                     ('stream compact zst', lambda path: write_json(records, path, 'zst', True))]
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('%-22s %10s %10s %10s' % ('variant', 'MiB', 'write s', 'read s'))
+        for i, (name, write) in enumerate(variants):
+            start = time.perf_counter()
+            path = write(os.path.join(directory, '%d_all_videocomp.json' % i))
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            assert len(load_json(path)) == len(records)
+            read_time = time.perf_counter() - start
+            print('%-22s %10.2f %10.3f %10.3f' % (name, os.path.getsize(path) / 2.0 ** 20,
+                                                  write_time, read_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
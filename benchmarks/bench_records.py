@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory benchmark of the course model.
+
+Compares the slotted records of lib.common with equivalent dict-backed
+classes (the previous implementation) on a synthetic catalog.
+
+  python benchmarks/bench_records.py [--units 50000]
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.common import SubSection, Unit, Video  # noqa: E402
+
+
+class DictSubSection(object):
+    def __init__(self, position, name, url):
+        self.position = position
+        self.name = name
+        self.url = url
+
+
+class DictUnit(object):
+    def __init__(self, videos, resources_urls):
+        self.videos = videos
+        self.resources_urls = resources_urls
+
+
+class DictVideo(object):
+    def __init__(self, video_youtube_url, available_subs_url,
+                 sub_template_url, mp4_urls):
+        self.video_youtube_url = video_youtube_url
+        self.available_subs_url = available_subs_url
+        self.sub_template_url = sub_template_url
+        self.mp4_urls = mp4_urls
+
+
+def build(n, strings, subsection_cls, unit_cls, video_cls):
+    subsections = []
+    units = []
+    for i in range(n):
+        subsections.append(subsection_cls(i, strings[i][4], strings[i][5]))
+        video = video_cls(strings[i][0], None, strings[i][1], [strings[i][2]])
+        units.append(unit_cls([video], [strings[i][3]]))
+    return subsections, units
+
+
+def make_strings(n):
+    # built before measuring, so that only the containers are measured
+    return [['https://courses.edx.org/asset-v1:Org+Course+Run+type@asset+block/%06d-%d' % (i, j)
+             for j in range(6)] for i in range(n)]
+
+
+def measure(label, n, strings, subsection_cls, unit_cls, video_cls):
+    tracemalloc.start()
+    records = build(n, strings, subsection_cls, unit_cls, video_cls)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%-22s %10.1f MiB' % (label, memory / 2.0 ** 20))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--units', type=int, default=50000)
+    args = parser.parse_args()
+
+    strings = make_strings(args.units)
+    print('memory of %d subsections, units and videos' % args.units)
+    measure('dict-backed classes', args.units, strings, DictSubSection, DictUnit, DictVideo)
+    measure('slotted records', args.units, strings, SubSection, Unit, Video)
+
+
+if __name__ == '__main__':
+    main()
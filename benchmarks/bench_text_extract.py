@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the text extraction of html blocks.
+
+Compares lib.textextract with the previous extraction (string concatenation
+of getText() over findAll of the segment tags) on a synthetic text-heavy
+unit with nested lists.
+
+  python benchmarks/bench_text_extract.py [--paragraphs 5000] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.textextract import HTML_TAGS, extract_structure, extract_text  # noqa: E402
+
+
+def build_unit(paragraphs):
+    parts = ['<div data-block-type="html">']
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            parts.append('<h3>Chapter %d</h3>' % i)
+        parts.append('<p>Paragraph %d with <b>bold</b> and <a href="#">a link</a>, '
+                     'followed by some more words to make it longer.</p>' % i)
+        if i % 10 == 0:
+            parts.append('<ul><li>item <p>one</p><ul><li>nested <em>item</em></li>'
+                         '</ul></li><li>item two</li></ul>')
+    parts.append('</div>')
+    return ''.join(parts)
+
+
+def legacy_extract(blocks):
+    text = ""
+    for soup_component in blocks:
+        for s in soup_component.findAll(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li']):
+            text += s.getText() + " "
+    return text
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--paragraphs', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    html = build_unit(args.paragraphs)
+    soup = BeautifulSoup(html, 'html.parser')
+    blocks = soup.findAll('div', {'data-block-type': 'html'})
+    print('unit: %d paragraphs, %.1f KiB of html' % (args.paragraphs, len(html) / 1024.0))
+
+    legacy_time, legacy_text = timed(lambda: legacy_extract(blocks), args.repeat)
+    text_time, text = timed(lambda: extract_text(blocks, HTML_TAGS), args.repeat)
+    structure_time, structure = timed(lambda: extract_structure(blocks, HTML_TAGS), args.repeat)
+
+    print('%-22s %8.3f s  %9d chars' % ('findAll + concat', legacy_time, len(legacy_text)))
+    print('%-22s %8.3f s  %9d chars' % ('extract_text', text_time, len(text)))
+    print('%-22s %8.3f s  %9d segments' % ('extract_structure', structure_time, len(structure)))
+    print('speedup: %.1fx' % (legacy_time / text_time))
+
+
+if __name__ == '__main__':
+    main()
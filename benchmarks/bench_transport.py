@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput benchmark of the HTTP transports of lib.transport.
+
+Fetches the same pages with concurrent threads through urlopen (one
+connection per request), the pooled HTTP/1.1 transport and the http2
+transport (with httpx[http2] installed). By default the pages are served by
+a local keep-alive server over TLS, which negotiates HTTP/2 with ALPN
+(answered with the h2 package, installed with httpx[http2]) and HTTP/1.1
+otherwise, so that every variant pays the same TLS cost. Without h2 or the
+openssl command the local server speaks plain HTTP/1.1 and http2 is skipped.
+A remote or other local HTTP/2 server (e.g. nghttpd, h2o or caddy) can be
+measured with --url:
+
+  python benchmarks/bench_transport.py [--requests 2000] [--concurrency 16]
+      [--size 50000] [--latency 5] [--url https://127.0.0.1:8443/page --insecure]
+"""
+
+import argparse
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.request import Request, urlopen
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.transport import Http2Transport, PooledTransport, UrllibTransport, httpx  # noqa: E402
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    context = None
+
+    def get_request(self):
+        connection, address = self.socket.accept()
+        if self.context is not None:
+            connection = self.context.wrap_socket(connection, server_side=True)
+        return connection, address
+
+
+class _InsecureUrllibTransport(UrllibTransport):
+    """
+    urlopen without certificate verification, for the local TLS server and
+    --insecure.
+    """
+
+    def __init__(self, context):
+        self._context = context
+
+    def open(self, request):
+        return urlopen(request, context=self._context)
+
+
+def _tls_context(directory):
+    """
+    Return the server TLS context offering h2 and http/1.1 with a
+    self-signed certificate made by openssl in directory, None when h2 or
+    openssl is missing.
+    """
+    if h2 is None:
+        return None
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    context.set_alpn_protocols(['h2', 'http/1.1'])
+    return context
+
+
+def _serve_h2(sock, body, latency):
+    """
+    Answer the HTTP/2 requests of a connection, each one in its own thread
+    after latency seconds, within the flow control windows of the client.
+    """
+    connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                      header_encoding='utf-8'))
+    cond = threading.Condition()
+    closed = []
+
+    def respond(stream_id, cookie):
+        time.sleep(latency)
+        with cond:
+            headers = [(':status', '200'), ('content-type', 'text/html; charset=utf-8'),
+                       ('content-length', str(len(body)))]
+            if 'sessionid' not in cookie:
+                headers.append(('set-cookie', 'sessionid=bench; Path=/'))
+            connection.send_headers(stream_id, headers)
+            sent = 0
+            while sent < len(body) and not closed:
+                size = min(connection.local_flow_control_window(stream_id),
+                           connection.max_outbound_frame_size, len(body) - sent)
+                if size <= 0:
+                    # until the client opens the window again
+                    sock.sendall(connection.data_to_send())
+                    cond.wait()
+                    continue
+                connection.send_data(stream_id, body[sent:sent + size], end_stream=sent + size == len(body))
+                sent += size
+            if not closed:
+                sock.sendall(connection.data_to_send())
+
+    with cond:
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+    try:
+        while True:
+            data = sock.recv(1 << 16)
+            if not data:
+                break
+            with cond:
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        cookie = dict(event.headers).get('cookie', '')
+                        threading.Thread(target=respond, args=(event.stream_id, cookie), daemon=True).start()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        closed.append(True)
+                sock.sendall(connection.data_to_send())
+                cond.notify_all()
+            if closed:
+                break
+    except (OSError, ssl.SSLError):
+        pass
+    finally:
+        with cond:
+            closed.append(True)
+            cond.notify_all()
+
+
+def serve_pages(size, latency, context=None):
+    """
+    Start a local keep-alive server returning pages of size bytes after
+    latency seconds, over TLS with context (HTTP/2 when negotiated), return
+    it and its url.
+    """
+    body = (b'<p>plate tectonics</p>' * (size // 22 + 1))[:size]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # one write per response, the headers and body in separate small
+        # packets would stall keep-alive connections (Nagle, delayed ACK)
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle(self):
+            if isinstance(self.request, ssl.SSLSocket) and self.request.selected_alpn_protocol() == 'h2':
+                _serve_h2(self.request, body, latency)
+            else:
+                BaseHTTPRequestHandler.handle(self)
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if 'sessionid' not in (self.headers.get('Cookie') or ''):
+                self.send_header('Set-Cookie', 'sessionid=bench; Path=/')
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _Server(('127.0.0.1', 0), Handler)
+    server.context = context
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = 'https' if context is not None else 'http'
+    return server, '%s://127.0.0.1:%d/page' % (scheme, server.server_address[1])
+
+
+def run(transport, url, requests, concurrency):
+    headers = {'User-Agent': 'edX-downloader/0.01', 'X-CSRFToken': 'x' * 32}
+
+    def fetch(i):
+        response = transport.open(Request('%s?%d' % (url, i), None, headers))
+        return len(response.read()), getattr(response, 'http_version', 'HTTP/1.1')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(fetch, range(requests)))
+    elapsed = time.perf_counter() - start
+    transport.close()
+    versions = sorted(set(version for _, version in results))
+    return elapsed, sum(size for size, _ in results), versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--size', type=int, default=50000, help='page size of the local server')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per page of the local server')
+    parser.add_argument('--url', help='page of an HTTP/2 test server instead of the local server')
+    parser.add_argument('--insecure', action='store_true', help='do not verify the certificate of --url')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    insecure = args.insecure
+    http2 = httpx is not None
+    if url is None:
+        directory = tempfile.mkdtemp(prefix='bench-transport-')
+        try:
+            server_context = _tls_context(directory)
+        finally:
+            shutil.rmtree(directory)
+        if server_context is None:
+            print('h2 or openssl is missing, the local server speaks HTTP/1.1 without TLS: skipping http2')
+            http2 = False
+        # the certificate of the local server is self-signed
+        insecure = server_context is not None
+        server, url = serve_pages(args.size, args.latency / 1000.0, server_context)
+    context = ssl._create_unverified_context() if insecure else None
+
+    variants = [('urllib', lambda: _InsecureUrllibTransport(context) if insecure else UrllibTransport()),
+                ('pooled', lambda: PooledTransport(per_host=args.concurrency, context=context))]
+    if httpx is None:
+        print('httpx is not installed, skipping http2')
+    elif http2:
+        variants.append(('http2', lambda: Http2Transport(per_host=args.concurrency, verify=not insecure)))
+
+    print('%-8s %10s %10s %10s  %s' % ('variant', 'seconds', 'req/s', 'MiB/s', 'versions'))
+    for name, transport in variants:
+        try:
+            elapsed, size, versions = run(transport(), url, args.requests, args.concurrency)
+        except ImportError as exception:
+            print('%-8s skipped: %s' % (name, exception))
+            continue
+        print('%-8s %10.3f %10.1f %10.2f  %s' % (name, elapsed, args.requests / elapsed,
+                                                size / 2.0 ** 20 / elapsed, ', '.join(versions)))
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
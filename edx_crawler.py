@@ -8,29 +8,35 @@
 #===========================================================================================================
 
 import argparse
+import copy
+import fnmatch
 import getpass
+import hashlib
 import json
 import logging
 import os
 import pickle
 import re
+import shutil
 import sys
 import string
-import codecs
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 import pandas as pd
-import tarfile
-import shutil
 import ffmpeg
 
 from webvtt import WebVTT
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait as wait_futures
 from datetime import datetime
 from functools import partial
-from multiprocessing.dummy import Pool as ThreadPool
 from bs4 import BeautifulSoup as BeautifulSoup
 from six.moves.http_cookiejar import CookieJar
 from six.moves.urllib.error import HTTPError, URLError
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import unquote, urlencode, urlparse
 from six.moves.urllib.request import (
 	urlopen,
 	build_opener,
@@ -40,7 +46,94 @@ from six.moves.urllib.request import (
 	urlretrieve,
 )
 
+from lib.archive import (
+	ARCHIVE_FORMATS,
+	UnitArchiveWriter,
+	archive_filename,
+)
+
+from lib.blobstore import BlobStore
+
+from lib.blockcache import BlockCache
+
+from lib.columnar import ParquetExporter
+
+from lib.dedup import UrlIndex
+from lib.downloader import Downloader
+
+from lib.errorsink import ERRORS
+
+from lib.extraction import (
+	COMPONENTS,
+	comma_set,
+	crawl_units,
+	extract_unit,
+	parse_components,
+)
+
+from lib.jobapi import (
+	JobQueue,
+	serve,
+)
+
+from lib.jsonio import (
+	COMPRESSIONS,
+	write_json,
+)
+
+from lib.membudget import (
+	MEMORY,
+	parse_size,
+)
+
+from lib.metrics import (
+	METRICS,
+	instrumented,
+)
+
+from lib.planner import (
+	History,
+	build_plan,
+	write_plan,
+)
+
+from lib.profiling import PROFILER
+
+from lib.scheduler import Scheduler
+
+from lib.searchindex import SearchIndex
+
+from lib.session import (
+	LoginError,
+	SessionManager,
+)
+
+from lib.sqlstore import SqlStore
+
+from lib.tracing import (
+	TRACER,
+	traced,
+)
+
+from lib.transport import (
+	TRANSPORTS,
+	make_transport,
+)
+
+from lib.warc import WARC
+
+from lib.watch import (
+	CHANGES_FILENAME,
+	STATE_FILENAME,
+	ChangeLog,
+	WatchState,
+	diff_blocks,
+	subsection_entry,
+	unit_fingerprint,
+)
+
 from lib.common import (
+	Section,
 	Unit,
 	Video,
 	ExitCode,
@@ -60,12 +153,14 @@ from lib.utils import (
 	get_filename_from_prefix,
 	get_page_contents,
 	get_page_contents_as_json,
+	get_page_contents_if_modified,
 	mkdir_p,
-	remove_duplicates,
+	set_session,
+	set_transport,
 )
 
 
-def parse_args():
+def parse_args(argv=None):
 	
 	parser = argparse.ArgumentParser(prog='edx-crawler',
 									 description='Crawling text from the OpenEdX platform')
@@ -83,9 +178,8 @@ def parse_args():
 	parser.add_argument('-u',
 						'--username',
 						dest='username',
-						required=True,
 						action='store',
-						help='your edX username (email)')
+						help='your edX username (email), not needed with --replay')
 
 	parser.add_argument('-p',
 						'--password',
@@ -112,7 +206,9 @@ def parse_args():
 						dest='filter_section',
 						action='store',
 						default=None,
-						help='filters sections to be downloaded')
+						help='filters sections to be downloaded: comma separated '
+						'section indexes (3), ranges (2-4, 3-) and subsection name '
+						'patterns (\'Week 1*\')')
 
 	parser.add_argument('--list-file-formats',
 						dest='list_file_formats',
@@ -138,7 +234,299 @@ def parse_args():
 						dest='sequential',
 						action='store_true',
 						default=False,
-						help='extracts the resources from the pages sequentially')
+						help='crawls the pages sequentially (same as --workers 1)')
+
+	parser.add_argument('--workers',
+						dest='workers',
+						action='store',
+						type=int,
+						default=16,
+						help='number of concurrent outline, subsection and '
+						'video tasks, shared by all the courses')
+
+	parser.add_argument('--per-host-limit',
+						dest='per_host_limit',
+						action='store',
+						type=int,
+						default=None,
+						help='maximum concurrent tasks against one host '
+						'(default --workers, no limit of its own)')
+
+	parser.add_argument('--per-course-limit',
+						dest='per_course_limit',
+						action='store',
+						type=int,
+						default=4,
+						help='maximum concurrent tasks of one course while other '
+						'courses have work, so that the courses are crawled '
+						'side by side')
+
+	parser.add_argument('--archive-format',
+						dest='archive_format',
+						action='store',
+						choices=sorted(ARCHIVE_FORMATS),
+						default='gz',
+						help='compression of the unit html archive: gz '
+						'(sourcefile.tar.gz) or zst (multithreaded zstd, '
+						'sourcefile.tar.zst)')
+
+	parser.add_argument('--blob-store',
+						dest='blob_store',
+						action='store',
+						default=None,
+						help='directory of a content-addressed store shared '
+						'between courses and runs; units are stored there once '
+						'and referenced from metadata.csv instead of being '
+						'archived per course')
+
+	parser.add_argument('--metrics-dir',
+						dest='metrics_dir',
+						action='store',
+						default=None,
+						help='directory where metrics.prom (Prometheus text '
+						'format) and metrics.json are written at exit')
+
+	parser.add_argument('--profile',
+						dest='profile',
+						action='store',
+						default=None,
+						help='profile every crawler stage (sampled stacks, wall '
+						'and cpu time) and write the reports into this directory')
+
+	parser.add_argument('--profile-interval',
+						dest='profile_interval',
+						action='store',
+						type=float,
+						default=5,
+						help='milliseconds between two stack samples of '
+						'--profile (default 5)')
+
+	parser.add_argument('--profile-cpu',
+						dest='profile_cpu',
+						action='store_true',
+						default=False,
+						help='also run cProfile in the stages of --profile '
+						'(<stage>.pstats), which slows the crawl down')
+
+	parser.add_argument('--profile-memory',
+						dest='profile_memory',
+						action='store',
+						type=int,
+						default=0,
+						help='also trace the memory allocated by the stages of '
+						'--profile with tracemalloc, keeping this many frames '
+						'per allocation (default 0, off), which slows the crawl '
+						'down')
+
+	parser.add_argument('--trace',
+						dest='trace',
+						action='store',
+						default=None,
+						help='record a timeline of every request and '
+						'extraction step into this file (Chrome trace-event '
+						'JSON, viewable in Perfetto)')
+
+	parser.add_argument('--url-index',
+						dest='url_index',
+						action='store',
+						default=None,
+						help='file keeping the resource urls already seen, to '
+						'remove repeated urls across runs and courses')
+
+	parser.add_argument('--url-index-bloom',
+						dest='url_index_bloom',
+						action='store',
+						type=int,
+						default=None,
+						help='use a compact probabilistic (Bloom filter) url '
+						'index sized for this many urls')
+
+	parser.add_argument('--session-store',
+						dest='session_store',
+						action='store',
+						default=None,
+						help='file keeping the login session (encrypted with '
+						'the password) to reuse it in the next runs')
+
+	parser.add_argument('--memory-budget',
+						dest='memory_budget',
+						action='store',
+						type=parse_size,
+						default=None,
+						help='resident memory budget of the process (e.g. '
+						'512M), fetching waits while it is exceeded')
+
+	parser.add_argument('--max-inflight-bytes',
+						dest='max_inflight_bytes',
+						action='store',
+						type=parse_size,
+						default=None,
+						help='maximum size of the pages fetched and parsed at '
+						'the same time (e.g. 64M)')
+
+	parser.add_argument('--text-structure',
+						dest='text_structure',
+						action='store_true',
+						default=False,
+						help='keep the structure (headings, paragraphs, list '
+						'items) of the text and quiz blocks in the json output')
+
+	parser.add_argument('--components',
+						dest='components',
+						action='store',
+						type=parse_components,
+						default=','.join(sorted(COMPONENTS)),
+						help='comma separated components to extract among text, '
+						'problem and video (default all); the others are neither '
+						'extracted nor fetched')
+
+	parser.add_argument('--transcript-langs',
+						dest='transcript_langs',
+						action='store',
+						type=comma_set,
+						default=None,
+						help='comma separated languages of the transcripts to '
+						'download (e.g. en,ja), default all the available ones')
+
+	parser.add_argument('--search-index',
+						dest='search_index',
+						action='store',
+						default=None,
+						help='SQLite database with a full-text index of the '
+						'text blocks, quizzes and transcripts, updated as units '
+						'are crawled (query it with python -m lib.searchindex)')
+
+	parser.add_argument('--sql-store',
+						dest='sql_store',
+						action='store',
+						default=None,
+						help='also write the courses, units, components, '
+						'videos and transcripts into this SQLite database, '
+						'which several crawlers can share')
+
+	parser.add_argument('--parquet-dir',
+						dest='parquet_dir',
+						action='store',
+						default=None,
+						help='also write the components, videos and transcript '
+						'segments as Parquet datasets partitioned by course into '
+						'this directory (requires pyarrow)')
+
+	parser.add_argument('--json-compression',
+						dest='json_compression',
+						action='store',
+						choices=sorted(COMPRESSIONS),
+						default='none',
+						help='compression of the json outputs: none (default), '
+						'gz or zst (requires zstandard)')
+
+	parser.add_argument('--compact-json',
+						dest='compact_json',
+						action='store_true',
+						default=False,
+						help='write the json outputs without indentation and '
+						'with UTF-8 characters instead of escapes')
+
+	parser.add_argument('--block-cache',
+						dest='block_cache',
+						action='store',
+						default=None,
+						help='SQLite database caching the extraction of every '
+						'block by its usage id and content, so that the blocks '
+						'shared by the runs of a course are extracted once')
+
+	parser.add_argument('--plan',
+						dest='plan',
+						action='store',
+						default=None,
+						help='only fetch the outlines and write the plan of the '
+						'crawl (counts, cached subsections, estimates) into this '
+						'json file')
+
+	parser.add_argument('--plan-history',
+						dest='plan_history',
+						action='append',
+						default=None,
+						help='metrics.json (or metrics directory) of a previous '
+						'crawl to estimate the plan from, can be repeated '
+						'(default: the one of --metrics-dir)')
+
+	parser.add_argument('--daemon',
+						dest='daemon',
+						action='store',
+						default=None,
+						help='run as a daemon crawling the jobs submitted to a '
+						'local API on this address (host:port or unix:/path)')
+
+	parser.add_argument('--daemon-jobs',
+						dest='daemon_jobs',
+						action='store',
+						type=int,
+						default=2,
+						help='number of daemon jobs crawled at the same time')
+
+	parser.add_argument('--watch',
+						dest='watch',
+						action='store',
+						type=float,
+						default=None,
+						help='watch the courses: poll them every this many '
+						'seconds and crawl only the subsections that changed')
+
+	parser.add_argument('--watch-state',
+						dest='watch_state',
+						action='store',
+						default=None,
+						help='file keeping the fingerprints of the watched '
+						'courses (default: watch_state.json in the html dir)')
+
+	parser.add_argument('--transport',
+						dest='transport',
+						action='store',
+						choices=TRANSPORTS,
+						default='urllib',
+						help='transport of the requests: urllib (one connection '
+						'per request, default), pooled (HTTP/1.1 keep-alive) or '
+						'http2 (requires httpx[http2], falls back to pooled)')
+
+	parser.add_argument('--record',
+						dest='record',
+						action='store',
+						default=None,
+						help='record every request and the results of '
+						'youtube-dl and ffmpeg into WARC files of this directory')
+
+	parser.add_argument('--replay',
+						dest='replay',
+						action='append',
+						default=None,
+						help='crawl from the WARC files (or directories) '
+						'recorded with --record instead of the network, '
+						'without login; can be repeated')
+
+	parser.add_argument('--download-dir',
+						dest='download_dir',
+						action='store',
+						default=None,
+						help='download the resources and mp4 videos of the '
+						'units into this directory after the crawl, each file '
+						'stored once and hard linked into the units sharing it')
+
+	parser.add_argument('--download-workers',
+						dest='download_workers',
+						action='store',
+						type=int,
+						default=8,
+						help='number of concurrent downloads and segments '
+						'(default 8)')
+
+	parser.add_argument('--download-segment-size',
+						dest='download_segment_size',
+						action='store',
+						type=float,
+						default=8,
+						help='size in MiB of the range segments large files '
+						'are downloaded in parallel by (default 8)')
 
 	parser.add_argument('--quiet',
 						dest='quiet',
@@ -152,7 +540,7 @@ def parse_args():
 						default=False,
 						help='print lots of debug information')
 
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
 
 	# Initialize the logging system first so that other functions
 	# can use it right away.
@@ -205,25 +593,28 @@ def _display_courses(courses):
 		logging.info('     %s', course.url)
 
 
-def get_courses_info(url, headers):
+def get_courses_info(url, headers, page=None):
 	"""
-	Extracts the courses information from the dashboard.
+	Extracts the courses information from the dashboard (or its page
+	already fetched).
 	"""
 	logging.info('Extracting course information from dashboard.')
 
-	page = get_page_contents(url, headers)
+	if page is None:
+		page = get_page_contents(url, headers)
 	page_extractor = get_page_extractor(url)
-	courses = page_extractor.extract_courses_from_html(page, BASE_URL)
+	with METRICS.timed('extract_courses'), TRACER.span('extract_courses', 'parse'):
+		courses = page_extractor.extract_courses_from_html(page, BASE_URL)
 
 	logging.debug('Data extracted: %s', courses)
 
 	return courses
 
 
-def _get_initial_token(url):
+def _get_initial_token(url, cookiejar=None):
 	"""
 	Create initial connection to get authentication token for future
-	requests.
+	requests. The cookies are kept in cookiejar (a new one if None).
 
 	Returns a string to be used in subsequent connections with the
 	X-CSRFToken header or the empty string if we didn't find any token in
@@ -231,7 +622,8 @@ def _get_initial_token(url):
 	"""
 	logging.info('Getting initial CSRF token.')
 
-	cookiejar = CookieJar()
+	if cookiejar is None:
+		cookiejar = CookieJar()
 	opener = build_opener(HTTPCookieProcessor(cookiejar))
 	install_opener(opener)
 	opener.open(url)
@@ -245,15 +637,18 @@ def _get_initial_token(url):
 	return ''
 
 
-def get_available_sections(url, headers):
+def get_available_sections(url, headers, page=None):
 	"""
-	Extracts the sections and subsections from a given url
+	Extracts the sections and subsections from a given url (or its page
+	already fetched)
 	"""
 	logging.debug("Extracting sections for :" + url)
 
-	page = get_page_contents(url, headers)
+	if page is None:
+		page = get_page_contents(url, headers)
 	page_extractor = get_page_extractor(url)
-	sections = page_extractor.extract_sections_from_html(page, BASE_URL)
+	with METRICS.timed('extract_sections'), TRACER.span('extract_sections', 'parse', url=url):
+		sections = page_extractor.extract_sections_from_html(page, BASE_URL)
 
 	logging.debug("Extracted sections: " + str(sections))
 	return sections
@@ -275,7 +670,7 @@ def edx_login(url, headers, username, password):
 	return resp
 
 
-def edx_get_headers():
+def edx_get_headers(cookiejar=None):
 	"""
 	Build the Open edX headers to create future requests.
 	"""
@@ -287,52 +682,24 @@ def edx_get_headers():
 		'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8',
 		'Referer': EDX_HOMEPAGE,
 		'X-Requested-With': 'XMLHttpRequest',
-		'X-CSRFToken': _get_initial_token(EDX_HOMEPAGE),
+		'X-CSRFToken': _get_initial_token(EDX_HOMEPAGE, cookiejar),
 	}
 
 	logging.debug('Headers built: %s', headers)
 	return headers
 
 
-def extract_units(url, headers, file_formats):
+def edx_authenticate(username, password, cookiejar):
 	"""
-	Parses a webpage and extracts its resources e.g. video_url, sub_url, etc.
+	Get the initial token and log in, keeping the session cookies in
+	cookiejar. Returns the headers of the session, raises LoginError if the
+	credentials are refused.
 	"""
-	#logging.info("Processing '%s'", url)
-
-	page = get_page_contents(url, headers)
-	page_extractor = get_page_extractor(url)
-	units = page_extractor.extract_units_from_html(page, BASE_URL, file_formats)
-	return units
-
-
-def extract_all_units_in_sequence(urls, headers, file_formats):
-	"""
-	Returns a dict of all the units in the selected_sections: {url, units}
-	sequentially, this is clearer for debug purposes
-	"""
-	logging.info('Extracting all units information in sequentially.')
-	logging.debug('urls: ' + str(urls))
-
-	units = [extract_units(url, headers, file_formats) for url in urls]
-	all_units = dict(zip(urls, units))
-	return all_units
-
-def extract_all_units_in_parallel(urls, headers, file_formats):
-	"""
-	Returns a dict of all the units in the selected_sections: {url, units}
-	in parallel
-	"""
-	logging.info('Extracting all units information in parallel.')
-	logging.debug('urls: ' + str(urls))
-
-	mapfunc = partial(extract_units, file_formats=file_formats, headers=headers)
-	pool = ThreadPool(16)
-	units = pool.map(mapfunc, urls)
-	pool.close()
-	pool.join()
-	all_units = dict(zip(urls, units))
-	return all_units
+	headers = edx_get_headers(cookiejar)
+	resp = edx_login(LOGIN_API, headers, username, password)
+	if not resp.get('success', False):
+		raise LoginError(resp.get('value', "Wrong Email or Password."))
+	return headers
 
 
 def _display_sections_menu(course, sections):
@@ -346,30 +713,62 @@ def _display_sections_menu(course, sections):
 		logging.info('%2d - Download %s videos', i, section.name)
 
 
-def _filter_sections(index, sections):
+def _parse_section_filter(spec, num_sections):
+	"""
+	Parses a --filter-section value: comma separated section indexes (3),
+	ranges of indexes (2-4, 3-, -2) and subsection name patterns (shell
+	wildcards, case insensitive). Returns the selected section indexes (None
+	for all the sections) and the subsection name patterns.
+	"""
+	indexes = None
+	patterns = []
+	for term in spec.split(','):
+		term = term.strip()
+		if not term:
+			continue
+		match = re.match(r'^(\d*)\s*-\s*(\d*)$', term)
+		if term.isdigit() or (match and any(match.groups())):
+			if term.isdigit():
+				first = last = int(term)
+			else:
+				first = int(match.group(1) or 1)
+				last = int(match.group(2) or num_sections)
+			selected = [index for index in range(first, last + 1) if 0 < index <= num_sections]
+			if not selected:
+				logging.warning('No section in %s, there are %d sections', term, num_sections)
+			indexes = (indexes or set()).union(selected)
+		else:
+			patterns.append(term.lower())
+	return indexes, patterns
+
+
+def _filter_sections(spec, sections):
 	"""
-	Get the sections for the given index.
+	Get the sections selected by spec (see _parse_section_filter), with
+	only their subsections matching the name patterns.
 
-	If the index is not valid (that is, None, a non-integer, a negative
-	integer, or an integer above the number of the sections), we choose all
-	sections.
+	If no index of spec is valid (that is, negative or above the number of
+	the sections), we choose all sections.
 	"""
 	num_sections = len(sections)
 
 	logging.info('Filtering sections')
 
-	if index is not None:
-		try:
-			index = int(index)
-			if index > 0 and index <= num_sections:
-				logging.info('Sections filtered to: %d', index)
-				return [sections[index - 1]]
-			else:
-				pass  # log some info here
-		except ValueError:
-			pass   # log some info here
-	else:
-		pass  # log some info here
+	if spec is None:
+		return sections
+	indexes, patterns = _parse_section_filter(str(spec), num_sections)
+	if indexes:
+		logging.info('Sections filtered to: %s', ', '.join(str(index) for index in sorted(indexes)))
+		sections = [section for index, section in enumerate(sections, 1) if index in indexes]
+	if patterns:
+		sections = [Section(section.position, section.name, section.url,
+							[subsection for subsection in section.subsections
+							 if any(fnmatch.fnmatchcase((subsection.name or 'Untitled').strip().lower(), pattern)
+									for pattern in patterns)])
+					for section in sections]
+		sections = [section for section in sections if section.subsections]
+		logging.info('Subsections filtered to %d matching: %s',
+					 sum(len(section.subsections) for section in sections), ', '.join(patterns))
 	return sections
 
 
@@ -421,7 +820,7 @@ def parse_file_formats(args):
 	"""
 	parse options for file formats and builds the array to be used
 	"""
-	file_formats = DEFAULT_FILE_FORMATS
+	file_formats = list(DEFAULT_FILE_FORMATS)
 
 	if args.list_file_formats:
 		logging.info(file_formats)
@@ -458,26 +857,30 @@ def parse_units(all_units):
 		exit(ExitCode.NO_DOWNLOADABLE_VIDEO)
 
 
-def remove_repeated_urls(all_units):
+def remove_repeated_urls(all_units, index=None):
 	"""
 	Removes repeated urls from the units, it does not consider subtitles.
 	This is done to avoid repeated downloads.
+
+	The urls are recorded into index (a UrlIndex), which keeps the units
+	sharing each url; units are identified as '<subsection url>#<position>'.
 	"""
-	existing_urls = set()
+	if index is None:
+		index = UrlIndex()
 	filtered_units = {}
 	for url, units in all_units.items():
 		reduced_units = []
-		for unit in units:
+		for position, unit in enumerate(units, 1):
+			owner = '%s#%d' % (url, position)
 			videos = []
 			for video in unit.videos:
 				# we don't analyze the subtitles for repetition since
 				# their size is negligible for the goal of this function
 				video_youtube_url = None
-				if video.video_youtube_url not in existing_urls:
+				if video.video_youtube_url is not None and index.add(video.video_youtube_url, owner):
 					video_youtube_url = video.video_youtube_url
-					existing_urls.add(video_youtube_url)
 
-				mp4_urls, existing_urls = remove_duplicates(video.mp4_urls, existing_urls)
+				mp4_urls = index.filter(video.mp4_urls, owner)
 
 				if video_youtube_url is not None or len(mp4_urls) > 0:
 					videos.append(Video(video_youtube_url=video_youtube_url,
@@ -485,7 +888,7 @@ def remove_repeated_urls(all_units):
 										sub_template_url=video.sub_template_url,
 										mp4_urls=mp4_urls))
 
-			resources_urls, existing_urls = remove_duplicates(unit.resources_urls, existing_urls)
+			resources_urls = index.filter(unit.resources_urls, owner)
 
 			if len(videos) > 0 or len(resources_urls) > 0:
 				reduced_units.append(Unit(videos=videos,
@@ -495,6 +898,45 @@ def remove_repeated_urls(all_units):
 	return filtered_units
 
 
+def download_targets(args, selections, all_units):
+	"""
+	Returns the files to download, {url: [paths]}: the resources and mp4
+	videos (when the video components are crawled) of the units, each url
+	once with the places of all the units containing it (identified like in
+	remove_repeated_urls), as
+	<course>/<section>/<subsection>/<unit position>-<file name>.
+	"""
+	subsection_dirs = {}
+	for selected_course, selected_sections in selections.items():
+		for selected_section in selected_sections:
+			for subsection in selected_section.subsections:
+				subsection_dirs[subsection.url] = os.path.join(
+					directory_name(selected_course.name),
+					directory_name("%02d-%s" % (selected_section.position, selected_section.name)),
+					directory_name("%02d-%s" % (subsection.position, subsection.name or 'Untitled')))
+
+	targets = {}
+	used = {}
+	for url, units in all_units.items():
+		for position, unit in enumerate(units, 1):
+			urls = list(unit.resources_urls)
+			if 'video' in args.components:
+				urls = [mp4_url for video in unit.videos for mp4_url in video.mp4_urls] + urls
+			for resource_url in urls:
+				filename = clean_filename(unquote(os.path.basename(urlparse(resource_url).path)),
+										  minimal_change=True) or 'resource'
+				path = os.path.join(subsection_dirs[url], '%02d-%s' % (position, filename))
+				# different files of the same name in a unit
+				root, extension = os.path.splitext(path)
+				count = 1
+				while used.setdefault(path, resource_url) != resource_url:
+					count += 1
+					path = '%s-%d%s' % (root, count, extension)
+				if path not in targets.setdefault(resource_url, []):
+					targets[resource_url].append(path)
+	return targets
+
+
 def num_urls_in_units_dict(units_dict):
 	"""
 	Counts the number of urls in a all_units dict, it ignores subtitles from
@@ -525,59 +967,9 @@ def save_urls_to_file(urls, filename):
 	file_.close()
 
 
-def extract_problem_comp(soup):
-
-	tmp = []
-	problem_flag = soup.findAll("div", {"data-block-type": "problem"})  ## filter problem component
-	for problem_comp in problem_flag:
-		dict_soup = problem_comp.find(attrs={"data-content":True}).attrs    ## search no-html parser part
-		txt2html = BeautifulSoup(dict_soup["data-content"],'html.parser')       
-		dict_soup["data-content"] = BeautifulSoup(txt2html.prettify(formatter=None),'html.parser') ## restore html parser 
-		tmp.append( dict_soup["data-content"])    ## save each problem component in list 
-	type_div = []
-	text = ''
-	for each_problem_content in tmp:
-			
-		for s in each_problem_content.findAll(['h1','h2','h3','h4','h5','h6','p','label','legend','label','option']):     
-			text+=s.getText()+" " 
-		
-		############################ search for type of problem(quiz) ######################################
-		#### from obseavation, multichoice & checkbox use the same clase. The difference lie into type of input option
-		####                   fillblank & droplist use the same clase but different subclass
-		#### class has two attribute located at the 4th layer ('div'), with attribute ['class'][<class> <subclass>]  
-		try:
-			type_div_tmp = each_problem_content.findAll('div')[4]['class'][0]        
-			if type_div_tmp == 'choicegroup':    
-				multi_or_check = each_problem_content.findAll('input')[0].attrs['type']
-				if multi_or_check == 'checkbox':
-					type_div_tmp ='checkbox'
-				else:
-					type_div_tmp = 'multichoice' 
-			elif type_div_tmp == 'inputtype':
-				if each_problem_content.findAll('div')[4]['class'][1] == 'option-input':
-					type_div_tmp = 'droplist'
-				else:
-					type_div_tmp = 'fillblank' 
-		except KeyError:
-			type_div_tmp = 'N/A'
-		type_div.append(type_div_tmp)   ## append all list of problem types into type_div
-	return text,type_div 
-	   
-def crawl_units(subsection_page):
-	unit = []
-	tmp=[]
-	unit_name =[]
-	idx = 0
-	while tmp is not None:
-	  id_name = "seq_contents_"+str(idx)
-	  tmp = subsection_page.find("div", {"id": id_name})
-	  #print ("tmp: %s\n", tmp)
-	  unit.append(tmp)
-	  idx = idx + 1 
-	unit.remove(None)
-	return unit
-
-
+@WARC.replayable('videolen')
+@instrumented('videolen')
+@traced('subprocess')
 def videolen(yt_link):
 	duration = 0
 	## error handling when Youtube video is not currently available
@@ -591,6 +983,7 @@ def videolen(yt_link):
 		else:
 			duration = int(timeformat[0])*3600+int(timeformat[1])*60+ int(timeformat[2])
 	except subprocess.CalledProcessError as e:
+		METRICS.error('videolen', e)
 		print("video link bug: Youtube link is not available")
 	return duration
 
@@ -609,8 +1002,14 @@ def vtt2json(vttfile):
 	return dict_obj
 
 
+@WARC.replayable('YT_transcript', key=lambda yt_link, key: '%s#%s' % (yt_link, key))
+@instrumented('YT_transcript')
+@traced('subprocess')
 def YT_transcript(yt_link,key):
 	transcript_raw = ''
+	# the videos are crawled concurrently, each call writes its subtitles in
+	# its own directory
+	tmp_dir = tempfile.mkdtemp(prefix='edx-crawler-vtt-')
 	## error handling when Youtube video is not currently available
 	try:
 		checksub = subprocess.check_output(["youtube-dl",yt_link, "--list-sub"])
@@ -618,14 +1017,18 @@ def YT_transcript(yt_link,key):
 			lang_ls = list(filter(None, checksub.decode("utf-8").split('Language formats\n')[2].split('\n')))
 			for lang in lang_ls:
 				if key in lang:
-					sub_dl = subprocess.check_output(["youtube-dl", yt_link, "--skip-download", "--write-sub", "--sub-lang", key])
+					sub_dl = subprocess.check_output(["youtube-dl", yt_link, "--skip-download", "--write-sub", "--sub-lang", key],
+													 cwd=tmp_dir)
 					#vttfile = re.sub(r'\n','',sub_dl.decode('utf-8').split('Writing video subtitles to: ')[1])
-					files = os.listdir()
-					vttfile = [name for name in files if name.endswith('vtt')]
-					transcript_raw = vtt2json(vttfile[0])
-					os.remove(vttfile[0])
+					vttfile = sorted(name for name in os.listdir(tmp_dir) if name.endswith('vtt'))
+					if vttfile:
+						transcript_raw = vtt2json(os.path.join(tmp_dir, vttfile[0]))
+						os.remove(os.path.join(tmp_dir, vttfile[0]))
 	except subprocess.CalledProcessError as e:
+		METRICS.error('YT_transcript', e)
 		print ("transcript link bug: Youtube link is not available")
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
 	return transcript_raw
 
 
@@ -636,353 +1039,961 @@ def extract_speech_period(start_ls,end_ls):
 		period_ls.append(tmp_period)
 	return period_ls
 
+@WARC.replayable('mp4_duration', key=lambda source_mp4, headers: source_mp4)
+@instrumented('extract_duration_from_non_YT_video')
+@traced('subprocess')
 def extract_duration_from_non_YT_video(source_mp4,headers):
-	file_name = 'trial_video.mp4' 
-	#print(source_mp4)
-	rsp = urlopen(Request(source_mp4, None, headers))
-	with open(file_name,'wb') as f:
-		f.write(rsp.read())
-	probe = ffmpeg.probe(file_name)
-	duration = probe['streams'][1]['duration']
-	os.remove(file_name)
+	# the videos are crawled concurrently, each call probes its own file
+	tmp_dir = tempfile.mkdtemp(prefix='edx-crawler-mp4-')
+	file_name = os.path.join(tmp_dir, 'trial_video.mp4')
+	try:
+		#print(source_mp4)
+		rsp = urlopen(Request(source_mp4, None, headers))
+		with open(file_name,'wb') as f:
+			f.write(rsp.read())
+		probe = ffmpeg.probe(file_name)
+		duration = probe['streams'][1]['duration']
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
 	#print(probe)
 	return(duration)
 
-def extract_video_component(args,coursename,headers,soup,section,subsection,unit):	
-	
-	video_flag = soup.findAll("div", {"data-block-type": "video"})
-	video_meta_list = []
-	for video_comp in video_flag:
-		video_meta = dict()
-		txtjson = video_comp.find('div',{"data-metadata":True})['data-metadata']
-		txt2dict = json.loads(txtjson)
-		yt_id = re.sub(r"1.00:", '', txt2dict['streams'])
-		if len(txt2dict['streams']) == 0:
-			duration = txt2dict['duration']
-			yt_link = 'n/a'
-			video_source = [i for i in txt2dict['sources'] if i.endswith('mp4')]
-			if duration == 0:
-				try:
-					duration = extract_duration_from_non_YT_video(video_source[0],headers)
-				except (HTTPError,URLError) as exception:
-					print('     bug: cannot download video from edx site')
-					duration = 'n/a'
-			video_meta.update({'section': section , 'subsection': subsection, 'unit': unit, 'youtube_url':yt_link,'video_source':video_source[0], 'video_duration':duration})
-		else:
-			yt_link = 'https://youtu.be/'+ yt_id
-			duration = videolen(yt_link)
-			video_source = 'n/a'
-			if duration == 0:
-				duration = txt2dict['duration']
-			video_meta.update({'section': section , 'subsection': subsection, 'unit': unit, 'youtube_url':yt_link,'video_source':video_source, 'video_duration':duration})
+def _requested_languages(args, video_metadata):
+	return sorted(key for key in video_metadata['transcriptLanguages']
+				  if args.transcript_langs is None or key in args.transcript_langs)
 
 
-		
-		for key, value in txt2dict['transcriptLanguages'].items():
-			transcript_name = 'transcript_'+ key
-			transcript_url = OPENEDX_SITES['edx']['url'] + re.sub(r"__lang__",key, txt2dict['transcriptTranslationUrl']) 
-			if yt_link == 'n/a':
-				print('download '+ value + ' transcript of '+ video_source[0])
-			else:
-				print('download '+ value + ' transcript of '+ yt_link)
+def extract_video(args,coursename,headers,txt2dict,section,subsection,unit):
+	"""
+	Extracts the duration and the transcripts of a video from its metadata.
+	"""
+	video_meta = dict()
+	yt_id = re.sub(r"1.00:", '', txt2dict['streams'])
+	if len(txt2dict['streams']) == 0:
+		duration = txt2dict['duration']
+		yt_link = 'n/a'
+		video_source = [i for i in txt2dict['sources'] if i.endswith('mp4')]
+		if duration == 0:
 			try:
-				transcript_dump = get_page_contents(transcript_url, headers)
-				transcript_raw = json.loads(transcript_dump)
-				#print (transcript_raw)
-				speech_period = extract_speech_period(transcript_raw['start'],transcript_raw['end'])
-		
-				video_meta.update({transcript_name:transcript_raw['text'],'speech_period':speech_period})
+				duration = extract_duration_from_non_YT_video(video_source[0],headers)
 			except (HTTPError,URLError) as exception:
+				print('     bug: cannot download video from edx site')
+				ERRORS.report('video', str(exception), course=coursename,
+							  course_dir=os.path.join(args.html_dir,coursename),
+							  details=[('video file', video_source[0]), ('section', section),
+									   ('subsection', subsection), ('unit_idx', unit)])
+				duration = 'n/a'
+		video_meta.update({'section': section , 'subsection': subsection, 'unit': unit, 'youtube_url':yt_link,'video_source':video_source[0], 'video_duration':duration})
+	else:
+		yt_link = 'https://youtu.be/'+ yt_id
+		duration = videolen(yt_link)
+		video_source = 'n/a'
+		if duration == 0:
+			duration = txt2dict['duration']
+		video_meta.update({'section': section , 'subsection': subsection, 'unit': unit, 'youtube_url':yt_link,'video_source':video_source, 'video_duration':duration})
 
-				print('     bug: cannot download transcript from edx site')
-				if yt_link == 'n/a':
-					video_meta.update({transcript_name:{"start":'',"end":'',"text":''},'speech_period':'n/a'})
-					logging.warning('transcript (error: %s)', exception)
-					errorlog = os.path.join(args.html_dir,coursename,'transcript_error_report.txt')
-					f = open(errorlog, 'a',encoding='utf-8')
-					text = '---------------------------------\n'\
-					+ 'transcript error: ' + str(exception) +'\n' \
-					+ 'video file: '+ video_source[0] +'\n' \
-					+ 'language: ' + value + '\n' \
-					+ 'section:  ' + section + '\n'\
-					+ 'subsection: ' + subsection + '\n'\
-					+ 'unit_idx: ' + unit + '\n' \
-					+'---------------------------------'
-					f.write(text)
-					f.close()
-					continue
-
-				print('     attempt to download transcript on Youtube')
-				transcript_raw = YT_transcript(yt_link,key)
-				if len(transcript_raw) == 0:
-					print('     no transcript available on YouTube')
-					video_meta.update({transcript_name:{"start":'',"end":'',"text":''},'speech_period':'n/a'})
-					logging.warning('transcript (error: %s)', exception)
-					errorlog = os.path.join(args.html_dir,coursename,'transcript_error_report.txt')
-					f = open(errorlog, 'a',encoding='utf-8')
-					text = '---------------------------------\n'\
-					+ 'transcript error: ' + str(exception) +'\n' \
-					+ 'video url: '+ yt_link +'\n' \
-					+ 'language: ' + value + '\n' \
-					+ 'section:  ' + section + '\n'\
-					+ 'subsection: ' + subsection + '\n'\
-					+ 'unit_idx: ' + unit + '\n' \
-					+'---------------------------------'
-					f.write(text)
-					f.close()
-				else:
-					print('     transcript was successfuly downloaded from YouTube')
-					speech_period = extract_speech_period(transcript_raw['start'],transcript_raw['end'])
-					video_meta.update({transcript_name:transcript_raw['text'],'speech_period':speech_period})
 
-		video_meta_list.append(video_meta)
-	return video_meta_list
+	
+	for key, value in txt2dict['transcriptLanguages'].items():
+		if args.transcript_langs is not None and key not in args.transcript_langs:
+			continue
+		transcript_name = 'transcript_'+ key
+		transcript_url = OPENEDX_SITES['edx']['url'] + re.sub(r"__lang__",key, txt2dict['transcriptTranslationUrl']) 
+		if yt_link == 'n/a':
+			print('download '+ value + ' transcript of '+ video_source[0])
+		else:
+			print('download '+ value + ' transcript of '+ yt_link)
+		try:
+			transcript_dump = get_page_contents(transcript_url, headers)
+			transcript_raw = json.loads(transcript_dump)
+			#print (transcript_raw)
+			speech_period = extract_speech_period(transcript_raw['start'],transcript_raw['end'])
+	
+			video_meta.update({transcript_name:transcript_raw['text'],'speech_period':speech_period})
+		except (HTTPError,URLError) as exception:
 
+			print('     bug: cannot download transcript from edx site')
+			if yt_link == 'n/a':
+				video_meta.update({transcript_name:{"start":'',"end":'',"text":''},'speech_period':'n/a'})
+				logging.warning('transcript (error: %s)', exception)
+				ERRORS.report('transcript', str(exception), course=coursename,
+							  course_dir=os.path.join(args.html_dir,coursename),
+							  report='transcript_error_report.txt',
+							  details=[('video file', video_source[0]), ('language', value),
+									   ('section', section), ('subsection', subsection),
+									   ('unit_idx', unit)])
+				continue
+
+			print('     attempt to download transcript on Youtube')
+			transcript_raw = YT_transcript(yt_link,key)
+			if len(transcript_raw) == 0:
+				print('     no transcript available on YouTube')
+				video_meta.update({transcript_name:{"start":'',"end":'',"text":''},'speech_period':'n/a'})
+				logging.warning('transcript (error: %s)', exception)
+				ERRORS.report('transcript', str(exception), course=coursename,
+							  course_dir=os.path.join(args.html_dir,coursename),
+							  report='transcript_error_report.txt',
+							  details=[('video url', yt_link), ('language', value),
+									   ('section', section), ('subsection', subsection),
+									   ('unit_idx', unit)])
+			else:
+				print('     transcript was successfuly downloaded from YouTube')
+				speech_period = extract_speech_period(transcript_raw['start'],transcript_raw['end'])
+				video_meta.update({transcript_name:transcript_raw['text'],'speech_period':speech_period})
 
+	return video_meta
 
 
-def save_html_to_file(args, selections, all_urls, headers):
+# fields of the video records set from the place of the video
+_VIDEO_PLACE = ('section', 'subsection', 'unit')
 
-	sub_idx = 0
-	prob_type_set = []
-	counter_video = 1
-	counter_unit = 1
-	txt_id = 1
-	prob_id = 1
-	video_id =  1
-	comp_id = 1
-	tmp_course_strut = dict()
-	txt_dict_ls = dict()
-	prob_dict_ls = dict()
-	comp_dict_ls = dict()
-	video_dict_ls = dict()
-	for selected_course, selected_sections in selections.items():
-		coursename = directory_name(selected_course.name)
-		sourcepath = os.path.join(args.html_dir, coursename,'source_html_file')
-		mkdir_p(sourcepath)
-		#filename_meta = os.path.join(sourcepath, 'html_metadata.csv')
-		
-		metasec_ls = [[],[],[],[]]
-		for selected_section in selected_sections:
-			section_dirname = "%02d-%s" % (selected_section.position,
-										   selected_section.name)
-			tmp_course_strut['section'] = (section_dirname)
 
-			for subsection in selected_section.subsections:
-			   
-				if subsection.name == None:
-					subsection.name = 'Untitled'
-
-			
-				tmp_course_strut['subsection'] = (subsection.name)
-				#logging.info('url: '+ str(all_urls[sub_idx]) )
-				print(all_urls[sub_idx])
-				page = get_page_contents(str(all_urls[sub_idx]), headers)
-				soup = BeautifulSoup(page, "html.parser")
-
-				#div contains all units (seq_contents_#)
-				main_content=soup.find("div", {"class": "container"})
-
-				units = crawl_units(main_content)		
-
-				sub_idx = sub_idx+1
-
-				for idx,unit in enumerate(units):
-					
-					filename_template = str(counter_unit).zfill(4) +".html"
-					filename = os.path.join(args.html_dir, coursename,'source_html_file', filename_template)
-
-
-					try:
-						file_ = sys.stdout if filename == '-' else codecs.open( filename, 'w', 'utf-8')
-					except IOError as exc:
-						f = open('downloading_error_report.txt', 'a')
-						text = 'External command error ignored: ' +str(exc) + '\n\n'
-						f.write(text)
-						f.close()
-						file_ = sys.stdout if filename == '-' else codecs.open( filename_template, 'w', 'utf-8')
-					
-					file_.writelines(unit.prettify(formatter=None))
-					file_.close()
-
-					
-					
-					soup =unit.prettify(formatter=None)
-					soup = BeautifulSoup(soup, "html.parser")
-
-
-					cur_unit = soup.find("h2",{"class": "hd hd-2 unit-title"}).getText()
-					if cur_unit == None:
-						cur_unit = 'Untitled'
-					tmp_course_strut['unit'] = (cur_unit)
-
-					logging.info('section: ' + tmp_course_strut['section'])
-					logging.info('     subsection: ' + tmp_course_strut['subsection'])
-					logging.info('                unit: ' + tmp_course_strut['unit'])
-					
-
-					metasec_ls[0].append(tmp_course_strut['section'])
-					metasec_ls[1].append(tmp_course_strut['subsection'])
-					metasec_ls[2].append(tmp_course_strut['unit'])
-					metasec_ls[3].append(filename_template)
-					
-				
-					# select only html componert (disregard video, problem)
-					html_flag = soup.findAll("div", {"data-block-type": "html"})
-					if len(html_flag) > 0:
-					
-						#create file only when html component exists
-						text=""
-						for soup_component in html_flag:					
-							for s in soup_component.findAll(['h1','h2','h3','h4','h5','h6','p','li']):
-								text+=s.getText()+" "                               		
-				
-
-						tmp_dict = {'text_block_'+str(txt_id).zfill(4):{'section': tmp_course_strut['section'] , 'subsection': tmp_course_strut['subsection'], 'unit': tmp_course_strut['unit'], 'content':text}}
-						txt_dict_ls.update(tmp_dict)
-						txt_id +=1
-						
-
-					# select only problem componert (disregard video, text)
-					prob_txt,prob_types = extract_problem_comp(soup)
-					
-					if len(prob_txt) > 0:
-						for prob_type in prob_types:
-							prob_type_set.append(prob_type+' \n')
-						
-						tmp_dict = {'quiz_block_'+str(prob_id).zfill(4):{'section': tmp_course_strut['section']  , 'subsection': tmp_course_strut['subsection'], 'unit': tmp_course_strut['unit'], 'content':prob_txt}}
-						prob_dict_ls.update(tmp_dict)
-						#print(tmp_dict)
-						prob_id +=1
-
-					tmp_video_dict = extract_video_component(args,coursename,headers,soup,tmp_course_strut['section'],tmp_course_strut['subsection'],tmp_course_strut['unit'])
-					if len(tmp_video_dict) > 0:
-						video_unit_dict = dict()
-						for vd in tmp_video_dict:
-							video_unit_dict.update({"video_block_"+str(counter_video).zfill(4):vd})
-							counter_video +=1
-
-						video_dict_ls.update(video_unit_dict)
-						video_id +=1
-
-					counter_unit += 1
-
-					set_comp_types = soup.findAll("div", {"data-block-type":True})
-					for comp_type in set_comp_types:
-						if comp_type['data-block-type'] in ['html','video','problem']:
-							comp_dict = {str(comp_id).zfill(4)+'_'+comp_type['data-block-type']:{'section': tmp_course_strut['section']  , 'subsection': tmp_course_strut['subsection'], 'unit': tmp_course_strut['unit'], 'type': comp_type['data-block-type']}}
-							comp_dict_ls.update(comp_dict)
-							comp_id+=1
-
-	txt_dict2json = json.dumps(txt_dict_ls, sort_keys=True, indent=4, separators=(',', ': '))
-	prob_dict2json = json.dumps(prob_dict_ls, sort_keys=True, indent=4, separators=(',', ': '))
-	video_dict2json = json.dumps(video_dict_ls, sort_keys=True, indent=4, separators=(',', ': '))
-	comp_dict2json = json.dumps(comp_dict_ls, sort_keys=True, indent=4, separators=(',', ': '))
-
-	with open(os.path.join(args.html_dir, coursename,'all_textcomp.json'),'w',encoding='utf-8') as f:
-		f.write(txt_dict2json)
-
-	with open(os.path.join(args.html_dir, coursename,'all_probcomp.json'),'w',encoding='utf-8') as f:
-		f.write(prob_dict2json)
-
-	with open(os.path.join(args.html_dir, coursename,'all_videocomp.json'),'w',encoding='utf-8') as f:
-		f.write(video_dict2json)
+@instrumented('extract_video_component')
+@traced('extract')
+def extract_video_component(args,coursename,headers,video_metadata,section,subsection,unit,block_cache=None):	
 	
-	with open(os.path.join(args.html_dir, coursename,'all_comp.json'),'w',encoding='utf-8') as f:
-		f.write(comp_dict2json)
+	TRACER.set_context(course=coursename, subsection=subsection, unit=unit.strip())
+	video_meta_list = []
+	for txt2dict, ident in video_metadata:
+		# the durations and transcripts of a video already extracted with
+		# the same languages are reused
+		languages = _requested_languages(args, txt2dict)
+		cached = block_cache.get(ident, 'video') if block_cache is not None else None
+		if cached is not None and cached['languages'] == languages:
+			video_meta = dict(cached['video'], section=section, subsection=subsection, unit=unit)
+		else:
+			video_meta = extract_video(args,coursename,headers,txt2dict,section,subsection,unit)
+			# videos whose duration or transcripts could not be downloaded
+			# are extracted again next time
+			complete = video_meta['video_duration'] != 'n/a' and not any(
+				isinstance(value, dict) for key, value in video_meta.items() if key.startswith('transcript_'))
+			if block_cache is not None and complete:
+				block_cache.put(ident, 'video', {'languages': languages,
+												 'video': {key: value for key, value in video_meta.items()
+														   if key not in _VIDEO_PLACE}})
+		video_meta_list.append(video_meta)
+	return video_meta_list
 
-	metafile_dict = {'section':metasec_ls[0],'subsection':metasec_ls[1],'unit':metasec_ls[2],'htmlfile':metasec_ls[3]}
-	df = pd.DataFrame.from_dict(metafile_dict)
-	df.to_csv(os.path.join(args.html_dir, coursename,'source_html_file','metadata.csv'))
-	
 
 
-	save_urls_to_file(prob_type_set,  os.path.join(args.html_dir, coursename,  "all_prob_type.txt"))
-	make_tarfile(os.path.join(args.html_dir, coursename,'sourcefile.tar.gz'),os.path.join(args.html_dir, coursename,'source_html_file'))
 
+def extract_unit_record(args, unit, block_cache=None):
+	"""
+	Extracts the records of a unit (an element of the subsection page): its
+	html, title, text, problems, component types and the metadata of its
+	videos, see lib.extraction.extract_unit.
+	"""
+	return extract_unit(unit.prettify(formatter=None), args.components, args.text_structure, block_cache)
 
 
-def make_tarfile(zip_path,sourcedir):
+def crawl_subsection(args, coursename, headers, file_formats, subsection_name, url, block_cache=None, page=None):
+	"""
+	Fetches the page of a subsection once (unless it is given, e.g. by a
+	watch poll), extracts the resources of its units (for the repeated urls
+	report) and the records of every unit.
+	Returns (resources units, unit records).
+	"""
+	TRACER.set_context(course=coursename, subsection=subsection_name, unit=None)
+	print(url)
+	with MEMORY.hold() as held:
+		# the page and its parse tree are held until all its units are
+		# processed
+		with PROFILER.stage('extraction'):
+			if page is None:
+				# the fetch waits for the estimated size of the page to fit
+				# in the in-flight budget
+				held.reserve()
+				page = get_page_contents(url, headers)
+			held.add(len(page))
+
+		with PROFILER.stage('unit_discovery'):
+			page_extractor = get_page_extractor(url)
+			with METRICS.timed('extract_units'), TRACER.span('extract_units', 'parse'):
+				resources = page_extractor.extract_units_from_html(page, BASE_URL, file_formats)
+
+		with PROFILER.stage('extraction'):
+			with METRICS.timed('parse_subsection'), TRACER.span('parse_subsection', 'parse'):
+				subsection_soup = BeautifulSoup(page, "html.parser")
+			page = None
+
+			#div contains all units (seq_contents_#)
+			main_content=subsection_soup.find("div", {"class": "container"})
+			records = [extract_unit_record(args, unit, block_cache) for unit in crawl_units(main_content)]
+
+			main_content = None
+			subsection_soup.decompose()
+	return resources, records
+
+
+class CourseOutput(object):
+	"""
+	Writes the units of a course, in order, into its archive (or the blob
+	store), its json outputs and the optional search index, SQL store and
+	Parquet datasets.
+	"""
 
-	print ("source file is being compressed as tar.gz ")
-	with tarfile.open(zip_path, 'w:gz') as tar:
-		for f in os.listdir(sourcedir):
-			tar.add(sourcedir + "/" + f, arcname=os.path.basename(f))
-		tar.close()
-	shutil.rmtree(sourcedir)
-	
+	def __init__(self, args, course, blob_store=None, search_index=None, sql_store=None, parquet=None,
+				 subsections=None):
+		self.args = args
+		self.coursename = directory_name(course.name)
+		self.course_dir = os.path.join(args.html_dir, self.coursename)
+		mkdir_p(self.course_dir)
+		self.blob_store = blob_store
+		self.search_index = search_index
+		self.sql_store = sql_store
+		self.parquet = parquet
+
+		self.prob_type_set = []
+		self.counter_video = 1
+		self.counter_unit = 1
+		self.txt_id = 1
+		self.prob_id = 1
+		self.comp_id = 1
+		self.txt_dict_ls = dict()
+		self.prob_dict_ls = dict()
+		self.comp_dict_ls = dict()
+		self.video_dict_ls = dict()
+		self.metasec_ls = [[],[],[],[],[]]
+
+		# a crawl of some subsections ((section dirname, SubSection) pairs)
+		# only replaces their rows, found by their names or by their urls in
+		# the SQL store
+		replaced = None
+		if subsections is not None:
+			replaced = [(section, subsection.name if subsection.name is not None else 'Untitled')
+						for section, subsection in subsections]
+		if search_index is not None:
+			search_index.begin_course(self.coursename, replaced)
+		if sql_store is not None:
+			self.course_id = sql_store.begin_course(self.coursename, course.url, None if subsections is None else
+													[subsection.url for _, subsection in subsections])
+		if parquet is not None:
+			parquet.begin_course(self.coursename, replaced)
+		# units are streamed into the archive as they are produced, or
+		# referenced from the blob store when one is used
+		self.archive = None
+		if blob_store is None:
+			self.archive = UnitArchiveWriter(os.path.join(self.course_dir, archive_filename('sourcefile', args.archive_format)),
+											 args.archive_format)
+
+	def add_unit(self, section, subsection, record, video_meta_list, outline):
+		"""
+		Writes a unit record (see extract_unit_record) and its videos (see
+		extract_video_component). outline is the place of its subsection in
+		the outline of the course: (section position, subsection position,
+		subsection url).
+		"""
+		coursename = self.coursename
+		unit_name = record['unit']
+		TRACER.set_context(course=coursename, subsection=subsection, unit=unit_name.strip())
+		filename_template = str(self.counter_unit).zfill(4) +".html"
+		self.counter_unit += 1
+
+		blob = ''
+		try:
+			with METRICS.timed('write_archive'), PROFILER.stage('archiving'), TRACER.span('write_archive', 'write', file=filename_template):
+				if self.blob_store is not None:
+					blob = self.blob_store.put(record['html'])
+				else:
+					self.archive.add(filename_template, record['html'])
+		except IOError as exc:
+			ERRORS.report('download', str(exc), course=coursename,
+						  report='downloading_error_report.txt',
+						  details=[('file', filename_template)])
+
+		logging.info('section: ' + section)
+		logging.info('     subsection: ' + subsection)
+		logging.info('                unit: ' + unit_name)
+
+		self.metasec_ls[0].append(section)
+		self.metasec_ls[1].append(subsection)
+		self.metasec_ls[2].append(unit_name)
+		self.metasec_ls[3].append(filename_template)
+		self.metasec_ls[4].append(blob)
+
+		text = record['text']
+		if text is not None:
+			key = 'text_block_'+str(self.txt_id).zfill(4)
+			self.txt_dict_ls[key] = {'section': section, 'subsection': subsection, 'unit': unit_name, 'content':text}
+			if self.args.text_structure:
+				self.txt_dict_ls[key]['structure'] = record['text_structure']
+			if self.search_index is not None:
+				self.search_index.add('text', coursename, section, subsection, unit_name.strip(), text, block_id=key)
+			self.txt_id +=1
+
+		prob_txt = record['problem']
+		if len(prob_txt) > 0:
+			for prob_type in record['problem_types']:
+				self.prob_type_set.append(prob_type+' \n')
+			key = 'quiz_block_'+str(self.prob_id).zfill(4)
+			self.prob_dict_ls[key] = {'section': section, 'subsection': subsection, 'unit': unit_name, 'content':prob_txt}
+			if self.args.text_structure:
+				self.prob_dict_ls[key]['structure'] = record['problem_structure']
+			if self.search_index is not None:
+				self.search_index.add('quiz', coursename, section, subsection, unit_name.strip(), prob_txt, block_id=key)
+			self.prob_id +=1
+
+		for vd in video_meta_list:
+			key = "video_block_"+str(self.counter_video).zfill(4)
+			self.video_dict_ls[key] = vd
+			if self.parquet is not None:
+				self.parquet.add_video(coursename, key, vd)
+			if self.search_index is not None:
+				for transcript_key, value in vd.items():
+					if transcript_key.startswith('transcript_') and isinstance(value, list):
+						self.search_index.add('transcript', coursename, section, subsection, unit_name.strip(),
+											  ' '.join(value), block_id=key, language=transcript_key[len('transcript_'):])
+			self.counter_video +=1
+
+		for comp_type in record['components']:
+			key = str(self.comp_id).zfill(4)+'_'+comp_type
+			self.comp_dict_ls[key] = {'section': section, 'subsection': subsection, 'unit': unit_name, 'type': comp_type}
+			if self.parquet is not None:
+				self.parquet.add_component(coursename, section, subsection, unit_name, key, comp_type)
+			self.comp_id+=1
+
+		if self.sql_store is not None:
+			self.sql_store.add_unit(self.course_id, section, subsection, unit_name, outline,
+									htmlfile=filename_template, blob=blob or None, text=text,
+									problem=prob_txt if len(prob_txt) > 0 else None,
+									problem_types=record['problem_types'] if len(prob_txt) > 0 else (),
+									videos=video_meta_list, components=record['components'])
+
+	def close(self):
+		"""
+		Writes the metadata and the json outputs of the course.
+		"""
+		if self.search_index is not None:
+			self.search_index.flush(self.coursename)
+		if self.sql_store is not None:
+			self.sql_store.flush()
+		if self.parquet is not None:
+			self.parquet.end_course(self.coursename)
+
+		metasec_ls = self.metasec_ls
+		metafile_dict = {'section':metasec_ls[0],'subsection':metasec_ls[1],'unit':metasec_ls[2],'htmlfile':metasec_ls[3]}
+		if self.blob_store is not None:
+			metafile_dict['blob'] = metasec_ls[4]
+			df = pd.DataFrame.from_dict(metafile_dict)
+			df.to_csv(os.path.join(self.course_dir, 'metadata.csv'))
+		else:
+			df = pd.DataFrame.from_dict(metafile_dict)
+			with METRICS.timed('write_archive'), PROFILER.stage('archiving', snapshot=True), TRACER.span('write_archive', 'write', file='metadata.csv'):
+				self.archive.add('metadata.csv', df.to_csv())
+				print ("source file is being compressed as " + os.path.basename(self.archive.path))
+				self.archive.close()
+
+		with METRICS.timed('write_output'), PROFILER.stage('output', snapshot=True), TRACER.span('write_output', 'write'):
+			# the records are streamed into the files, optionally compressed
+			# and compact
+			args = self.args
+			write_json(self.txt_dict_ls, os.path.join(self.course_dir,'all_textcomp.json'),
+					   args.json_compression, args.compact_json)
+			write_json(self.prob_dict_ls, os.path.join(self.course_dir,'all_probcomp.json'),
+					   args.json_compression, args.compact_json)
+			write_json(self.video_dict_ls, os.path.join(self.course_dir,'all_videocomp.json'),
+					   args.json_compression, args.compact_json)
+			write_json(self.comp_dict_ls, os.path.join(self.course_dir,'all_comp.json'),
+					   args.json_compression, args.compact_json)
+
+			save_urls_to_file(self.prob_type_set, os.path.join(self.course_dir, "all_prob_type.txt"))
+		logging.info('Course %s is done.', self.coursename)
+
+	def summary(self):
+		return {'course': self.coursename, 'directory': self.course_dir,
+				'units': self.counter_unit - 1, 'text_blocks': self.txt_id - 1,
+				'quiz_blocks': self.prob_id - 1, 'videos': self.counter_video - 1,
+				'components': self.comp_id - 1}
+
+
+def _video_host(video_metadata):
+	"""
+	Returns the host the video task mostly works with: YouTube for the
+	durations and fallback transcripts of YouTube videos, edX otherwise.
+	"""
+	if any(len(metadata['streams']) > 0 for metadata, _ in video_metadata):
+		return 'www.youtube.com'
+	return urlparse(BASE_URL).netloc
 
 
+def crawl_unit_videos(args, coursename, headers, video_metadata, section, subsection, unit, block_cache=None):
+	"""
+	Task extracting the videos of a unit, see extract_video_component.
+	"""
+	with PROFILER.stage('video'):
+		return extract_video_component(args, coursename, headers, video_metadata, section, subsection, unit,
+									   block_cache)
 
-def main():
 
-	start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-	args = parse_args()
-	file_formats = parse_file_formats(args)
+def _result(task):
+	return task.result() if isinstance(task, Future) else task
 
-	# Query password, if not alredy passed by command line.
-	if not args.password:
-		args.password = getpass.getpass(stream=sys.stderr)
 
-	if not args.username or not args.password:
-		logging.error("You must supply username and password to log-in")
-		exit(ExitCode.MISSING_CREDENTIALS)
+def crawl_courses(args, selections, headers, file_formats, scheduler, summaries=None, pages=None, delta=False):
+	"""
+	Crawls the units of the selected courses, interleaving the subsection
+	and video tasks of all the courses in the scheduler. Small courses get
+	the highest priority. The units of every course are written in order as
+	soon as they and the units before them are done, and the outputs of a
+	course as soon as all its units are.
+
+	Returns the resources of the units of every subsection: {url: units}.
+	The summaries of the courses are appended to summaries. The subsection
+	pages already fetched are given in pages: {url: page}. A delta crawl
+	(of the changed subsections of a watch poll) replaces only the rows of
+	its subsections in the search index, SQL store and Parquet datasets.
+	"""
+	blob_store = BlobStore(args.blob_store) if args.blob_store else None
+	search_index = SearchIndex(args.search_index) if args.search_index else None
+	sql_store = SqlStore(args.sql_store) if args.sql_store else None
+	parquet = ParquetExporter(args.parquet_dir) if args.parquet_dir else None
+	block_cache = BlockCache(args.block_cache) if args.block_cache else None
+	host = urlparse(BASE_URL).netloc
+
+	# for every course, its output and its subsections in order as
+	# [section, subsection, url, subsection task, video tasks, place in the
+	# outline]
+	courses = []
+	for selected_course, selected_sections in selections.items():
+		subsections = [(selected_section, subsection)
+					   for selected_section in selected_sections
+					   for subsection in selected_section.subsections]
+		replaced = None
+		if delta:
+			replaced = [("%02d-%s" % (selected_section.position, selected_section.name), subsection)
+						for selected_section, subsection in subsections]
+		output = CourseOutput(args, selected_course, blob_store, search_index, sql_store, parquet, replaced)
+		priority = len(subsections)
+		slots = deque()
+		for selected_section, subsection in subsections:
+			if subsection.name == None:
+				subsection.name = 'Untitled'
+			task = scheduler.submit(crawl_subsection, args, output.coursename, headers, file_formats,
+									subsection.name, subsection.url, block_cache,
+									pages.pop(subsection.url, None) if pages else None,
+									priority=priority, host=host, course=output.coursename)
+			slots.append(["%02d-%s" % (selected_section.position, selected_section.name), subsection.name,
+						  subsection.url, task, None, (selected_section.position, subsection.position, subsection.url)])
+		courses.append((output, slots, priority))
+
+	all_units = {}
+	try:
+		while courses:
+			waiting = []
+			for output, slots, priority in courses:
+				for slot in slots:
+					section_dirname, subsection_name, url, task, video_tasks, _ = slot
+					if video_tasks is not None:
+						waiting.extend(video_task for video_task in video_tasks
+									   if isinstance(video_task, Future) and not video_task.done())
+					elif not task.done():
+						waiting.append(task)
+					else:
+						resources, records = task.result()
+						all_units[url] = resources
+						slot[4] = [scheduler.submit(crawl_unit_videos, args, output.coursename, headers,
+													record['videos'], section_dirname, subsection_name, record['unit'], block_cache,
+													priority=priority, host=_video_host(record['videos']),
+													course=output.coursename)
+								   if record['videos'] else [] for record in records]
+						waiting.extend(video_task for video_task in slot[4] if isinstance(video_task, Future))
+
+				# write the units done in order
+				while slots and slots[0][4] is not None and all(
+						not isinstance(video_task, Future) or video_task.done() for video_task in slots[0][4]):
+					section_dirname, subsection_name, _, task, video_tasks, outline = slots.popleft()
+					for record, video_task in zip(task.result()[1], video_tasks):
+						output.add_unit(section_dirname, subsection_name, record, _result(video_task), outline)
+
+			for course in [course for course in courses if not course[1]]:
+				course[0].close()
+				if summaries is not None:
+					summaries.append(course[0].summary())
+				courses.remove(course)
+
+			if waiting:
+				wait_futures(waiting, return_when=FIRST_COMPLETED)
+	except BaseException:
+		# a failed crawl (e.g. a daemon job) does not leave its tasks queued
+		for _, slots, _ in courses:
+			for slot in slots:
+				for task in [slot[3]] + list(slot[4] or []):
+					if isinstance(task, Future):
+						task.cancel()
+		raise
+
+	if search_index is not None:
+		search_index.close()
+	if sql_store is not None:
+		sql_store.close()
+	if parquet is not None:
+		parquet.close()
+	if block_cache is not None:
+		block_cache.close()
+	return all_units
 
-	# Prepare Headers
-	headers = edx_get_headers()
 
-	# Login
-	resp = edx_login(LOGIN_API, headers, args.username, args.password)
-	if not resp.get('success', False):
-		logging.error(resp.get('value', "Wrong Email or Password."))
-		exit(ExitCode.WRONG_EMAIL_OR_PASSWORD)
+def _available_courses(headers):
+	"""
+	Returns the started courses of the dashboard.
+	"""
+	with PROFILER.stage('dashboard', snapshot=True):
+		courses = get_courses_info(DASHBOARD, headers)
+	return [course for course in courses if course.state == 'Started']
 
-	# Parse and select the available courses
-	courses = get_courses_info(DASHBOARD, headers)
-	available_courses = [course for course in courses if course.state == 'Started']
+
+def crawl(args, headers, file_formats, available_courses, scheduler):
+	"""
+	Crawls the courses of args.course_urls (or writes the plan of the crawl
+	with --plan), running their tasks in scheduler. Returns the summary of
+	the crawl.
+	"""
 	selected_courses = parse_courses(args, available_courses)
 
 	# Parse the sections and build the selections dict filtered by sections
-	if args.platform == 'edx':
-		all_selections = {selected_course:
-						  get_available_sections(selected_course.url.replace('info', 'course'), headers)
-						  for selected_course in selected_courses}
-	else:
-		all_selections = {selected_course:
-						  get_available_sections(selected_course.url.replace('info', 'courseware'), headers)
-						  for selected_course in selected_courses}
+	with PROFILER.stage('outline', snapshot=True):
+		page = 'course' if args.platform == 'edx' else 'courseware'
+		outlines = {selected_course:
+					scheduler.submit(get_available_sections, selected_course.url.replace('info', page), headers,
+									 host=urlparse(BASE_URL).netloc, course=selected_course.name)
+					for selected_course in selected_courses}
+		all_selections = {selected_course: outline.result()
+						  for selected_course, outline in outlines.items()}
 
 	selections = parse_sections(args, all_selections)
 	_display_selections(selections)
 
-	# Extract the unit information (downloadable resources)
-	# This parses the HTML of all the subsection.url and extracts
-	# the URLs of the resources as Units.
-	all_urls = [subsection.url
-				for selected_sections in selections.values()
-				for selected_section in selected_sections
-				for subsection in selected_section.subsections]
-
-	extractor = extract_all_units_in_parallel
-	if args.sequential:
-		extractor = extract_all_units_in_sequence
-
-	all_units = extractor(all_urls, headers, file_formats)
+	if args.plan:
+		# dry run: size the crawl from the outlines and the history
+		history_paths = args.plan_history or ([args.metrics_dir] if args.metrics_dir else [])
+		plan = build_plan(selections, args.html_dir, History.load(history_paths),
+						  workers=1 if args.sequential else args.workers,
+						  per_course=args.per_course_limit)
+		write_plan(plan, args.plan)
+		logging.info('Crawl plan written to %s', args.plan)
+		return {'plan': args.plan}
 
 	parse_units(selections)
 
-	# This removes all repeated important urls
-	# FIXME: This is not the best way to do it but it is the simplest, a
-	# better approach will be to create symbolic or hard links for the repeated
-	# units to avoid losing information
-	filtered_units = remove_repeated_urls(all_units)
+	# Crawl the units of all the subsections: saves the html content as
+	# course units and extracts the unit information (downloadable
+	# resources) as Units
+	summaries = []
+	all_units = crawl_courses(args, selections, headers, file_formats, scheduler, summaries)
+
+	# This removes all repeated important urls. The units sharing them are
+	# reported in shared_urls.json, so that repeated resources can be linked
+	# instead of losing information
+	if args.url_index:
+		url_index = UrlIndex.load(args.url_index, bloom_capacity=args.url_index_bloom)
+	else:
+		url_index = UrlIndex(bloom_capacity=args.url_index_bloom)
+	filtered_units = remove_repeated_urls(all_units, url_index)
 	num_all_urls = num_urls_in_units_dict(all_units)
 	num_filtered_urls = num_urls_in_units_dict(filtered_units)
 	logging.warning('Removed %d duplicated urls from %d in total',
 				 (num_all_urls - num_filtered_urls), num_all_urls)
+	shared_urls = url_index.shared()
+	if shared_urls:
+		mkdir_p(args.html_dir)
+		with open(os.path.join(args.html_dir, 'shared_urls.json'), 'w', encoding='utf-8') as f:
+			json.dump(shared_urls, f, indent=4, sort_keys=True)
+		logging.info('%d urls are shared between units, see shared_urls.json', len(shared_urls))
+	if args.url_index:
+		url_index.save(args.url_index)
+
+	summary = {'courses': summaries, 'urls': num_all_urls,
+			   'duplicated_urls': num_all_urls - num_filtered_urls}
+	if args.download_dir and WARC.replaying:
+		logging.warning('The resources are not downloaded in a replay')
+	elif args.download_dir:
+		# every url is downloaded once, the units repeating it get links
+		targets = download_targets(args, selections, all_units)
+		logging.info('Downloading %d files into %s', len(targets), args.download_dir)
+		with PROFILER.stage('download', snapshot=True):
+			downloader = Downloader(args.download_dir, headers, urlparse(BASE_URL).netloc,
+									workers=args.download_workers,
+									segment_size=max(int(args.download_segment_size * 2 ** 20), 1))
+			summary['downloads'] = downloader.download(targets)
+		logging.info('Downloads: %(downloaded)d files downloaded, %(cached)d already stored, %(failed)d failed',
+					 summary['downloads'])
+	# the error summaries of the crawl, also for a daemon job
+	ERRORS.flush([course['directory'] for course in summaries] + ([args.download_dir] if args.download_dir else []))
+	return summary
+
+
+def fingerprint_subsection(page, components):
+	"""
+	Returns the fingerprints of the units of a subsection page: their
+	titles and their blocks of the components types (see lib.watch).
+	"""
+	with METRICS.timed('fingerprint_subsection'), TRACER.span('fingerprint_subsection', 'parse'):
+		subsection_soup = BeautifulSoup(page, "html.parser")
+		units = []
+		for unit in crawl_units(subsection_soup.find("div", {"class": "container"})):
+			soup = BeautifulSoup(unit.prettify(formatter=None), "html.parser")
+			title = soup.find("h2",{"class": "hd hd-2 unit-title"}).getText()
+			blocks = [block for block in soup.findAll("div", {"data-block-type": True})
+					  if block['data-block-type'] in components]
+			units.append(unit_fingerprint(title.strip(), blocks))
+			soup.decompose()
+		subsection_soup.decompose()
+	return units
+
+
+class CourseWatcher(object):
+	"""
+	Watch mode: polls the dashboard, the outlines and the subsection pages
+	of the watched courses with conditional requests, and crawls only the
+	subsections whose fingerprint changed since the previous poll (see
+	lib.watch). The first poll of a course crawls it into args.html_dir, the
+	next ones crawl its changed subsections into
+	args.html_dir/changes/<time of the poll>. The base copy in
+	args.html_dir is never rewritten, the consumers of the files merge the
+	change directories into it (see the README); the search index, SQL
+	store and Parquet datasets are updated in place.
+	"""
+
+	def __init__(self, args, headers, file_formats, scheduler):
+		self.args = args
+		self.headers = headers
+		self.file_formats = file_formats
+		self.scheduler = scheduler
+		self.state = WatchState(args.watch_state or os.path.join(args.html_dir, STATE_FILENAME))
+		self.changelog = ChangeLog(os.path.join(args.html_dir, CHANGES_FILENAME))
+		# validators (ETag, Last-Modified) and hash of the last page of
+		# every url, the pages themselves are not kept
+		self._validators = {}
+		self._digests = {}
+		self._courses = []
+		self._outlines = {}
+
+	def _fetch(self, url):
+		"""
+		Returns the page at url, None when it did not change since the
+		previous poll.
+		"""
+		page = get_page_contents_if_modified(url, self.headers, self._validators.setdefault(url, {}))
+		if page is None:
+			return None
+		# most courseware pages have no validators, an unchanged page is
+		# not parsed again either
+		digest = hashlib.sha256(page.encode('utf-8')).hexdigest()
+		if self._digests.get(url) == digest:
+			return None
+		self._digests[url] = digest
+		return page
+
+	def _watched_courses(self):
+		with PROFILER.stage('dashboard', snapshot=True):
+			page = self._fetch(DASHBOARD)
+			if page is not None:
+				courses = get_courses_info(DASHBOARD, self.headers, page)
+				self._courses = [course for course in courses if course.state == 'Started']
+		courses = [course for course in self._courses if course.url in self.args.course_urls]
+		missing = set(self.args.course_urls) - set(course.url for course in courses)
+		if missing:
+			logging.warning('Not watching the courses not started or not enrolled: %s', ', '.join(sorted(missing)))
+		return courses
+
+	def poll(self):
+		"""
+		Polls the watched courses once, crawls their changed subsections and
+		logs their changes. Returns the summaries of the crawled courses.
+		"""
+		args = self.args
+		METRICS.inc('watch_polls_total')
+		host = urlparse(BASE_URL).netloc
+		outline_page = 'course' if args.platform == 'edx' else 'courseware'
+
+		with PROFILER.stage('outline', snapshot=True):
+			outlines = [(course, course.url.replace('info', outline_page),
+						 self.scheduler.submit(self._fetch, course.url.replace('info', outline_page),
+											   host=host, course=course.name))
+						for course in self._watched_courses()]
+			for course, url, outline in outlines:
+				page = outline.result()
+				if page is not None:
+					self._outlines[course.url] = get_available_sections(url, self.headers, page)
+
+		# the subsection pages of all the courses are fetched at once
+		polled = []
+		for course, _, _ in outlines:
+			sections = _filter_sections(args.filter_section, self._outlines[course.url])
+			subsections = [(section, subsection) for section in sections for subsection in section.subsections]
+			polled.append((course, [(section, subsection,
+									 self.scheduler.submit(self._fetch, subsection.url, priority=len(subsections),
+														   host=host, course=course.name))
+									for section, subsection in subsections]))
+
+		# {output directory: selections} of the changed subsections, a
+		# course crawled for the first time is written into html_dir
+		stamp = time.strftime('%Y%m%dT%H%M%S')
+		targets = {args.html_dir: {}, os.path.join(args.html_dir, 'changes', stamp): {}}
+		pages = {}
+		polls = []
+		for course, tasks in polled:
+			coursename = directory_name(course.name)
+			previous = self.state.subsections(coursename)
+			current = {}
+			changed_sections = []
+			for section, subsection, task in tasks:
+				section_dirname = "%02d-%s" % (section.position, section.name)
+				name = subsection.name if subsection.name is not None else 'Untitled'
+				page = task.result()
+				entry = previous.get(subsection.url)
+				if page is None and entry is not None and (entry['section'], entry['subsection']) == (section_dirname, name):
+					current[subsection.url] = entry
+					continue
+				if page is None:
+					# renamed or moved since the previous poll
+					page = get_page_contents(subsection.url, self.headers)
+				current[subsection.url] = subsection_entry(section_dirname, name,
+														   fingerprint_subsection(page, args.components))
+				if entry is None or entry['fingerprint'] != current[subsection.url]['fingerprint']:
+					pages[subsection.url] = page
+					if not changed_sections or changed_sections[-1].position != section.position:
+						changed_sections.append(Section(section.position, section.name, section.url, []))
+					changed_sections[-1].subsections.append(subsection)
+				page = None
+
+			output = args.html_dir if coursename not in self.state else os.path.join(args.html_dir, 'changes', stamp)
+			if changed_sections:
+				targets[output][course] = changed_sections
+			polls.append((coursename, current, diff_blocks(previous, current), output if changed_sections else None))
+
+		summaries = []
+		for html_dir, selections in targets.items():
+			if selections:
+				_display_selections(selections)
+				target_args = copy.copy(args)
+				target_args.html_dir = html_dir
+				# the courses already crawled only get their changed
+				# subsections replaced in the search index and the stores
+				crawl_courses(target_args, selections, self.headers, self.file_formats, self.scheduler,
+							  summaries, pages, delta=html_dir != args.html_dir)
+
+		# the subsections moved or removed without any changed page are
+		# updated in the SQL store too
+		if args.sql_store:
+			sql_store = SqlStore(args.sql_store)
+			for course, tasks in polled:
+				sql_store.update_outline(directory_name(course.name), [
+					("%02d-%s" % (section.position, section.name), section.position,
+					 subsection.name if subsection.name is not None else 'Untitled', subsection.position, subsection.url)
+					for section, subsection, _ in tasks])
+			sql_store.close()
+
+		ERRORS.flush([summary['directory'] for summary in summaries])
+
+		# the changes are logged once crawled
+		for coursename, current, changes, output in polls:
+			self.changelog.append(coursename, changes, output)
+			self.state.update(coursename, current)
+			logging.info('%s: %d changed components, %d crawled units', coursename, len(changes),
+						 sum(summary['units'] for summary in summaries if summary['course'] == coursename))
+		self.state.save()
+		return summaries
+
+	def run(self):
+		"""
+		Polls every args.watch seconds until interrupted.
+		"""
+		while True:
+			start = time.time()
+			try:
+				self.poll()
+			except Exception as exception:
+				METRICS.error('watch', exception)
+				logging.error('Watch poll failed: %s', exception)
+				# the next poll fetches and fingerprints every page again
+				self._validators.clear()
+				self._digests.clear()
+			time.sleep(max(0.0, self.args.watch - (time.time() - start)))
+
+
+def watch_courses(args, headers, file_formats, scheduler):
+	"""
+	Watch mode: crawls the changes of the courses of args.course_urls
+	every args.watch seconds, until it is interrupted or terminated.
+	"""
+	if len(args.course_urls) == 0:
+		logging.error('You must pass the URL of at least one course, check the correct url with --list-courses')
+		exit(ExitCode.MISSING_COURSE_URL)
+	watcher = CourseWatcher(args, headers, file_formats, scheduler)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(ExitCode.OK))
+	logging.info('Watching %d course(s) every %s seconds', len(args.course_urls), args.watch)
+	watcher.run()
+
+
+# options of the daemon process, which the jobs cannot change
+DAEMON_OPTIONS = ('course_urls', 'username', 'password', 'platform', 'daemon', 'daemon_jobs',
+				  'watch', 'watch_state', 'transport', 'record', 'replay', 'workers', 'per_host_limit', 'per_course_limit', 'sequential',
+				  'session_store', 'memory_budget', 'max_inflight_bytes', 'profile',
+				  'profile_interval', 'profile_cpu', 'profile_memory', 'trace', 'metrics_dir', 'list_file_formats',
+				  'quiet', 'debug')
+
+
+def job_args(base_argv, spec):
+	"""
+	Returns the arguments of a daemon job: the command line of the daemon
+	with the course urls and the options (dest: value) of the job spec.
+	Raises ValueError for invalid options.
+	"""
+	argv = list(base_argv)
+	for dest, value in sorted(spec.get('options', {}).items()):
+		if dest in DAEMON_OPTIONS:
+			raise ValueError('%s is an option of the daemon' % dest)
+		flag = '--' + dest.replace('_', '-')
+		if value is True:
+			argv.append(flag)
+		elif value is False or value is None:
+			continue
+		elif isinstance(value, list):
+			for item in value:
+				argv.extend([flag, str(item)])
+		else:
+			argv.extend([flag, str(value)])
+	argv.append('--course-urls')
+	argv.extend(spec['course_urls'])
+	try:
+		return parse_args(argv)
+	except SystemExit:
+		raise ValueError('invalid options %s' % json.dumps(spec.get('options', {}), sort_keys=True))
+
+
+# outputs of a crawl keyed by course (see job_outputs), and written whole
+COURSE_OUTPUTS = ('html_dir', 'blob_store', 'sql_store', 'parquet_dir')
+SHARED_OUTPUTS = ('download_dir', 'url_index', 'search_index')
+
+
+def job_outputs(args):
+	"""
+	Returns the outputs written by the crawl of args, so that the daemon
+	does not run two jobs writing the same course (or the same shared file)
+	at the same time.
+	"""
+	outputs = set()
+	for dest in COURSE_OUTPUTS:
+		if getattr(args, dest):
+			path = os.path.abspath(getattr(args, dest))
+			outputs.update((dest, path, url) for url in args.course_urls)
+	for dest in SHARED_OUTPUTS:
+		if getattr(args, dest):
+			outputs.add((dest, os.path.abspath(getattr(args, dest))))
+	# every crawl rewrites the shared urls report of html_dir
+	outputs.add(('shared_urls', os.path.abspath(args.html_dir)))
+	return outputs
+
+
+def serve_jobs(args, headers, available_courses, scheduler):
+	"""
+	Daemon mode: runs the crawl jobs submitted to the job API on
+	args.daemon with the session, caches and scheduler of the process,
+	until it is interrupted or terminated.
+	"""
+	base_argv = sys.argv[1:]
+	dashboard = {'courses': available_courses}
+	dashboard_lock = threading.Lock()
+
+	def run(job):
+		args = job.prepared
+		with dashboard_lock:
+			known = set(course.url for course in dashboard['courses'])
+			if not set(args.course_urls) <= known:
+				# the account may have enrolled since the last jobs
+				dashboard['courses'] = _available_courses(headers)
+			courses = dashboard['courses']
+		return crawl(args, headers, parse_file_formats(args), courses, scheduler)
+
+	queue = JobQueue(run, workers=args.daemon_jobs, prepare=partial(job_args, base_argv), outputs=job_outputs)
+	server = serve(args.daemon, queue)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(ExitCode.OK))
+	logging.info('Job API listening on %s', args.daemon)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		queue.shutdown(wait=False)
+
 
-	#saving html content as course unit
-	save_html_to_file(args, selections, all_urls, headers)
+# arguments of the run, kept by main for the exit handler
+MAIN_ARGS = None
+
+
+def main():
+	global MAIN_ARGS
+
+	start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+	args = MAIN_ARGS = parse_args()
+	file_formats = parse_file_formats(args)
+
+	# Query password, if not alredy passed by command line. Replays do not
+	# log in
+	if not args.password and not args.replay:
+		args.password = getpass.getpass(stream=sys.stderr)
+
+	if (not args.username or not args.password) and not args.replay:
+		logging.error("You must supply username and password to log-in")
+		exit(ExitCode.MISSING_CREDENTIALS)
+
+	if args.profile:
+		PROFILER.start(args.profile, interval=args.profile_interval / 1000.0, cpu=args.profile_cpu,
+					   memory_frames=args.profile_memory)
+	if args.trace:
+		TRACER.start(args.trace)
+	MEMORY.configure(rss_limit=args.memory_budget,
+					 max_inflight_bytes=args.max_inflight_bytes)
+
+	session = None
+	if args.replay:
+		# the recorded exchanges and tool results are served from the WARC
+		# files, without network nor session
+		WARC.replay(args.replay)
+		set_transport(WARC.transport())
+		headers = {}
+	else:
+		if args.record:
+			WARC.record(args.record)
+		# Prepare Headers and Login, unless the stored session is still valid.
+		# The session logs in again when it expires during the crawl
+		session = SessionManager(partial(edx_authenticate, args.username, args.password),
+								 args.username, args.password, urlparse(BASE_URL).netloc,
+								 store_path=args.session_store)
+		with PROFILER.stage('login', snapshot=True):
+			try:
+				headers = session.open()
+			except LoginError as exception:
+				logging.error(str(exception))
+				exit(ExitCode.WRONG_EMAIL_OR_PASSWORD)
+		set_session(session)
+		# the transport shares the cookies of the session
+		transport = make_transport(args.transport, session.cookiejar, args.per_host_limit or args.workers)
+		set_transport(WARC.transport(transport))
+
+	# Parse and select the available courses
+	available_courses = _available_courses(headers)
+
+	# The outline, subsection and video tasks of all the courses (and of
+	# all the jobs of the daemon) share the workers of the scheduler
+	scheduler = Scheduler(workers=1 if args.sequential else args.workers,
+						  per_host=args.per_host_limit,
+						  per_course=args.per_course_limit)
+	completed = False
+	try:
+		if args.daemon:
+			serve_jobs(args, headers, available_courses, scheduler)
+		elif args.watch:
+			watch_courses(args, headers, file_formats, scheduler)
+		else:
+			crawl(args, headers, file_formats, available_courses, scheduler)
+		completed = True
+	finally:
+		scheduler.shutdown(cancel=not completed)
+
+	# keep the cookies refreshed by the site for the next runs
+	if session is not None:
+		session.save()
 		
 	
 if __name__ == '__main__':
@@ -991,3 +2002,12 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		logging.warning("\n\nCTRL-C detected, shutting down....")
 		sys.exit(ExitCode.OK)
+	finally:
+		# written on every exit, so that the scheduler also sees failed runs
+		# but not by --plan, which reads them
+		if MAIN_ARGS is not None and MAIN_ARGS.metrics_dir and not MAIN_ARGS.plan:
+			METRICS.write(MAIN_ARGS.metrics_dir)
+		ERRORS.close()
+		WARC.close()
+		PROFILER.stop()
+		TRACER.stop()
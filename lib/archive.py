@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming, randomly accessible archives for the unit HTML files.
+
+Units are written straight into the course archive as soon as they are
+produced, instead of being written to ``source_html_file/NNNN.html`` and
+tarred afterwards.
+
+Every tar member (header, data and padding) is compressed as an independent
+gzip member or zstd frame.  Concatenated gzip members and zstd frames are
+still valid single streams, so the result can be read by ``tar xzf`` or
+``tar --zstd -xf`` like any other archive.  Because every member starts on
+a compression boundary, an index sidecar (``<archive>.idx``) recording the
+compressed offset and length of each member lets a single unit be read back
+without decompressing the whole archive.
+"""
+
+import gzip
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+
+ARCHIVE_FORMATS = {
+    'gz': '.tar.gz',
+    'zst': '.tar.zst',
+}
+INDEX_SUFFIX = '.idx'
+
+
+def archive_filename(basename, archive_format):
+    """
+    Return the archive file name (e.g. 'sourcefile.tar.gz') for the given
+    basename and archive_format.
+    """
+    return basename + ARCHIVE_FORMATS[archive_format]
+
+
+class _GzipCodec(object):
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class _ZstdCodec(object):
+    def __init__(self, level, threads):
+        if zstandard is None:
+            raise RuntimeError('zstd archives require the zstandard module '
+                               '(pip install zstandard)')
+        self.level = level
+        self.threads = threads
+        self._local = threading.local()
+
+    def _compressor(self):
+        # ZstdCompressor objects are not thread safe, keep one per thread
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=self.level,
+                                                  threads=self.threads,
+                                                  write_content_size=True)
+            self._local.compressor = compressor
+        return compressor
+
+    def compress(self, data):
+        return self._compressor().compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _get_codec(archive_format, level=None, threads=-1):
+    if archive_format == 'gz':
+        return _GzipCodec(9 if level is None else level)
+    elif archive_format == 'zst':
+        return _ZstdCodec(3 if level is None else level, threads)
+    raise ValueError('Unknown archive format: %s' % archive_format)
+
+
+class UnitArchiveWriter(object):
+    """
+    Writes files into a compressed tar archive as they are produced.
+
+    Usage:
+
+      >>> with UnitArchiveWriter('sourcefile.tar.gz', 'gz') as archive:
+      ...     archive.add('0001.html', html)
+    """
+
+    def __init__(self, path, archive_format='gz', level=None, threads=-1):
+        """
+        @param path: Path of the archive to create.
+        @type path: str
+
+        @param archive_format: One of ARCHIVE_FORMATS ('gz' or 'zst').
+        @type archive_format: str
+
+        @param level: Compression level, None for the codec default.
+        @type level: int or None
+
+        @param threads: Number of zstd worker threads (-1 means one per
+            CPU). Ignored for gzip.
+        @type threads: int
+        """
+        self.path = path
+        self.archive_format = archive_format
+        self._codec = _get_codec(archive_format, level, threads)
+        self._file = open(path, 'wb')
+        self._lock = threading.Lock()
+        self._index = {}
+        self._offset = 0
+
+    def add(self, name, content, mtime=None):
+        """
+        Append the file name with the given content (str or bytes) to the
+        archive.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = time.time() if mtime is None else mtime
+        info.mode = 0o644
+
+        remainder = len(content) % tarfile.BLOCKSIZE
+        padding = b'\0' * (tarfile.BLOCKSIZE - remainder) if remainder else b''
+        member = info.tobuf(format=tarfile.GNU_FORMAT) + content + padding
+
+        # compression is the expensive part, do it outside of the lock
+        data = self._codec.compress(member)
+        with self._lock:
+            self._file.write(data)
+            self._index[name] = [self._offset, len(data)]
+            self._offset += len(data)
+
+    def close(self):
+        """
+        Write the end-of-archive marker and the member index.
+        """
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.write(self._codec.compress(b'\0' * tarfile.RECORDSIZE))
+            self._file.close()
+            self._file = None
+
+        index = {'format': self.archive_format, 'members': self._index}
+        with open(self.path + INDEX_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class UnitArchiveReader(object):
+    """
+    Random access reader for archives written by UnitArchiveWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + INDEX_SUFFIX, encoding='utf-8') as f:
+            index = json.load(f)
+        self.archive_format = index['format']
+        self.members = index['members']
+        self._codec = _get_codec(self.archive_format)
+
+    def names(self):
+        """
+        Return the member names in the order they were written.
+        """
+        return sorted(self.members, key=lambda name: self.members[name][0])
+
+    def read(self, name):
+        """
+        Return the content (bytes) of the member name, decompressing only
+        that member.
+        """
+        offset, length = self.members[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            member = self._codec.decompress(f.read(length))
+
+        with tarfile.open(fileobj=io.BytesIO(member), mode='r:') as tar:
+            return tar.extractfile(tar.next()).read()
+
+
+def has_index(path):
+    """
+    Tell whether path is an indexed (randomly accessible) archive.
+    """
+    return os.path.exists(path + INDEX_SUFFIX)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed store for the unit HTML files.
+
+Reruns of a course mostly contain byte-identical units.  Instead of keeping a
+copy of every unit in each course archive, units are stored once in a shared
+blob store keyed by the hash of their normalized markup, and the per-course
+metadata.csv references them through its 'blob' column.
+
+Layout of the store:
+
+  <root>/objects/<2 first hex digits>/<sha256 hex digest>.html.gz
+
+Blobs that are no longer referenced by any metadata.csv can be removed with:
+
+  python -m lib.blobstore gc <root> <html_dir> [<html_dir> ...]
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+
+BLOB_SUFFIX = '.html.gz'
+METADATA_FILENAME = 'metadata.csv'
+
+_RE_SEQ_CONTENTS_ID = re.compile(r'id="seq_contents_\d+"')
+_RE_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_unit_html(html):
+    """
+    Normalize the markup of a seq_contents_N unit so that the same unit
+    produces the same key wherever it appears in a course and however it
+    was pretty-printed: the position dependent seq_contents_N id is dropped
+    and whitespace runs are collapsed.
+    """
+    html = _RE_SEQ_CONTENTS_ID.sub('id="seq_contents"', html)
+    return _RE_WHITESPACE.sub(' ', html).strip()
+
+
+def blob_key(html):
+    """
+    Return the key (sha256 hex digest of the normalized markup) of html.
+    """
+    return hashlib.sha256(normalize_unit_html(html).encode('utf-8')).hexdigest()
+
+
+class BlobStore(object):
+    """
+    Content-addressed store of unit HTML shared between courses and runs.
+    It is safe to use from several threads and several crawler processes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def path(self, key):
+        """
+        Return the path of the blob with the given key.
+        """
+        return os.path.join(self.root, 'objects', key[:2], key + BLOB_SUFFIX)
+
+    def put(self, html):
+        """
+        Store html unless an identical unit is already stored and return its
+        key. A unit already stored gets its modification time refreshed, so
+        that gc keeps it until the metadata.csv referencing it is written.
+        """
+        key = blob_key(html)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            # write to a temporary file and rename it, so that concurrent
+            # writers and readers never see a partial blob
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(html.encode('utf-8')))
+            os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        """
+        Return the html stored under key.
+        """
+        with open(self.path(key), 'rb') as f:
+            return gzip.decompress(f.read()).decode('utf-8')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        """
+        Iterate over the keys of all the stored blobs.
+        """
+        objects = os.path.join(self.root, 'objects')
+        for prefix in sorted(os.listdir(objects)):
+            for name in sorted(os.listdir(os.path.join(objects, prefix))):
+                if name.endswith(BLOB_SUFFIX):
+                    yield name[:-len(BLOB_SUFFIX)]
+
+    def gc(self, referenced, min_age=3600, dry_run=False):
+        """
+        Remove the blobs whose key is not in referenced. Blobs written or
+        stored again (see put) less than min_age seconds ago are kept, since a
+        running crawl may not have written the metadata.csv that references
+        them yet.
+
+        Returns the list of removed keys.
+        """
+        removed = []
+        now = time.time()
+        for key in list(self.keys()):
+            if key in referenced:
+                continue
+            path = self.path(key)
+            if now - os.path.getmtime(path) < min_age:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed.append(key)
+        return removed
+
+
+def referenced_keys(html_dirs):
+    """
+    Return the set of blob keys referenced by the metadata.csv files found
+    under html_dirs.
+    """
+    keys = set()
+    for html_dir in html_dirs:
+        # a mistyped directory would make every blob look unreferenced
+        if not os.path.isdir(html_dir):
+            raise IOError('Not a directory: %s' % html_dir)
+        for dirpath, _, filenames in os.walk(html_dir):
+            if METADATA_FILENAME not in filenames:
+                continue
+            with open(os.path.join(dirpath, METADATA_FILENAME),
+                      encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    if row.get('blob'):
+                        keys.add(row['blob'])
+    return keys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.blobstore',
+                                     description='Maintain the unit HTML blob store')
+    subparsers = parser.add_subparsers(dest='command')
+
+    gc_parser = subparsers.add_parser('gc', help='remove unreferenced blobs')
+    gc_parser.add_argument('root', help='blob store directory')
+    gc_parser.add_argument('html_dirs', nargs='+',
+                           help='crawler output directories whose '
+                           'metadata.csv files reference the store')
+    gc_parser.add_argument('--min-age', type=int, default=3600,
+                           help='keep blobs younger than this (seconds)')
+    gc_parser.add_argument('--dry-run', action='store_true',
+                           help='only list the blobs that would be removed')
+
+    cat_parser = subparsers.add_parser('cat', help='print a stored unit')
+    cat_parser.add_argument('root', help='blob store directory')
+    cat_parser.add_argument('key', help='blob key (from metadata.csv)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'gc':
+        store = BlobStore(args.root)
+        removed = store.gc(referenced_keys(args.html_dirs),
+                           min_age=args.min_age, dry_run=args.dry_run)
+        for key in removed:
+            logging.info('%s %s', 'unreferenced' if args.dry_run else 'removed', key)
+        logging.info('%d unreferenced blob(s)', len(removed))
+    elif args.command == 'cat':
+        sys.stdout.write(BlobStore(args.root).get(args.key))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
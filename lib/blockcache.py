@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent extraction cache of the unit blocks, shared by the runs of a
+course.
+
+Open edX blocks carry a data-usage-id which is kept when a course is rerun:
+block-v1:ORG+COURSE+RUN+type@html+block@4f1e... only changes by its RUN. The
+cache (--block-cache) is a SQLite database of the extracted text, problem
+text and type, and video metadata (durations and transcripts) of every block,
+keyed by the usage id without the run and by the hash of the markup of the
+block, in which the course key of the run is also replaced, and of the
+version of the extractors (EXTRACTOR_VERSION). A block is only
+extracted again when it is new or its content changed, so crawling a new term
+of a known course skips most of the parsing and all the video and transcript
+lookups.
+
+  >>> from lib.blockcache import BlockCache
+  >>> cache = BlockCache('blocks.db')
+  >>> ident = cache.identify(block)          # block: parse tree element
+  >>> data = cache.get(ident, 'html') or compute(block)
+  >>> cache.put(ident, 'html', data)
+
+Statistics of a cache:
+
+  python -m lib.blockcache <database>
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from .metrics import METRICS
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    block_key TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (block_key, content_hash)
+) WITHOUT ROWID;
+"""
+
+_INSERT = ('INSERT OR REPLACE INTO blocks (block_key, content_hash, kind, data, updated) '
+           'VALUES (?, ?, ?, ?, ?)')
+
+# version of the extraction of the blocks (lib.extraction, lib.textextract
+# and the video metadata of the crawler), part of the content hash: bump it
+# when the extracted data changes, so that the cached data is not reused
+EXTRACTOR_VERSION = 1
+
+# block-v1:ORG+COURSE+RUN+type@TYPE+block@ID
+_RE_BLOCK_V1 = re.compile(r'^block-v1:([^+]+)\+([^+]+)\+([^+]+)\+(type@.+)$')
+
+
+def block_key(usage_id):
+    """
+    Return the identity of the block usage_id shared by the runs of its
+    course, and the course key of its run (None for the usage ids without
+    one, e.g. i4x://ORG/COURSE/TYPE/ID).
+    """
+    match = _RE_BLOCK_V1.match(usage_id)
+    if match is None:
+        return usage_id, None
+    org, course, run, block = match.groups()
+    return '%s+%s+%s' % (org, course, block), (org, course, run)
+
+
+def content_hash(markup, course_key=None):
+    """
+    Return the hash of the markup of a block, in which the course key of
+    its run (in the usage ids, the course and asset urls) is replaced, and
+    of EXTRACTOR_VERSION.
+    """
+    if course_key is not None:
+        org, course, run = course_key
+        for separator in ('+', '%2B', '/'):
+            markup = markup.replace(separator.join((org, course, run)),
+                                    separator.join((org, course)))
+    return hashlib.sha256(('%d\n%s' % (EXTRACTOR_VERSION, markup)).encode('utf-8')).hexdigest()
+
+
+def identify(block):
+    """
+    Return the identity (block key, content hash) of a block (parse tree
+    element), None when it has no data-usage-id.
+    """
+    usage_id = block.get('data-usage-id')
+    if not usage_id:
+        return None
+    key, course_key = block_key(usage_id)
+    return key, content_hash(str(block), course_key)
+
+
+class BlockCache(object):
+    """
+    Extracted data of the blocks by (block key, content hash), in SQLite.
+    """
+
+    def __init__(self, path, batch_size=200):
+        """
+        @param path: Path of the SQLite database, created if needed.
+        @type path: str
+
+        @param batch_size: Number of blocks written per transaction.
+        @type batch_size: int
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    def identify(self, block):
+        """
+        Return the identity of a block, see identify.
+        """
+        return identify(block)
+
+    def get(self, ident, kind, require=()):
+        """
+        Return the data cached for the block ident, None when the block was
+        never extracted, changed, or its data lacks one of the keys require.
+        """
+        data = None
+        if ident is not None:
+            with self._lock:
+                data = self._pending.get(ident)
+                if data is None:
+                    row = self._conn.execute('SELECT data FROM blocks WHERE block_key = ? '
+                                             'AND content_hash = ?', ident).fetchone()
+                    data = json.loads(row[0]) if row is not None else None
+                else:
+                    data = data[1]
+            if data is not None and any(key not in data for key in require):
+                data = None
+        METRICS.inc('block_cache_total', type=kind, result='miss' if data is None else 'hit')
+        return data
+
+    def put(self, ident, kind, data):
+        """
+        Cache the data (JSON serializable dict) extracted from the block
+        ident; it is written with the next batch.
+        """
+        if ident is None:
+            return
+        with self._lock:
+            self._pending[ident] = (kind, data)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        # called with self._lock held
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(_INSERT, [(key, digest, kind, json.dumps(data, sort_keys=True), now)
+                                             for (key, digest), (kind, data) in pending.items()])
+
+    def flush(self):
+        """
+        Write the pending blocks.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def stats(self):
+        """
+        Return the number of cached blocks by kind.
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT kind, COUNT(*) FROM blocks GROUP BY kind'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.blockcache',
+                                     description='Statistics of a block extraction cache')
+    parser.add_argument('database', help='cache built with --block-cache')
+    args = parser.parse_args(argv)
+
+    cache = BlockCache(args.database)
+    try:
+        for kind, count in sorted(cache.stats().items()):
+            print('%-10s %d' % (kind, count))
+    finally:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
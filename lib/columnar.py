@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar (Parquet) export of the crawled courses.
+
+With --parquet-dir, the components, videos and transcript segments of every
+course are written as Parquet files partitioned by course (hive layout):
+
+  <root>/components/course=<course>/part-0.parquet
+  <root>/videos/course=<course>/part-0.parquet
+  <root>/transcript_segments/course=<course>/part-0.parquet
+
+The schemas are typed, and the section, subsection, unit, type and language
+columns are dictionary encoded. Rows are written by row group while the
+course is crawled (several courses can be crawled at the same time) into a
+file of <root>/.tmp, outside of the datasets, which is renamed into place
+when the course is done and replaces the one of a previous crawl; until then
+the datasets hold the previous crawl. When only some subsections of a course
+are crawled again (a watch poll), the rows of its other subsections are kept.
+
+Reading them back:
+
+  >>> import pyarrow.dataset as ds
+  >>> videos = ds.dataset('parquet/videos', partitioning='hive').to_table()
+  >>> import pandas
+  >>> components = pandas.read_parquet('parquet/components')
+
+Requires pyarrow (pip install pyarrow).
+"""
+
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow is optional
+    pyarrow = None
+
+
+PART_FILENAME = 'part-0.parquet'
+TMP_DIRNAME = '.tmp'
+
+
+def _schemas():
+    names = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    place = [('section', names), ('subsection', names), ('unit', names)]
+    return {
+        'components': pyarrow.schema(place + [
+            ('block_id', pyarrow.string()),
+            ('type', names),
+        ]),
+        'videos': pyarrow.schema(place + [
+            ('block_id', pyarrow.string()),
+            ('youtube_url', pyarrow.string()),
+            ('video_source', pyarrow.string()),
+            ('duration', pyarrow.float64()),
+            ('languages', pyarrow.list_(pyarrow.string())),
+            ('missing_languages', pyarrow.list_(pyarrow.string())),
+            ('speech_period', pyarrow.list_(pyarrow.float64())),
+        ]),
+        'transcript_segments': pyarrow.schema(place + [
+            ('block_id', pyarrow.string()),
+            ('language', names),
+            ('position', pyarrow.int32()),
+            ('text', pyarrow.string()),
+        ]),
+    }
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # 'n/a' when the duration could not be found
+        return None
+
+
+def _without_subsections(table, subsections):
+    """
+    Return the rows of table outside of subsections ((section, subsection)
+    names).
+    """
+    replaced = set(subsections)
+    mask = [(section, subsection) not in replaced
+            for section, subsection in zip(table.column('section').to_pylist(),
+                                           table.column('subsection').to_pylist())]
+    return table.filter(pyarrow.array(mask, pyarrow.bool_()))
+
+
+class _DatasetWriter(object):
+    """
+    Buffers the rows of one dataset of one course by column and writes them
+    as a row group every row_group_size rows into tmp_path, moved to path
+    when closed.
+    """
+
+    def __init__(self, path, tmp_path, schema, row_group_size, compression, kept=None):
+        self.path = path
+        self.tmp_path = tmp_path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.compression = compression
+        # rows of the previous file written before the new ones
+        self.kept = kept
+        self._columns = {name: [] for name in schema.names}
+        self._rows = 0
+        self._writer = None
+
+    def add(self, row):
+        for name, values in self._columns.items():
+            values.append(row.get(name))
+        self._rows += 1
+        if self._rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self._columns[field.name]
+            if pyarrow.types.is_dictionary(field.type):
+                arrays.append(pyarrow.array(values, pyarrow.string())
+                              .dictionary_encode().cast(field.type))
+            else:
+                arrays.append(pyarrow.array(values, field.type))
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        self._open()
+        self._writer.write_batch(batch, row_group_size=self._rows)
+        for values in self._columns.values():
+            del values[:]
+        self._rows = 0
+
+    def _open(self):
+        if self._writer is not None:
+            return
+        os.makedirs(os.path.dirname(self.tmp_path), exist_ok=True)
+        self._writer = pyarrow.parquet.ParquetWriter(self.tmp_path, self.schema,
+                                                     compression=self.compression)
+        if self.kept is not None and self.kept.num_rows:
+            self._writer.write_table(self.kept, row_group_size=self.row_group_size)
+        self.kept = None
+
+    def close(self):
+        """
+        Write the last row group and move the file into place, replacing the
+        one of a previous crawl. A dataset without rows has no file.
+        """
+        self.flush()
+        if self.kept is not None and self.kept.num_rows:
+            self._open()
+        if self._writer is not None:
+            self._writer.close()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ParquetExporter(object):
+    """
+    Writes the components, videos and transcript segments of the crawled
+    courses into partitioned Parquet datasets.
+    """
+
+    def __init__(self, root, row_group_size=10000, compression='zstd'):
+        """
+        @param root: Directory of the datasets.
+        @type root: str
+
+        @param row_group_size: Rows written per row group.
+        @type row_group_size: int
+
+        @param compression: Parquet compression codec.
+        @type compression: str
+        """
+        if pyarrow is None:
+            raise RuntimeError('The Parquet export requires the pyarrow module '
+                               '(pip install pyarrow)')
+        self.root = root
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self._schemas = _schemas()
+        # the dataset writers of the courses being crawled, by course
+        self._writers = {}
+
+    def begin_course(self, course, subsections=None):
+        """
+        Start the partitions of course, which replace the ones of a previous
+        crawl when the course ends. With subsections ((section, subsection)
+        names), only the rows of these subsections are replaced.
+        """
+        self.end_course(course)
+        writers = self._writers[course] = {}
+        for dataset, schema in self._schemas.items():
+            partition = 'course=%s' % course
+            path = os.path.join(self.root, dataset, partition, PART_FILENAME)
+            kept = None
+            if subsections is not None and os.path.exists(path):
+                kept = _without_subsections(pyarrow.parquet.read_table(path, schema=schema), subsections)
+            writers[dataset] = _DatasetWriter(path, os.path.join(self.root, TMP_DIRNAME, dataset, partition + '.parquet'),
+                                              schema, self.row_group_size, self.compression, kept)
+
+    def add_component(self, course, section, subsection, unit, block_id, kind):
+        self._writers[course]['components'].add({'section': section, 'subsection': subsection,
+                                                 'unit': unit, 'block_id': block_id, 'type': kind})
+
+    def add_video(self, course, block_id, video):
+        """
+        Add a video record (as in all_videocomp.json) and its transcripts.
+        """
+        writers = self._writers[course]
+        place = {'section': video.get('section'), 'subsection': video.get('subsection'),
+                 'unit': video.get('unit')}
+        languages = []
+        missing = []
+        for key, value in video.items():
+            if not key.startswith('transcript_'):
+                continue
+            language = key[len('transcript_'):]
+            if not isinstance(value, list):
+                missing.append(language)
+                continue
+            languages.append(language)
+            add_segment = writers['transcript_segments'].add
+            for position, text in enumerate(value):
+                add_segment(dict(place, block_id=block_id, language=language,
+                                 position=position, text=text))
+
+        speech_period = video.get('speech_period')
+        if not isinstance(speech_period, list):
+            speech_period = None
+        else:
+            speech_period = [_to_float(period) for period in speech_period]
+        writers['videos'].add(dict(place, block_id=block_id,
+                                         youtube_url=video.get('youtube_url'),
+                                         video_source=video.get('video_source'),
+                                         duration=_to_float(video.get('video_duration')),
+                                         languages=languages,
+                                         missing_languages=missing,
+                                         speech_period=speech_period))
+
+    def end_course(self, course):
+        """
+        Write the remaining rows of course and close its files.
+        """
+        writers = self._writers.pop(course, None)
+        if writers is None:
+            return
+        for writer in writers.values():
+            writer.close()
+
+    def close(self):
+        for course in list(self._writers):
+            self.end_course(course)
@@ -30,6 +30,9 @@ In the script the data structures used are:
 
 4. The units can contain multiple videos:
    Unit -> [Video]
+
+All the classes use __slots__, since catalog-scale crawls hold tens of
+thousands of them.
 """
 
 
@@ -37,6 +40,8 @@ class Course(object):
     """
     Course class represents course information.
     """
+    __slots__ = ('id', 'name', 'url', 'state')
+
     def __init__(self, id, name, url, state):
         """
         @param id: The id of a course in edX is composed by the path
@@ -69,6 +74,8 @@ class Section(object):
     """
     Representation of a section of the course.
     """
+    __slots__ = ('position', 'name', 'url', 'subsections')
+
     def __init__(self, position, name, url, subsections):
         """
         @param position: Integer position of the section in the list of
@@ -95,6 +102,8 @@ class SubSection(object):
     """
     Representation of a subsection in a section.
     """
+    __slots__ = ('position', 'name', 'url')
+
     def __init__(self, position, name, url):
         """
         @param position: Integer position of the subsection in the subsection
@@ -118,6 +127,8 @@ class Unit(object):
     """
     Representation of a single unit of the course.
     """
+    __slots__ = ('videos', 'resources_urls')
+
     def __init__(self, videos, resources_urls):
         """
         @param videos: List of videos present in the unit.
@@ -136,6 +147,9 @@ class Video(object):
     """
     Representation of a single video.
     """
+    __slots__ = ('video_youtube_url', 'available_subs_url',
+                 'sub_template_url', 'mp4_urls')
+
     def __init__(self, video_youtube_url, available_subs_url,
                  sub_template_url, mp4_urls):
         """
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+Global index of the resource urls already seen, used to remove repeated urls
+from the units in linear time.
+
+The index is updated in place, can be saved and loaded to deduplicate
+across runs and courses, and remembers which units share a url so that
+repeated resources can be linked instead of silently dropped.
+
+For catalog-wide crawls the exact set of urls can be replaced by a Bloom
+filter of a fixed size (bloom_capacity); it may then report a new url as
+already seen with probability error_rate, and only knows the owners of the
+repetitions found during the current run.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import tempfile
+
+
+_BLOOM_MAGIC = b'EDXBLOOM1'
+
+
+class BloomFilter(object):
+    """
+    Fixed size probabilistic set of strings.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, num_bits=None, num_hashes=None,
+                 bits=None):
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits / float(capacity) * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing of a single digest (Kirsch and Mitzenmacher)
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        """
+        Add item, return True if it was (probably) not present yet.
+        """
+        new = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        return new
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def __len__(self):
+        # estimate of the number of items from the bits set (Swamidass and
+        # Baldi)
+        ones = sum(bin(byte).count('1') for byte in self.bits)
+        if ones >= self.num_bits:
+            return self.num_bits
+        return int(round(-self.num_bits / float(self.num_hashes) * math.log(1 - ones / float(self.num_bits))))
+
+    def to_bytes(self):
+        return _BLOOM_MAGIC + struct.pack('<QI', self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        header = len(_BLOOM_MAGIC)
+        num_bits, num_hashes = struct.unpack('<QI', data[header:header + 12])
+        return cls(None, num_bits=num_bits, num_hashes=num_hashes,
+                   bits=bytearray(data[header + 12:]))
+
+
+class UrlIndex(object):
+    """
+    Index of the urls seen so far and of the units (owners) that contain
+    them.
+    """
+
+    def __init__(self, bloom_capacity=None, error_rate=0.001):
+        """
+        @param bloom_capacity: Number of urls expected, when given the index
+            is a Bloom filter instead of an exact set.
+        @type bloom_capacity: int or None
+
+        @param error_rate: False positive rate of the Bloom filter.
+        @type error_rate: float
+        """
+        self._bloom = BloomFilter(bloom_capacity, error_rate) if bloom_capacity else None
+        # url -> first owner (exact mode only)
+        self._first_owner = {}
+        # url -> owners of the repetitions found
+        self._repeated = {}
+
+    @property
+    def probabilistic(self):
+        return self._bloom is not None
+
+    def __contains__(self, url):
+        if self._bloom is not None:
+            return url in self._bloom
+        return url in self._first_owner
+
+    def __len__(self):
+        """
+        Number of urls in the index, estimated in Bloom filter mode.
+        """
+        if self._bloom is not None:
+            return len(self._bloom)
+        return len(self._first_owner)
+
+    def add(self, url, owner=None):
+        """
+        Add url found in owner, return True if it had not been seen before.
+        A url found again in the same owner (e.g. the same unit crawled again
+        with a saved index) is no repetition.
+        """
+        if self._bloom is not None:
+            new = self._bloom.add(url)
+        else:
+            new = url not in self._first_owner
+            if new:
+                self._first_owner[url] = owner
+        if not new and owner != self._first_owner.get(url):
+            owners = self._repeated.setdefault(url, [])
+            if owner not in owners:
+                owners.append(owner)
+        return new
+
+    def filter(self, urls, owner=None):
+        """
+        Return the urls (in order) that had not been seen before, and add
+        them to the index.
+        """
+        return [url for url in urls if self.add(url, owner)]
+
+    def shared(self):
+        """
+        Return {url: [owners]} for the urls found in more than one place.
+        The first owner is only known in exact mode.
+        """
+        result = {}
+        for url, owners in self._repeated.items():
+            first = self._first_owner.get(url)
+            result[url] = ([first] if first is not None else []) + owners
+        return result
+
+    def save(self, path):
+        """
+        Save the index into path (atomically).
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if self._bloom is not None:
+                f.write(self._bloom.to_bytes())
+            else:
+                f.write(json.dumps(self._first_owner).encode('utf-8'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, bloom_capacity=None, error_rate=0.001):
+        """
+        Load the index saved in path, or return a new one if path does not
+        exist. An exact index loaded with bloom_capacity is converted to a
+        Bloom filter; a Bloom filter stays one.
+        """
+        index = cls(bloom_capacity, error_rate)
+        if not os.path.exists(path):
+            return index
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.startswith(_BLOOM_MAGIC):
+            if not bloom_capacity:
+                logging.warning('%s is a Bloom filter, the url index is not exact', path)
+            index._bloom = BloomFilter.from_bytes(data)
+        elif bloom_capacity:
+            logging.info('Converting the exact url index %s to a Bloom filter', path)
+            for url in json.loads(data.decode('utf-8')):
+                index._bloom.add(url)
+        else:
+            index._first_owner = json.loads(data.decode('utf-8'))
+        return index
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+"""
+Download stage of the resources (PDFs, slides, ... of --file-formats) and of
+the MP4 videos found in the units (--download-dir).
+
+The files are fetched by a bounded pool of threads. A file larger than a
+segment, from a server accepting range requests, is split into segments
+fetched in parallel (HTTP Range, with If-Range so that a file changed in the
+meantime is not assembled from two versions). The segments are written in a
+partial directory as they arrive, so an interrupted download resumes from
+the bytes already on disk in the next run. The assembled file is checked
+against its size and the checksums announced by the server (Digest,
+Repr-Digest, Content-MD5, x-goog-hash, or the MD5 ETag of S3), and stored
+once by its SHA-256 in a content-addressed store; the places of the file in
+the course are hard links to it, so the resources repeated across units and
+courses take their size once:
+
+  <download dir>/objects/4f/4f1e...          content of every file, once
+  <download dir>/partial/<url hash>/         segments of the unfinished files
+  <download dir>/manifest.json               {url: {"sha256": ..., "size": ...}}
+  <download dir>/<Course>/<section>/<subsection>/<unit>-<file>   hard links
+
+The urls in the manifest are not downloaded again. The requests go through
+the transport of the crawl (see lib.utils.open_url, so they are recorded with
+--record), those to the edX host with the headers of the session, renewing it
+when it expires; the other hosts only get a User-Agent. A file redirected to
+the login page, or answered by an HTML page, is a failed download.
+
+Usage:
+
+  >>> from lib.downloader import Downloader
+  >>> downloader = Downloader('downloads', headers, 'courses.edx.org', workers=8, segment_size=8 << 20)
+  >>> summary = downloader.download({url: ['GeoS101x/01-Intro/01-Plates/01-slides.pdf'], ...})
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlparse
+
+from .errorsink import ERRORS
+from .metrics import METRICS
+from .session import is_login_url
+from .utils import mkdir_p, open_url
+
+MANIFEST_FILENAME = 'manifest.json'
+OBJECTS_DIRNAME = 'objects'
+PARTIAL_DIRNAME = 'partial'
+
+_CHUNK_SIZE = 1 << 16
+_STATE_FILENAME = 'state.json'
+_USER_AGENT = 'edX-downloader/0.01'
+
+# ETags of S3 (and CloudFront in front of it) are the MD5 of the objects
+# uploaded in one part, the multipart ones have a -<parts> suffix
+_RE_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(IOError):
+    """
+    A file could not be downloaded.
+    """
+
+
+class ContentMismatchError(DownloadError):
+    """
+    The content of a file does not match its size or checksums, or changed
+    during its download.
+    """
+
+
+def _decode_digest(value):
+    try:
+        return binascii.hexlify(base64.b64decode(value.strip().strip(':'))).decode('ascii')
+    except (binascii.Error, ValueError):
+        return None
+
+
+def expected_digests(headers):
+    """
+    Return the checksums {'sha256': hex, 'md5': hex} of a file announced in
+    its response headers.
+    """
+    digests = {}
+    # Repr-Digest: sha-256=:base64:, Digest: SHA-256=base64, and
+    # Content-Digest when the content is sent without encoding
+    values = [headers.get('Repr-Digest'), headers.get('Digest')]
+    if not headers.get('Content-Encoding'):
+        values.append(headers.get('Content-Digest'))
+    for value in values:
+        for item in (value or '').split(','):
+            algorithm, _, encoded = item.strip().partition('=')
+            algorithm = algorithm.strip().lower().replace('-', '')
+            if algorithm in ('sha256', 'md5') and encoded:
+                digest = _decode_digest(encoded)
+                if digest is not None:
+                    digests.setdefault(algorithm, digest)
+    for item in (headers.get('x-goog-hash') or '').split(','):
+        algorithm, _, encoded = item.strip().partition('=')
+        if algorithm == 'md5':
+            digest = _decode_digest(encoded)
+            if digest is not None:
+                digests.setdefault('md5', digest)
+    if headers.get('Content-MD5'):
+        digest = _decode_digest(headers['Content-MD5'])
+        if digest is not None:
+            digests.setdefault('md5', digest)
+    match = _RE_MD5_ETAG.match(headers.get('ETag') or '')
+    if match and any(name.lower().startswith('x-amz-') for name in headers.keys()):
+        digests.setdefault('md5', match.group(1))
+    return digests
+
+
+class _Download(object):
+    """
+    A file being downloaded: its size, validator, checksums, segments and
+    partial directory.
+    """
+
+    def __init__(self, url, paths, directory):
+        self.url = url
+        self.paths = paths
+        self.directory = directory
+        self.size = None
+        self.ranges = False
+        self.validator = None
+        self.digests = {}
+        self.segments = []
+        self.pending = 0
+        self.failed = False
+
+    def state(self):
+        return {'url': self.url, 'size': self.size, 'validator': self.validator,
+                'segments': self.segments}
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, '%05d.part' % index)
+
+
+class Downloader(object):
+    """
+    Downloads files into a content-addressed store and links them to their
+    places, with a bounded pool of threads.
+    """
+
+    def __init__(self, directory, headers=None, host=None, workers=8, segment_size=8 << 20, retries=2):
+        """
+        @param directory: Download directory (store, partial downloads,
+            manifest and the links of the courses).
+        @type directory: str
+
+        @param headers: Headers of the session, sent to host only (the
+            cookies are those of the transport, and the headers of a renewed
+            session those of lib.utils.open_url).
+        @type headers: dict or None
+
+        @param host: Host (netloc) of the edX site.
+        @type host: str or None
+
+        @param workers: Number of downloading threads.
+        @type workers: int
+
+        @param segment_size: Size in bytes of the range segments; smaller
+            files are fetched in one request.
+        @type segment_size: int
+
+        @param retries: Times a failed segment is requested again, from the
+            bytes already received.
+        @type retries: int
+        """
+        self.directory = directory
+        self.headers = dict(headers or {})
+        self.host = host
+        self.workers = workers
+        self.segment_size = segment_size
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        self._manifest = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, encoding='utf-8') as f:
+                self._manifest = json.load(f)
+
+    def object_path(self, sha256):
+        return os.path.join(self.directory, OBJECTS_DIRNAME, sha256[:2], sha256)
+
+    def _open(self, download, extra_headers=None, method=None):
+        url = download.url
+        if urlparse(url).netloc == self.host:
+            headers = self.headers
+        else:
+            # the CSRF token and the XHR headers of the session are for edX
+            headers = {'User-Agent': self.headers.get('User-Agent', _USER_AGENT)}
+        response = open_url(url, headers, extra_headers, method)
+        # the session could not be renewed, or the file needs another login
+        if is_login_url(response.geturl()) and not is_login_url(url):
+            response.close()
+            raise DownloadError('%s: redirected to the login page' % url)
+        content_type = (response.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type == 'text/html' and not download.paths[0].lower().endswith(('.htm', '.html')):
+            response.close()
+            raise DownloadError('%s: an HTML page instead of the file' % url)
+        return response
+
+    def _probe(self, download):
+        """
+        Read the size, validator and checksums of a file, and plan its
+        segments, keeping those of a previous run of the same file.
+        """
+        try:
+            with self._open(download, method='HEAD') as response:
+                headers = response.headers
+        except HTTPError as exception:
+            # servers refusing HEAD are downloaded in one request
+            if exception.code not in (403, 405, 501):
+                raise
+            headers = {}
+        length = headers.get('Content-Length')
+        download.size = int(length) if length and length.isdigit() else None
+        download.ranges = download.size is not None and (headers.get('Accept-Ranges') or '').lower() == 'bytes'
+        etag = headers.get('ETag')
+        download.validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        download.digests = expected_digests(headers)
+
+        if download.ranges and download.size > self.segment_size:
+            download.segments = [[start, min(start + self.segment_size, download.size) - 1]
+                                 for start in range(0, download.size, self.segment_size)]
+        else:
+            download.segments = [[0, download.size - 1 if download.size else None]]
+
+        state_path = os.path.join(download.directory, _STATE_FILENAME)
+        if os.path.exists(state_path):
+            with open(state_path, encoding='utf-8') as f:
+                previous = json.load(f)
+            # the segments of another version of the file are dropped
+            if previous != download.state() or download.validator is None or not download.ranges:
+                shutil.rmtree(download.directory)
+        mkdir_p(download.directory)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(download.state(), f)
+        return download
+
+    def _fetch_segment(self, download, index):
+        """
+        Fetch the missing bytes of a segment into its part file.
+        """
+        start, end = download.segments[index]
+        path = download.segment_path(index)
+        length = end - start + 1 if end is not None else None
+        host = urlparse(download.url).netloc
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            if length is not None and offset >= length:
+                METRICS.inc('download_segments_total', result='resumed' if attempt == 0 else 'fetched')
+                return
+            if offset and not download.ranges:
+                offset = 0
+            extra_headers = {}
+            if start + offset > 0 or end is not None and end < download.size - 1:
+                extra_headers['Range'] = 'bytes=%d-%s' % (start + offset, end if end is not None else '')
+                if download.validator:
+                    extra_headers['If-Range'] = download.validator
+            try:
+                with self._open(download, extra_headers) as response:
+                    if 'Range' in extra_headers:
+                        content_range = response.headers.get('Content-Range') or ''
+                        if response.status != 206 or not content_range.startswith('bytes %d-' % (start + offset)):
+                            raise ContentMismatchError('%s changed during the download' % download.url)
+                    with open(path, 'ab' if offset else 'wb') as f:
+                        while True:
+                            chunk = response.read(_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            METRICS.inc('download_bytes_total', len(chunk), host=host)
+            except ContentMismatchError:
+                raise
+            except (URLError, http_client.HTTPException, socket.error) as exception:
+                # the server errors and the network failures are retried
+                if attempt == self.retries or isinstance(exception, HTTPError) and exception.code < 500:
+                    raise
+                logging.warning('Segment %d of %s failed (%s), retrying', index, download.url, exception)
+            else:
+                if length is None or os.path.getsize(path) >= length:
+                    METRICS.inc('download_segments_total', result='fetched')
+                    return
+                logging.warning('Segment %d of %s is incomplete, resuming', index, download.url)
+        raise DownloadError('%s: segment %d is incomplete' % (download.url, index))
+
+    def _finalize(self, download):
+        """
+        Assemble the segments of a file, check it and store it, return its
+        SHA-256.
+        """
+        hashes = {'sha256': hashlib.sha256()}
+        if 'md5' in download.digests:
+            hashes['md5'] = hashlib.md5()
+        objects_dir = os.path.join(self.directory, OBJECTS_DIRNAME)
+        mkdir_p(objects_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir, suffix='.tmp')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for index in range(len(download.segments)):
+                    with open(download.segment_path(index), 'rb') as f:
+                        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                            for digest in hashes.values():
+                                digest.update(chunk)
+                            out.write(chunk)
+                            size += len(chunk)
+            if download.size is not None and size != download.size:
+                raise ContentMismatchError('%s: %d bytes instead of %d' % (download.url, size, download.size))
+            for algorithm, expected in download.digests.items():
+                if hashes[algorithm].hexdigest() != expected:
+                    raise ContentMismatchError('%s: %s mismatch' % (download.url, algorithm))
+            sha256 = hashes['sha256'].hexdigest()
+            path = self.object_path(sha256)
+            mkdir_p(os.path.dirname(path))
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                # the same content from another url is already stored
+                pass
+        finally:
+            os.remove(tmp_path)
+        shutil.rmtree(download.directory)
+        with self._lock:
+            self._manifest[download.url] = {'sha256': sha256, 'size': size}
+        return sha256
+
+    def link(self, sha256, paths):
+        """
+        Link the stored file sha256 to paths (relative to the download
+        directory), copying it where hard links are not supported.
+        """
+        source = self.object_path(sha256)
+        for path in paths:
+            target = os.path.join(self.directory, path)
+            mkdir_p(os.path.dirname(target))
+            if os.path.exists(target):
+                if os.path.samefile(source, target):
+                    continue
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+    def _failed(self, download, exception):
+        logging.warning('Download of %s failed: %s', download.url, exception)
+        METRICS.inc('downloads_total', result='failed')
+        ERRORS.report('resource', str(exception), course_dir=self.directory,
+                      details=[('url', download.url), ('file', download.paths[0])])
+        # a corrupt or changed file is downloaded from scratch next time
+        if isinstance(exception, ContentMismatchError) and os.path.isdir(download.directory):
+            shutil.rmtree(download.directory)
+
+    def download(self, targets):
+        """
+        Download the files of targets, {url: [paths]} with the paths
+        relative to the download directory, and link them there. Return the
+        number of files downloaded, already stored (cached) and failed.
+        """
+        summary = {'downloaded': 0, 'cached': 0, 'failed': 0}
+        futures = {}
+        # the pool threads record into the metrics of the calling job
+        probe, fetch_segment, finalize = (METRICS.bind(self._probe), METRICS.bind(self._fetch_segment),
+                                          METRICS.bind(self._finalize))
+        with ThreadPoolExecutor(self.workers) as pool:
+            for url, paths in sorted(targets.items()):
+                stored = self._manifest.get(url)
+                if stored is not None and os.path.exists(self.object_path(stored['sha256'])):
+                    self.link(stored['sha256'], paths)
+                    METRICS.inc('downloads_total', result='cached')
+                    summary['cached'] += 1
+                    continue
+                directory = os.path.join(self.directory, PARTIAL_DIRNAME,
+                                         hashlib.sha1(url.encode('utf-8')).hexdigest())
+                download = _Download(url, paths, directory)
+                futures[pool.submit(probe, download)] = ('probe', download)
+
+            # the segments of a file are fetched as soon as it is probed, and
+            # it is assembled as soon as they are all there
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, download = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except (URLError, http_client.HTTPException, OSError) as exception:
+                        if not download.failed:
+                            download.failed = True
+                            summary['failed'] += 1
+                            self._failed(download, exception)
+                        if stage == 'segment':
+                            download.pending -= 1
+                        continue
+                    if stage == 'probe':
+                        download.pending = len(download.segments)
+                        for index in range(len(download.segments)):
+                            futures[pool.submit(fetch_segment, download, index)] = ('segment', download)
+                    elif stage == 'segment':
+                        download.pending -= 1
+                        if download.pending == 0 and not download.failed:
+                            futures[pool.submit(finalize, download)] = ('finalize', download)
+                    else:
+                        self.link(result, download.paths)
+                        METRICS.inc('downloads_total', result='downloaded')
+                        summary['downloaded'] += 1
+        self.save()
+        return summary
+
+    def save(self):
+        mkdir_p(self.directory)
+        tmp_path = self._manifest_path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path)
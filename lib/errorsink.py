@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+Structured error collection for the crawler.
+
+Errors are reported as events from any thread (or from worker processes,
+see ErrorSink.start) and written by a single writer thread in batches, so
+that parallel workers never contend on the report files nor interleave
+their writes. Every event is written to errors.jsonl, and events that
+belong to a legacy text report (transcript_error_report.txt,
+downloading_error_report.txt) are also appended there in the historical
+format. When a crawl is done (ErrorSink.flush), an error_summary.json with
+the number of its errors by kind is written for every course and the report
+files of the course are closed; close() does it for the remaining ones.
+
+Usage:
+
+  >>> from lib.errorsink import ERRORS
+  >>> ERRORS.report('transcript', str(exception),
+  ...               course='GeoS101x', course_dir='HTMLs/GeoS101x',
+  ...               report='transcript_error_report.txt',
+  ...               details=[('video url', yt_link), ('language', 'English')])
+  >>> ERRORS.flush(['HTMLs/GeoS101x'])
+  >>> ERRORS.close()
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+
+JSONL_FILENAME = 'errors.jsonl'
+SUMMARY_FILENAME = 'error_summary.json'
+
+_STOP = None
+
+
+def _format_block(event):
+    lines = ['---------------------------------',
+             '%s error: %s' % (event['kind'], event['message'])]
+    lines.extend('%s: %s' % (label, value) for label, value in event['details'])
+    lines.append('---------------------------------')
+    return '\n'.join(lines) + '\n'
+
+
+def _format_line(event):
+    return 'External command error ignored: %s\n\n' % event['message']
+
+
+# formatting of the events of each legacy text report
+LEGACY_FORMATS = {
+    'transcript_error_report.txt': _format_block,
+    'downloading_error_report.txt': _format_line,
+}
+
+
+class ErrorSink(object):
+    """
+    Collects error events and writes them through a single writer thread.
+    Use the module level ERRORS instance.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._files = {}
+        self._summaries = {}
+        # flush requests queued and done, see flush
+        self._flush_cond = threading.Condition()
+        self._flushes = 0
+        self._flushed = 0
+
+    def start(self, multiprocess=False):
+        """
+        Start the writer thread. With multiprocess=True events are carried
+        by a multiprocessing queue; pass ERRORS.queue to the worker
+        processes and call ERRORS.attach(queue) in them.
+        """
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._queue = multiprocessing.Queue() if multiprocess else queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop,
+                                            name='error-writer', daemon=True)
+            self._writer.start()
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def attach(self, event_queue):
+        """
+        Make this sink (in a worker process) send its events to the queue
+        of the sink of the parent process.
+        """
+        self._queue = event_queue
+
+    def report(self, kind, message, course=None, course_dir=None, report=None,
+               details=()):
+        """
+        Report an error event.
+
+        @param kind: Kind of error, e.g. 'transcript', 'download', 'video'.
+        @type kind: str
+
+        @param message: Error message, usually str(exception).
+        @type message: str
+
+        @param course: Name of the course the error belongs to.
+        @type course: str or None
+
+        @param course_dir: Output directory of the course, where the reports
+            are written. None for the working directory.
+        @type course_dir: str or None
+
+        @param report: Legacy text report (one of LEGACY_FORMATS) the error
+            is also written to.
+        @type report: str or None
+
+        @param details: (label, value) pairs describing the error.
+        @type details: [(str, str)]
+        """
+        if self._queue is None:
+            self.start()
+        self._queue.put({'time': time.time(),
+                         'pid': os.getpid(),
+                         'thread': threading.current_thread().name,
+                         'kind': kind,
+                         'message': message,
+                         'course': course,
+                         'course_dir': course_dir,
+                         'report': report,
+                         'details': [list(detail) for detail in details]})
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            flush = None
+            while True:
+                if event is _STOP:
+                    stopping = True
+                    break
+                if isinstance(event, tuple):
+                    flush = event
+                    break
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+            if flush is not None:
+                _, token, course_dirs = flush
+                self._write_summaries(course_dirs)
+                with self._flush_cond:
+                    self._flushed = token
+                    self._flush_cond.notify_all()
+
+    def _file(self, path):
+        f = self._files.get(path)
+        if f is None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            f = self._files[path] = open(path, 'a', encoding='utf-8')
+        return f
+
+    def _write_batch(self, batch):
+        for event in batch:
+            course_dir = event['course_dir'] or ''
+            self._file(os.path.join(course_dir, JSONL_FILENAME)).write(
+                json.dumps(event, ensure_ascii=False) + '\n')
+            if event['report'] in LEGACY_FORMATS:
+                self._file(os.path.join(course_dir, event['report'])).write(
+                    LEGACY_FORMATS[event['report']](event))
+
+            summary = self._summaries.setdefault(course_dir, {'course': event['course'],
+                                                              'total': 0,
+                                                              'by_kind': {},
+                                                              'by_language': {}})
+            summary['total'] += 1
+            summary['by_kind'][event['kind']] = summary['by_kind'].get(event['kind'], 0) + 1
+            for label, value in event['details']:
+                if label == 'language':
+                    summary['by_language'][value] = summary['by_language'].get(value, 0) + 1
+        for f in self._files.values():
+            f.flush()
+
+    def _write_summaries(self, course_dirs=None):
+        """
+        Write the summaries of the errors reported since the previous one
+        into course_dirs (all by default) and close their report files.
+        """
+        course_dirs = sorted(self._summaries) if course_dirs is None else course_dirs
+        for course_dir in course_dirs:
+            summary = self._summaries.pop(course_dir, None)
+            if summary is not None:
+                with open(os.path.join(course_dir, SUMMARY_FILENAME), 'w', encoding='utf-8') as f:
+                    json.dump(summary, f, indent=4, sort_keys=True)
+                logging.warning('%d error(s) in %s: %s', summary['total'],
+                                summary['course'] or 'the working directory',
+                                ', '.join('%s %d' % item for item in sorted(summary['by_kind'].items())))
+            for path in [path for path in self._files if os.path.dirname(path) == course_dir]:
+                self._files.pop(path).close()
+
+    def flush(self, course_dirs=None):
+        """
+        Wait for the events reported so far to be written, then write the
+        error summaries of course_dirs (the output directories of the
+        courses of a crawl, all by default) and close their report files, so
+        that long-running processes (daemon, watch) get a summary per crawl.
+        """
+        with self._lock:
+            if self._writer is None:
+                return
+            self._flushes += 1
+            token = self._flushes
+            self._queue.put(('flush', token, None if course_dirs is None else list(course_dirs)))
+        with self._flush_cond:
+            while self._flushed < token:
+                self._flush_cond.wait()
+
+    def close(self):
+        """
+        Write the pending events, close the reports and write the remaining
+        per-course summaries.
+        """
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        self._queue.put(_STOP)
+        writer.join()
+        self._queue = None
+        self._write_summaries()
+
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+ERRORS = ErrorSink()
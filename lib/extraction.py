@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Extraction of the records of the units of a course: the text of the html
+blocks, the text and type of the problems, the component types and the
+metadata of the videos.
+
+The crawler extracts the units of the subsection pages as it fetches them,
+and lib.reextract extracts again the units kept in the archives of previous
+crawls, with the same functions.
+
+Usage:
+
+  >>> from lib.extraction import crawl_units, extract_unit
+  >>> for unit in crawl_units(subsection_soup.find("div", {"class": "container"})):
+  ...     record = extract_unit(unit.prettify(formatter=None), {'html', 'problem'})
+"""
+
+import argparse
+import json
+
+from bs4 import BeautifulSoup
+
+from .blockcache import identify
+from .metrics import METRICS, instrumented
+from .textextract import HTML_TAGS, PROBLEM_TAGS, extract_structure, extract_text
+from .tracing import TRACER, traced
+
+
+# --components names of the data-block-type of the extracted components
+COMPONENTS = {
+    'text': 'html',
+    'problem': 'problem',
+    'video': 'video',
+}
+
+
+def comma_set(value):
+    return set(item.strip() for item in value.split(',') if item.strip())
+
+
+def parse_components(value):
+    """
+    Parse a --components value into the set of the component block types.
+    """
+    components = comma_set(value)
+    unknown = components - set(COMPONENTS)
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown components: %s (choose from %s)'
+                                         % (', '.join(sorted(unknown)), ', '.join(sorted(COMPONENTS))))
+    return set(COMPONENTS[component] for component in components)
+
+def crawl_units(subsection_page):
+    """
+    Return the unit elements (seq_contents_0, seq_contents_1, ...) of the
+    main content of a subsection page.
+    """
+    units = []
+    while True:
+        unit = subsection_page.find("div", {"id": "seq_contents_" + str(len(units))})
+        if unit is None:
+            return units
+        units.append(unit)
+
+
+def extract_problem_block(problem_comp, structure=False):
+    """
+    Return the text, the type and (with structure) the segments of a
+    problem block.
+    """
+    dict_soup = problem_comp.find(attrs={"data-content": True}).attrs    ## search no-html parser part
+    txt2html = BeautifulSoup(dict_soup["data-content"], 'html.parser')
+    each_problem_content = BeautifulSoup(txt2html.prettify(formatter=None), 'html.parser')  ## restore html parser
+    txt2html.decompose()
+    text = extract_text([each_problem_content], PROBLEM_TAGS)
+    segments = extract_structure([each_problem_content], PROBLEM_TAGS) if structure else None
+
+    ############################ search for type of problem(quiz) ######################################
+    #### from obseavation, multichoice & checkbox use the same clase. The difference lie into type of input option
+    ####                   fillblank & droplist use the same clase but different subclass
+    #### class has two attribute located at the 4th layer ('div'), with attribute ['class'][<class> <subclass>]
+    try:
+        type_div_tmp = each_problem_content.findAll('div')[4]['class'][0]
+        if type_div_tmp == 'choicegroup':
+            multi_or_check = each_problem_content.findAll('input')[0].attrs['type']
+            if multi_or_check == 'checkbox':
+                type_div_tmp = 'checkbox'
+            else:
+                type_div_tmp = 'multichoice'
+        elif type_div_tmp == 'inputtype':
+            if each_problem_content.findAll('div')[4]['class'][1] == 'option-input':
+                type_div_tmp = 'droplist'
+            else:
+                type_div_tmp = 'fillblank'
+    except KeyError:
+        type_div_tmp = 'N/A'
+    each_problem_content.decompose()
+    return text, type_div_tmp, segments
+
+
+@instrumented('extract_problem_comp')
+@traced('extract')
+def extract_problem_comp(soup, structure=False, block_cache=None):
+    """
+    Return the text, the types and (with structure) the segments of the
+    problem blocks of the unit soup. The blocks found in block_cache are not
+    extracted again.
+    """
+    texts = []
+    type_div = []
+    segments = [] if structure else None
+    problem_flag = soup.findAll("div", {"data-block-type": "problem"})  ## filter problem component
+    for problem_comp in problem_flag:
+        # problems already extracted from the same block are reused
+        ident = block_cache.identify(problem_comp) if block_cache is not None else None
+        cached = block_cache.get(ident, 'problem', ('segments',) if structure else ()) if block_cache is not None else None
+        if cached is None:
+            text, type_div_tmp, block_segments = extract_problem_block(problem_comp, structure)
+            cached = {'text': text, 'type': type_div_tmp}
+            if structure:
+                cached['segments'] = block_segments
+            if block_cache is not None:
+                block_cache.put(ident, 'problem', cached)
+        if cached['text']:
+            texts.append(cached['text'])
+        type_div.append(cached['type'])   ## append all list of problem types into type_div
+        if structure:
+            segments.extend(cached['segments'])
+    return ' '.join(texts), type_div, segments
+
+
+def extract_video_metadata(soup, identities=False):
+    """
+    Return the metadata (dict) of every video component of the unit soup,
+    and (with identities) their identity in the block cache.
+    """
+    video_flag = soup.findAll("div", {"data-block-type": "video"})
+    return [(json.loads(video_comp.find('div', {"data-metadata": True})['data-metadata']),
+             identify(video_comp) if identities else None)
+            for video_comp in video_flag]
+
+
+def extract_unit(html, components, text_structure=False, block_cache=None, video_identities=False):
+    """
+    Extract the record of a unit from its html (as archived): its html,
+    title, text, problems, component types and the metadata of its videos,
+    for the block types of components. The blocks found in block_cache are
+    not extracted again; the identities of the videos in the cache are
+    returned with block_cache or video_identities.
+    """
+    TRACER.set_context(unit=None)
+    record = {'html': html}
+
+    with METRICS.timed('parse_unit'), TRACER.span('parse_unit', 'parse'):
+        soup = BeautifulSoup(html, "html.parser")
+    METRICS.inc('units_total')
+
+    cur_unit = soup.find("h2", {"class": "hd hd-2 unit-title"}).getText()
+    if cur_unit == None:
+        cur_unit = 'Untitled'
+    record['unit'] = cur_unit
+    TRACER.set_context(unit=cur_unit.strip())
+
+    # select only html componert (disregard video, problem)
+    html_flag = soup.findAll("div", {"data-block-type": "html"}) if 'html' in components else []
+    record['text'] = None
+    if len(html_flag) > 0:
+        texts = []
+        structure = []
+        with METRICS.timed('extract_html_text'), TRACER.span('extract_html_text', 'extract'):
+            for block in html_flag:
+                # the text already extracted from the same block is reused
+                ident = block_cache.identify(block) if block_cache is not None else None
+                cached = block_cache.get(ident, 'html', ('structure',) if text_structure else ()) if block_cache is not None else None
+                if cached is None:
+                    cached = {'text': extract_text([block], HTML_TAGS)}
+                    if text_structure:
+                        cached['structure'] = extract_structure([block], HTML_TAGS)
+                    if block_cache is not None:
+                        block_cache.put(ident, 'html', cached)
+                if cached['text']:
+                    texts.append(cached['text'])
+                if text_structure:
+                    structure.extend(cached['structure'])
+        record['text'] = ' '.join(texts)
+        if text_structure:
+            record['text_structure'] = structure
+
+    # select only problem componert (disregard video, text)
+    if 'problem' in components:
+        record['problem'], record['problem_types'], record['problem_structure'] = extract_problem_comp(soup, text_structure, block_cache)
+    else:
+        record['problem'], record['problem_types'], record['problem_structure'] = '', [], None
+
+    # the videos are extracted by separate tasks (durations and transcripts
+    # are fetched from other hosts)
+    record['videos'] = extract_video_metadata(soup, block_cache is not None or video_identities) if 'video' in components else []
+
+    record['components'] = []
+    for comp_type in soup.findAll("div", {"data-block-type": True}):
+        METRICS.inc('blocks_total', type=comp_type['data-block-type'])
+        if comp_type['data-block-type'] in components:
+            record['components'].append(comp_type['data-block-type'])
+
+    # the records of the unit are emitted, free its tree
+    soup.decompose()
+    return record
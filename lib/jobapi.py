@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+"""
+Job queue and local HTTP API of the crawler daemon (--daemon).
+
+The daemon keeps its session, caches and scheduler across jobs. Jobs are
+JSON objects, submitted one per line (JSONL) or as a JSON array:
+
+  {"id": "geo-2t2016", "course_urls": ["https://courses.edx.org/courses/.../course/"],
+   "options": {"html_dir": "HTMLs/geo", "components": "text,problem"}}
+
+The API listens on a TCP address (host:port, the loopback by default) or on a
+Unix socket (unix:/path/to/socket):
+
+  POST   /jobs        submit the jobs of the body, returns their status
+  GET    /jobs        status of all the jobs
+  GET    /jobs/<id>   status, result and metrics (requests, bytes, errors,
+                      latencies) of a job
+  GET    /jobs/<id>/metrics   metrics of a job (Prometheus text format)
+  DELETE /jobs/<id>   cancel a queued job
+  GET    /metrics     metrics of the daemon, all the jobs together
+                      (Prometheus text format)
+  GET    /health      liveness
+
+Jobs writing the same outputs (e.g. the same course into the same html dir)
+are not run at the same time: a queued job waits for the running jobs it
+shares an output with, and the next jobs of the queue run meanwhile.
+
+  curl --data-binary @jobs.jsonl http://127.0.0.1:8765/jobs
+  curl --unix-socket /tmp/edx-crawler.sock http://localhost/jobs/geo-2t2016
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn, UnixStreamServer
+
+from .metrics import METRICS, Metrics
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobError(Exception):
+    """
+    Invalid job or request, status is the HTTP status of the error.
+    """
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Job(object):
+    """
+    A crawl job and its state.
+    """
+
+    def __init__(self, job_id, spec, prepared, outputs=()):
+        self.id = job_id
+        self.spec = spec
+        self.prepared = prepared
+        self.outputs = frozenset(outputs)
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        # counters and histograms recorded by the job, see Metrics.scope
+        self.metrics = None
+
+    def describe(self, metrics=False):
+        elapsed = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        description = {
+            'id': self.id,
+            'status': self.status,
+            'course_urls': self.spec['course_urls'],
+            'options': self.spec.get('options', {}),
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'elapsed_seconds': elapsed,
+            'result': self.result,
+            'error': self.error,
+        }
+        if metrics:
+            description['metrics'] = self.metrics.summary() if self.metrics is not None else None
+        return description
+
+
+def parse_jobs(text):
+    """
+    Return the job specs (dicts) of a JSON object, a JSON array or JSONL.
+    """
+    text = text.strip()
+    if not text:
+        return []
+    try:
+        specs = json.loads(text)
+    except ValueError:
+        try:
+            specs = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except ValueError as exception:
+            raise JobError('Invalid JSON or JSONL jobs: %s' % exception)
+    if isinstance(specs, dict):
+        specs = [specs]
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise JobError('A job must be a JSON object')
+        urls = spec.get('course_urls')
+        if not urls or not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            raise JobError('A job needs a non empty list of course_urls')
+        if not isinstance(spec.get('options', {}), dict):
+            raise JobError('The options of a job must be a JSON object')
+    return specs
+
+
+class JobQueue(object):
+    """
+    Runs the submitted jobs in order in a few job threads, one job at a time
+    per output.
+    """
+
+    def __init__(self, run, workers=2, prepare=None, outputs=None):
+        """
+        @param run: Function running a job, run(job) returns its result (a
+            JSON serializable dict).
+        @type run: callable
+
+        @param workers: Number of jobs run at the same time.
+        @type workers: int
+
+        @param prepare: Function validating a job spec when it is
+            submitted, prepare(spec) raises ValueError for invalid jobs and
+            returns the value set as job.prepared.
+        @type prepare: callable or None
+
+        @param outputs: Function returning the outputs written by a job,
+            outputs(prepared) returns hashable keys; the jobs sharing one
+            are run one after the other.
+        @type outputs: callable or None
+        """
+        self._run = run
+        self._prepare = prepare
+        self._outputs = outputs
+        self._jobs = OrderedDict()
+        self._queue = deque()
+        self._writing = set()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._ids = 0
+        self._threads = [threading.Thread(target=self._work, name='job-%d' % i, daemon=True)
+                         for i in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, spec):
+        """
+        Queue the job spec, return the job.
+        """
+        try:
+            prepared = self._prepare(spec) if self._prepare is not None else None
+        except ValueError as exception:
+            raise JobError('Invalid job %s: %s' % (spec.get('id', ''), exception))
+        outputs = self._outputs(prepared) if self._outputs is not None else ()
+        with self._cond:
+            if self._shutdown:
+                raise JobError('The daemon is shutting down', status=503)
+            job_id = spec.get('id')
+            if job_id is None:
+                self._ids += 1
+                job_id = 'job-%d' % self._ids
+                while job_id in self._jobs:
+                    self._ids += 1
+                    job_id = 'job-%d' % self._ids
+            job_id = str(job_id)
+            if job_id in self._jobs and self._jobs[job_id].status in (QUEUED, RUNNING):
+                raise JobError('Job %s is already %s' % (job_id, self._jobs[job_id].status), status=409)
+            job = self._jobs[job_id] = Job(job_id, spec, prepared, outputs)
+            self._jobs.move_to_end(job_id)
+            self._queue.append(job)
+            METRICS.set_gauge('queue_depth', len(self._queue), queue='jobs')
+            self._cond.notify()
+        logging.info('Job %s queued', job_id)
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise JobError('No job %s' % job_id, status=404)
+        return job
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued job, return it.
+        """
+        job = self.get(job_id)
+        with self._cond:
+            if job.status != QUEUED:
+                raise JobError('Job %s is %s, only queued jobs can be cancelled'
+                               % (job_id, job.status), status=409)
+            self._queue.remove(job)
+            job.status = CANCELLED
+            job.finished = time.time()
+            METRICS.set_gauge('queue_depth', len(self._queue), queue='jobs')
+        return job
+
+    def _pop(self):
+        # called with self._cond held, return the first queued job writing
+        # no output of a running job
+        for job in self._queue:
+            if not job.outputs & self._writing:
+                self._queue.remove(job)
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._pop()
+                while job is None:
+                    if self._shutdown and not self._queue:
+                        return
+                    self._cond.wait()
+                    job = self._pop()
+                self._writing |= job.outputs
+                job.status = RUNNING
+                job.started = time.time()
+                job.metrics = Metrics()
+                METRICS.set_gauge('queue_depth', len(self._queue), queue='jobs')
+
+            logging.info('Job %s started', job.id)
+            try:
+                with METRICS.scope(job.metrics):
+                    result = self._run(job)
+            except BaseException as exception:
+                # a job calling exit() fails, but not the daemon
+                job.error = ('exit code %s' % exception.code if isinstance(exception, SystemExit)
+                             else '%s: %s' % (type(exception).__name__, exception))
+                job.status = FAILED
+                logging.error('Job %s failed: %s', job.id, job.error)
+            else:
+                job.result = result
+                job.status = DONE
+            job.finished = time.time()
+            with self._cond:
+                self._writing -= job.outputs
+                # the jobs waiting for these outputs can run
+                self._cond.notify_all()
+            METRICS.inc('jobs_total', status=job.status)
+            logging.info('Job %s %s in %.1fs', job.id, job.status, job.finished - job.started)
+
+    def shutdown(self, wait=True):
+        """
+        Cancel the queued jobs and wait for the running ones.
+        """
+        with self._cond:
+            self._shutdown = True
+            for job in self._queue:
+                job.status = CANCELLED
+            self._queue.clear()
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'edx-crawler'
+
+    def address_string(self):
+        # no client address on Unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug('%s - ' + format, self.address_string(), *args)
+
+    def _send(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body, indent=2, sort_keys=True) + '\n'
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method):
+        queue = self.server.queue
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'jobs': len(queue.jobs())}
+        if method == 'GET' and path == '/metrics':
+            return 200, METRICS.to_prometheus()
+        if path == '/jobs':
+            if method == 'GET':
+                return 200, [job.describe() for job in queue.jobs()]
+            if method == 'POST':
+                length = int(self.headers.get('Content-Length') or 0)
+                specs = parse_jobs(self.rfile.read(length).decode('utf-8'))
+                return 202, [queue.submit(spec).describe() for spec in specs]
+        if method == 'GET' and path.startswith('/jobs/') and path.endswith('/metrics'):
+            job = queue.get(path[len('/jobs/'):-len('/metrics')])
+            return 200, job.metrics.to_prometheus() if job.metrics is not None else ''
+        if path.startswith('/jobs/'):
+            job_id = path[len('/jobs/'):]
+            if method == 'GET':
+                return 200, queue.get(job_id).describe(metrics=True)
+            if method == 'DELETE':
+                return 200, queue.cancel(job_id).describe()
+        raise JobError('No route %s %s' % (method, self.path), status=404)
+
+    def _handle(self, method):
+        try:
+            status, body = self._route(method)
+        except JobError as exception:
+            status, body = exception.status, {'error': str(exception)}
+        self._send(status, body, 'text/plain' if isinstance(body, str) else 'application/json')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _TCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def serve(address, queue):
+    """
+    Return the API server of queue listening on address (host:port, :port
+    on the loopback, or unix:/path), run it with serve_forever().
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = _UnixServer(path, _Handler)
+        # the API crawls with the account of the daemon
+        os.chmod(path, 0o600)
+    else:
+        host, _, port = address.rpartition(':')
+        server = _TCPServer((host or '127.0.0.1', int(port)), _Handler)
+        if server.server_address[0] not in ('127.0.0.1', '::1'):
+            logging.warning('The job API listens on %s, it is reachable from other hosts', address)
+    server.queue = queue
+    return server
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming writer and reader of the JSON outputs (all_textcomp.json,
+all_videocomp.json, ...).
+
+The outputs are dicts of block records. They are written one record at a
+time, so the whole document is never built in memory, optionally compressed
+(gzip or zstd, a .gz or .zst suffix is appended to the file name) and
+optionally compact (no indentation, non-ASCII characters kept as UTF-8).
+Without compression nor compact mode the output is byte for byte the
+historical pretty-printed one.
+
+Readers detect the compression from the magic bytes of the file:
+
+  >>> from lib.jsonio import load_json
+  >>> videos = load_json('HTMLs/Course_Name/all_videocomp.json.zst')
+"""
+
+import gzip
+import io
+import json
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+
+COMPRESSIONS = {
+    'none': '',
+    'gz': '.gz',
+    'zst': '.zst',
+}
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('zstd compression requires the zstandard module '
+                           '(pip install zstandard)')
+
+
+def open_output(path, compression='none', level=None):
+    """
+    Open path + the suffix of compression for writing text, return the file
+    and its path.
+    """
+    path += COMPRESSIONS[compression]
+    if compression == 'gz':
+        return gzip.open(path, 'wt', encoding='utf-8',
+                         compresslevel=6 if level is None else level), path
+    if compression == 'zst':
+        _require_zstandard()
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        raw = compressor.stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(raw, encoding='utf-8'), path
+    return open(path, 'w', encoding='utf-8'), path
+
+
+def open_input(path):
+    """
+    Open path for reading text, decompressing it if it is gzip or zstd.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if magic.startswith(_ZSTD_MAGIC):
+        _require_zstandard()
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(raw, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def write_records(f, records, compact=False):
+    """
+    Write the dict records into the text file f, one record at a time and
+    sorted by key.
+    """
+    if not records:
+        f.write('{}')
+        return
+    if compact:
+        separator = ','
+        f.write('{')
+        for i, key in enumerate(sorted(records)):
+            if i:
+                f.write(separator)
+            f.write(json.dumps(key, ensure_ascii=False))
+            f.write(':')
+            f.write(json.dumps(records[key], sort_keys=True, ensure_ascii=False,
+                               separators=(',', ':')))
+        f.write('}')
+        return
+
+    # same bytes as json.dumps(records, sort_keys=True, indent=4,
+    # separators=(',', ': ')); record values never contain raw newlines
+    f.write('{\n')
+    for i, key in enumerate(sorted(records)):
+        if i:
+            f.write(',\n')
+        f.write('    ')
+        f.write(json.dumps(key))
+        f.write(': ')
+        f.write(json.dumps(records[key], sort_keys=True, indent=4,
+                           separators=(',', ': ')).replace('\n', '\n    '))
+    f.write('\n}')
+
+
+def write_json(records, path, compression='none', compact=False):
+    """
+    Write the dict records into path (plus the compression suffix), return
+    the path written.
+    """
+    f, path = open_output(path, compression)
+    with f:
+        write_records(f, records, compact)
+    return path
+
+
+def load_json(path):
+    """
+    Read a JSON output written by write_json, compressed or not.
+    """
+    with open_input(path) as f:
+        return json.load(f)
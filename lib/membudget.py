@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory budget of the crawler.
+
+Two limits can be set, both disabled by default:
+
+* max_inflight_bytes caps the total size of the pages held at the same time
+  by the fetch and parse stages (rather than their number). A fetch waits
+  until the estimated size of its page (the average of the pages fetched so
+  far) fits, and its reservation is then adjusted to the real size.
+* rss_limit is a budget for the resident memory of the process. When it is
+  exceeded, the fetch stages stop (backpressure) until the memory goes back
+  under the limit or max_wait seconds have passed, so that many crawler
+  processes can share a host.
+
+Usage:
+
+  >>> from lib.membudget import MEMORY
+  >>> MEMORY.configure(rss_limit=512 * 2 ** 20, max_inflight_bytes=64 * 2 ** 20)
+  >>> with MEMORY.hold() as held:
+  ...     held.reserve()
+  ...     page = get_page_contents(url, headers)
+  ...     held.add(len(page))
+  ...     ...
+"""
+
+import gc
+import logging
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc is used on Linux
+    psutil = None
+
+from .metrics import METRICS
+
+
+_UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+# estimated size of a page before the first one is fetched
+_DEFAULT_PAGE_SIZE = 256 * 2 ** 10
+
+
+def parse_size(text):
+    """
+    Parse a size such as '512M', '2G' or '1048576' into bytes.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$', str(text), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid size: %r' % text)
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def current_rss():
+    """
+    Return the resident memory of the process in bytes, or None if it
+    cannot be measured on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return None
+
+
+class _Held(object):
+    """
+    Bytes held by one hold() block.
+    """
+
+    __slots__ = ('budget', 'nbytes', 'reserved')
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.reserved = 0
+
+    def reserve(self):
+        """
+        Account the estimated size of the page about to be fetched, waiting
+        for it to fit in the in-flight budget.
+        """
+        nbytes = self.budget.page_estimate
+        self.budget.acquire(nbytes)
+        self.nbytes += nbytes
+        self.reserved = nbytes
+
+    def add(self, nbytes):
+        """
+        Account the nbytes of the page fetched: they replace the reservation
+        of the block without waiting (the page is already in memory), or
+        wait to fit in the in-flight budget without one. Call it once per
+        block: a block waiting for its own bytes could wait forever.
+        """
+        if self.reserved:
+            self.budget.adjust(self.reserved, nbytes)
+            self.nbytes += nbytes - self.reserved
+            self.reserved = 0
+        else:
+            self.budget.acquire(nbytes)
+            self.nbytes += nbytes
+
+
+class MemoryBudget(object):
+    """
+    In-flight bytes semaphore and resident memory governor. Use the module
+    level MEMORY instance.
+    """
+
+    def __init__(self):
+        self.rss_limit = None
+        self.max_inflight_bytes = None
+        self.max_wait = 60.0
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._warned = False
+        # moving average of the sizes of the fetched pages
+        self.page_estimate = _DEFAULT_PAGE_SIZE
+
+    @property
+    def enabled(self):
+        return bool(self.rss_limit or self.max_inflight_bytes)
+
+    def configure(self, rss_limit=None, max_inflight_bytes=None, max_wait=60.0):
+        """
+        @param rss_limit: Resident memory budget in bytes, None to disable.
+        @type rss_limit: int or None
+
+        @param max_inflight_bytes: Maximum bytes of pages held at the same
+            time, None to disable.
+        @type max_inflight_bytes: int or None
+
+        @param max_wait: Longest backpressure wait, in seconds, after which
+            the crawl goes on even over the budget (a single page can be
+            larger than the whole budget).
+        @type max_wait: float
+        """
+        if rss_limit and current_rss() is None:
+            logging.warning('Cannot measure the memory of the process, '
+                            'the memory budget is ignored.')
+            rss_limit = None
+        self.rss_limit = rss_limit
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_wait = max_wait
+
+    def throttle(self):
+        """
+        Wait while the resident memory is over the budget.
+        """
+        if not self.rss_limit:
+            return
+        rss = current_rss()
+        METRICS.set_gauge('rss_bytes', rss)
+        if rss <= self.rss_limit:
+            return
+
+        # the parse trees released so far may only wait for the collector
+        gc.collect()
+        start = time.perf_counter()
+        rss = current_rss()
+        while rss > self.rss_limit and time.perf_counter() - start < self.max_wait:
+            with self._cond:
+                self._cond.wait(0.1)
+            rss = current_rss()
+        METRICS.inc('backpressure_seconds_total', time.perf_counter() - start, limit='rss')
+        METRICS.set_gauge('rss_bytes', rss)
+        if rss > self.rss_limit and not self._warned:
+            self._warned = True
+            logging.warning('The process uses %d MiB, over the memory budget of %d MiB.',
+                            rss // 2 ** 20, self.rss_limit // 2 ** 20)
+
+    def acquire(self, nbytes):
+        """
+        Wait until nbytes fit in the in-flight budget and account them. A
+        page larger than the whole budget is admitted alone.
+        """
+        if not self.max_inflight_bytes:
+            return
+        waited = 0.0
+        with self._cond:
+            if self._inflight and self._inflight + nbytes > self.max_inflight_bytes:
+                start = time.perf_counter()
+                while self._inflight and self._inflight + nbytes > self.max_inflight_bytes:
+                    self._cond.wait()
+                waited = time.perf_counter() - start
+            self._inflight += nbytes
+            METRICS.set_gauge('inflight_bytes', self._inflight)
+        if waited:
+            METRICS.inc('backpressure_seconds_total', waited, limit='inflight')
+
+    def adjust(self, reserved, nbytes):
+        """
+        Replace the reserved bytes of a fetch by the nbytes of its page,
+        without waiting.
+        """
+        if not self.max_inflight_bytes:
+            return
+        with self._cond:
+            self.page_estimate = int(0.8 * self.page_estimate + 0.2 * nbytes) or 1
+            self._inflight += nbytes - reserved
+            METRICS.set_gauge('inflight_bytes', self._inflight)
+            if nbytes < reserved:
+                self._cond.notify_all()
+
+    def release(self, nbytes):
+        """
+        Give back nbytes accounted by acquire.
+        """
+        if not self.max_inflight_bytes:
+            return
+        with self._cond:
+            self._inflight -= nbytes
+            METRICS.set_gauge('inflight_bytes', self._inflight)
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self):
+        """
+        Context manager for a fetch stage: waits for the memory to be under
+        the budget, then yields an object whose add(nbytes) accounts the
+        page fetched. The bytes are released when the block exits.
+        """
+        self.throttle()
+        held = _Held(self)
+        try:
+            yield held
+        finally:
+            if held.nbytes:
+                self.release(held.nbytes)
+
+
+MEMORY = MemoryBudget()
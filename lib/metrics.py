@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counters, gauges and latency histograms for the crawler.
+
+All the crawler modules record into the module level registry METRICS, which
+is written at exit as a Prometheus text-format file (metrics.prom) and a JSON
+summary (metrics.json) when --metrics-dir is given.
+
+Usage:
+
+  >>> from lib.metrics import METRICS, instrumented
+  >>> METRICS.inc('units_total')
+  >>> with METRICS.timed('extract_units'):
+  ...     ...
+  >>> @instrumented('videolen')
+  ... def videolen(yt_link):
+  ...     ...
+
+The counters and histograms recorded by a thread can also be recorded into
+another registry, e.g. the metrics of a daemon job, with METRICS.scope(); the
+functions it hands to other threads keep the scope with METRICS.bind():
+
+  >>> with METRICS.scope(Metrics()) as job_metrics:
+  ...     scheduler.submit(METRICS.bind(get_page_contents), url, headers)
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+PREFIX = 'edx_crawler_'
+
+# upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HELP = {
+    'requests_total': 'HTTP requests sent, by host',
+    'response_bytes_total': 'Bytes of HTTP responses read, by host',
+    'request_seconds': 'HTTP request latency, by host',
+    'stage_seconds': 'Latency of the crawler stages',
+    'errors_total': 'Errors, by stage and kind (exception class)',
+    'units_total': 'Units extracted',
+    'blocks_total': 'Blocks extracted, by type',
+    'queue_depth': 'Work items waiting, by queue',
+    'session_renewals_total': 'Logins done again after the session expired',
+    'rss_bytes': 'Resident memory of the process (with a memory budget)',
+    'inflight_bytes': 'Bytes of the pages held by the fetch and parse stages',
+    'backpressure_seconds_total': 'Time the fetch stages waited for memory, by limit',
+    'block_cache_total': 'Block extraction cache lookups, by block type and result',
+    'jobs_total': 'Daemon jobs finished, by status',
+    'not_modified_total': 'Conditional requests answered 304 Not Modified, by host',
+    'watch_polls_total': 'Polls of the watched courses',
+    'watch_changes_total': 'Components changed between two polls, by change',
+    'connections_total': 'HTTP connections opened by the pooled transport, by host',
+    'transport_requests_total': 'Requests of the pooled and http2 transports, by HTTP version',
+    'warc_records_total': 'WARC records written (record), read (replay) or missing (miss)',
+    'downloads_total': 'Files of --download-dir downloaded, already stored (cached) or failed',
+    'download_segments_total': 'Range segments downloaded (fetched) or found complete on disk (resumed)',
+    'download_bytes_total': 'Bytes of the files of --download-dir downloaded, by host',
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels_key, extra=()):
+    items = list(labels_key) + list(extra)
+    if not items:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                            .replace('\n', '\\n').replace('"', '\\"'))
+               for k, v in items]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return [(upper bound, cumulative count)] including +Inf.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append((float('inf'), self.count))
+        return result
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters, gauges and histograms. Every metric
+    can carry labels given as keyword arguments.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def _scopes(self):
+        return getattr(self._local, 'scopes', ())
+
+    @contextmanager
+    def scope(self, metrics):
+        """
+        Also record the counters and histograms of the calling thread into
+        the registry metrics while the block runs (the gauges describe the
+        process and are not copied).
+        """
+        previous = self._scopes()
+        self._local.scopes = previous + (metrics,)
+        try:
+            yield metrics
+        finally:
+            self._local.scopes = previous
+
+    def bind(self, func):
+        """
+        Return func running in the scopes of the calling thread, for the
+        work it hands to other threads.
+        """
+        scopes = self._scopes()
+        if not scopes:
+            return func
+
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            previous = self._scopes()
+            self._local.scopes = scopes
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.scopes = previous
+        return bound
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter name by value.
+        """
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        for metrics in self._scopes():
+            metrics.inc(name, value, **labels)
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set the gauge name to value.
+        """
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Record value into the histogram name.
+        """
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+        for metrics in self._scopes():
+            metrics.observe(name, value, **labels)
+
+    def error(self, stage, exception):
+        """
+        Count an error of the given stage by the class of exception.
+        """
+        self.inc('errors_total', stage=stage, kind=type(exception).__name__)
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        """
+        Context manager recording the duration of its block in the
+        stage_seconds histogram, and any exception raised in errors_total.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as exception:
+            self.error(stage, exception)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start,
+                         stage=stage, **labels)
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def _header(name, kind):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, HELP.get(name, name)))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+
+        with self._lock:
+            for name in sorted(self._counters):
+                _header(name, 'counter')
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append('%s%s%s %s' % (PREFIX, name, _format_labels(key),
+                                                _format_value(value)))
+            for name in sorted(self._gauges):
+                _header(name, 'gauge')
+                for key, value in sorted(self._gauges[name].items()):
+                    lines.append('%s%s%s %s' % (PREFIX, name, _format_labels(key),
+                                                _format_value(value)))
+            for name in sorted(self._histograms):
+                _header(name, 'histogram')
+                for key, histogram in sorted(self._histograms[name].items()):
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s%s_bucket%s %d' % (
+                            PREFIX, name,
+                            _format_labels(key, [('le', _format_value(bound))]),
+                            count))
+                    lines.append('%s%s_sum%s %s' % (PREFIX, name, _format_labels(key),
+                                                    _format_value(histogram.sum)))
+                    lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(key),
+                                                      histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Return a JSON serializable summary of the metrics.
+        """
+        elapsed = time.time() - self.started
+
+        def _series(metrics, convert):
+            return {name: [dict(labels=dict(key), **convert(value))
+                           for key, value in sorted(series.items())]
+                    for name, series in sorted(metrics.items())}
+
+        def _histogram(histogram):
+            return {'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count if histogram.count else 0.0,
+                    'buckets': [[_format_value(bound), count]
+                                for bound, count in histogram.cumulative()]}
+
+        with self._lock:
+            units = sum(self._counters.get('units_total', {}).values())
+            return {
+                'started': self.started,
+                'elapsed_seconds': elapsed,
+                'units_per_second': units / elapsed if elapsed > 0 else 0.0,
+                'counters': _series(self._counters, lambda v: {'value': v}),
+                'gauges': _series(self._gauges, lambda v: {'value': v}),
+                'histograms': _series(self._histograms, _histogram),
+            }
+
+    def write(self, directory):
+        """
+        Write metrics.prom and metrics.json into directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'metrics.prom'), 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        with open(os.path.join(directory, 'metrics.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+
+METRICS = Metrics()
+
+
+def instrumented(stage):
+    """
+    Decorator timing every call of the decorated function as stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
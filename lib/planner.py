@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Crawl planner of --plan: sizes a crawl from the course outlines only.
+
+The plan counts the sections and subsections of the selected courses, and
+estimates their units, blocks, requests, bytes and time from the metrics of
+previous crawls (metrics.json of --metrics-dir). The rates are taken per
+subsection, since a subsection page is the unit of work of the crawler.
+Subsections already in the local output of a course (its metadata.csv) are
+marked as cached, and their units and blocks are counted exactly.
+
+Usage:
+
+  >>> from lib.planner import History, build_plan, write_plan
+  >>> history = History.load(['metrics/metrics.json'])
+  >>> plan = build_plan(selections, 'HTMLs', history, workers=16, per_course=4)
+  >>> write_plan(plan, 'plan.json')
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import time
+
+from .archive import ARCHIVE_FORMATS, UnitArchiveReader, archive_filename, has_index
+from .jsonio import COMPRESSIONS, load_json
+from .utils import directory_name
+
+
+METADATA_FILENAME = 'metadata.csv'
+METRICS_FILENAME = 'metrics.json'
+
+# stages doing work outside of the http requests (already in request_seconds)
+WORK_STAGES = ('parse_subsection', 'parse_unit', 'extract_units', 'extract_html_text',
+               'extract_problem_comp', 'videolen', 'YT_transcript',
+               'extract_duration_from_non_YT_video', 'write_archive')
+
+
+def _counter_values(summary, name, label=None):
+    values = {}
+    for series in summary.get('counters', {}).get(name, []):
+        key = series['labels'].get(label) if label else None
+        values[key] = values.get(key, 0) + series['value']
+    return values
+
+
+def _histograms(summary, name, label):
+    return {series['labels'].get(label): (series['count'], series['sum'])
+            for series in summary.get('histograms', {}).get(name, [])}
+
+
+class History(object):
+    """
+    Per subsection rates of previous crawls, summed over their metrics.json.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.subsections = 0
+        self.elapsed_seconds = 0.0
+        self.units = 0
+        self.blocks = {}
+        self.requests = {}
+        self.response_bytes = {}
+        self.request_seconds = {}
+        self.work_seconds = 0.0
+
+    @classmethod
+    def load(cls, paths):
+        """
+        Read the metrics.json files (or the metrics directories) in paths.
+        Missing files and runs without any subsection are skipped.
+        """
+        history = cls()
+        for path in paths:
+            if os.path.isdir(path):
+                path = os.path.join(path, METRICS_FILENAME)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    summary = json.load(f)
+            except (IOError, ValueError) as exception:
+                logging.warning('Skipping the crawl history %s: %s', path, exception)
+                continue
+            history.add(summary)
+        return history
+
+    def add(self, summary):
+        """
+        Add the metrics summary of a run (see Metrics.summary).
+        """
+        stages = _histograms(summary, 'stage_seconds', 'stage')
+        # every subsection page goes through extract_units once
+        subsections = stages.get('extract_units', (0, 0.0))[0]
+        if not subsections:
+            return
+        self.runs += 1
+        self.subsections += subsections
+        self.elapsed_seconds += summary.get('elapsed_seconds', 0.0)
+        self.units += sum(_counter_values(summary, 'units_total').values())
+        for values, name, label in ((self.blocks, 'blocks_total', 'type'),
+                                    (self.requests, 'requests_total', 'host'),
+                                    (self.response_bytes, 'response_bytes_total', 'host')):
+            for key, value in _counter_values(summary, name, label).items():
+                values[key] = values.get(key, 0) + value
+        for host, (count, seconds) in _histograms(summary, 'request_seconds', 'host').items():
+            self.request_seconds[host] = self.request_seconds.get(host, 0.0) + seconds
+        for stage in WORK_STAGES:
+            self.work_seconds += stages.get(stage, (0, 0.0))[1]
+
+    def __bool__(self):
+        return self.subsections > 0
+
+    def per_subsection(self, values):
+        return {key: float(value) / self.subsections for key, value in values.items()}
+
+    def estimate(self, subsections):
+        """
+        Return the estimates (units, blocks, requests, bytes and seconds of
+        work of one worker) of crawling subsections subsections.
+        """
+        requests = self.per_subsection(self.requests)
+        seconds = sum(self.request_seconds.values()) + self.work_seconds
+        return {
+            'units': subsections * float(self.units) / self.subsections,
+            'blocks': {key: subsections * value for key, value in self.per_subsection(self.blocks).items()},
+            'requests': {key: subsections * value for key, value in requests.items()},
+            'bytes': subsections * float(sum(self.response_bytes.values())) / self.subsections,
+            'work_seconds': subsections * seconds / self.subsections,
+        }
+
+    def describe(self):
+        return {
+            'runs': self.runs,
+            'subsections': self.subsections,
+            'units_per_subsection': float(self.units) / self.subsections if self else None,
+            'seconds_per_subsection': self.elapsed_seconds / self.subsections if self else None,
+        }
+
+
+def _read_metadata(course_dir):
+    """
+    Return the rows of the metadata.csv of a crawled course (in the course
+    directory with a blob store, in the archive otherwise), None when the
+    course has not been crawled.
+    """
+    path = os.path.join(course_dir, METADATA_FILENAME)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8', newline='') as f:
+            return list(csv.DictReader(f))
+    for archive_format in sorted(ARCHIVE_FORMATS):
+        path = os.path.join(course_dir, archive_filename('sourcefile', archive_format))
+        if has_index(path):
+            reader = UnitArchiveReader(path)
+            if METADATA_FILENAME in reader.members:
+                content = reader.read(METADATA_FILENAME).decode('utf-8')
+                return list(csv.DictReader(io.StringIO(content, newline='')))
+    return None
+
+
+def _read_components(course_dir):
+    for suffix in COMPRESSIONS.values():
+        path = os.path.join(course_dir, 'all_comp.json' + suffix)
+        if os.path.exists(path):
+            return load_json(path)
+    return {}
+
+
+def cached_subsections(course_dir):
+    """
+    Return {(section, subsection): {'units': n, 'blocks': {type: n}}} of the
+    subsections in the local output of a course.
+    """
+    rows = _read_metadata(course_dir)
+    if rows is None:
+        return {}
+    cached = {}
+    for row in rows:
+        entry = cached.setdefault((row['section'], row['subsection']), {'units': 0, 'blocks': {}})
+        entry['units'] += 1
+    for component in _read_components(course_dir).values():
+        entry = cached.get((component['section'], component['subsection']))
+        if entry is not None:
+            entry['blocks'][component['type']] = entry['blocks'].get(component['type'], 0) + 1
+    return cached
+
+
+def _add(totals, values):
+    for key, value in values.items():
+        if isinstance(value, dict):
+            _add(totals.setdefault(key, {}), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _rounded(values):
+    if isinstance(values, dict):
+        return {key: _rounded(value) for key, value in values.items()}
+    if isinstance(values, float):
+        return round(values, 3)
+    return values
+
+
+def build_plan(selections, html_dir, history, workers=16, per_course=None):
+    """
+    Return the plan (a JSON serializable dict) of crawling selections, a
+    dict {Course: [Section]} from the course outlines.
+    """
+    courses = []
+    totals = {'courses': 0, 'sections': 0, 'subsections': 0, 'cached_subsections': 0,
+              'cached': {'units': 0, 'blocks': {}}}
+    estimated = {}
+    remaining = {}
+    for course, sections in selections.items():
+        coursename = directory_name(course.name)
+        course_dir = os.path.join(html_dir, coursename)
+        cached = cached_subsections(course_dir)
+        course_plan = {'name': course.name, 'url': course.url, 'directory': course_dir,
+                       'crawled': bool(cached), 'sections': []}
+        course_estimated = {}
+        course_remaining = {}
+        course_cached = {'units': 0, 'blocks': {}}
+        subsections = cached_count = 0
+        for section in sections:
+            section_dirname = "%02d-%s" % (section.position, section.name)
+            section_plan = {'name': section_dirname, 'subsections': []}
+            for subsection in section.subsections:
+                name = subsection.name if subsection.name is not None else 'Untitled'
+                entry = cached.get((section_dirname, name))
+                subsection_plan = {'name': name, 'url': subsection.url, 'cached': entry is not None}
+                if entry is not None:
+                    subsection_plan.update(entry)
+                    _add(course_cached, entry)
+                    cached_count += 1
+                subsections += 1
+                section_plan['subsections'].append(subsection_plan)
+            course_plan['sections'].append(section_plan)
+
+        if history:
+            course_estimated = history.estimate(subsections)
+            course_remaining = history.estimate(subsections - cached_count)
+            # the units and blocks of the cached subsections are known
+            course_estimated['units'] = course_remaining['units']
+            course_estimated['blocks'] = dict(course_remaining['blocks'])
+            _add(course_estimated, course_cached)
+        course_plan.update({'subsection_count': subsections, 'cached_subsections': cached_count,
+                            'cached': course_cached,
+                            'estimated': _rounded(course_estimated),
+                            'remaining': _rounded(course_remaining)})
+        courses.append(course_plan)
+
+        totals['courses'] += 1
+        totals['sections'] += len(sections)
+        totals['subsections'] += subsections
+        totals['cached_subsections'] += cached_count
+        _add(totals['cached'], course_cached)
+        _add(estimated, course_estimated)
+        _add(remaining, course_remaining)
+
+    if history:
+        # the courses share the workers: a course runs at most per_course
+        # tasks at a time while the others have work, and all the workers
+        # once it is the last one (see lib.scheduler), so none is idle
+        estimated['seconds'] = estimated['work_seconds'] / workers
+        remaining['seconds'] = remaining['work_seconds'] / workers
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'workers': workers,
+        'per_course': per_course,
+        'history': history.describe(),
+        'totals': totals,
+        'estimated': _rounded(estimated),
+        'remaining': _rounded(remaining),
+        'courses': courses,
+    }
+
+
+def write_plan(plan, path):
+    """
+    Write the plan as JSON into path.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, indent=4, sort_keys=True)
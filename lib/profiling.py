@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in per-stage CPU and memory profiling of the crawler (--profile DIR).
+
+The crawler wraps each of its stages (login, dashboard, outline,
+unit_discovery, extraction, video, archiving, output, download) with
+PROFILER.stage().
+Stages nest, and the time and memory of a nested stage are attributed to it
+only, not to the enclosing stage. When the profiler is not started a stage
+costs a single attribute check.
+
+A sampling thread records the stacks of every thread, prefixed with their
+current stages, into the merged profile.collapsed file which can be rendered
+by flamegraph.pl or speedscope, and the wall and CPU time of every stage are
+written in a <stage>.txt report for each. This is the default mode, cheap
+enough to leave on; the costly collectors are opt-in:
+
+* cpu=True: a cProfile profile of the thread running the stage
+  (<stage>.pstats, and its top functions in the report),
+* memory_frames > 0: the memory allocated while the stage ran (tracemalloc)
+  and, for the coarse stages, the tracemalloc snapshot difference with the
+  previous snapshot (the allocations the stage left behind).
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+NO_STAGE = '(no stage)'
+
+
+class _StageStats(object):
+    __slots__ = ('calls', 'wall', 'cpu', 'allocated', 'peak', 'snapshot_diff')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.allocated = 0
+        self.peak = 0
+        self.snapshot_diff = None
+
+
+class _Frame(object):
+    """
+    A stage being run by a thread.
+    """
+    __slots__ = ('name', 'profile', 'wall', 'cpu', 'memory',
+                 'child_wall', 'child_cpu', 'child_memory')
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.memory = tracemalloc.get_traced_memory()[0]
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.child_memory = 0
+
+
+class Profiler(object):
+    """
+    Collects per-stage profiles. Use the module level PROFILER instance.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._profiles = []
+        self._thread_stages = {}
+        self._samples = {}
+        self._sampler = None
+        self._last_snapshot = None
+        self.cpu = False
+
+    def start(self, directory, interval=0.005, cpu=False, memory_frames=0):
+        """
+        Start profiling, reports will be written into directory.
+
+        @param interval: Seconds between two stack samples.
+        @type interval: float
+
+        @param cpu: Run cProfile in the stages.
+        @type cpu: bool
+
+        @param memory_frames: Number of frames kept by tracemalloc for each
+            allocation, 0 disables memory tracing.
+        @type memory_frames: int
+        """
+        self.directory = directory
+        self.cpu = cpu
+        os.makedirs(directory, exist_ok=True)
+        if memory_frames > 0:
+            tracemalloc.start(memory_frames)
+            self._last_snapshot = tracemalloc.take_snapshot()
+        self.enabled = True
+        self._sampler = threading.Thread(target=self._sample, args=(interval,),
+                                         name='profiler-sampler', daemon=True)
+        self._sampler.start()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._local.profiles = {}
+            with self._lock:
+                self._thread_stages[threading.get_ident()] = stack
+        return stack
+
+    def _enable(self, profile):
+        try:
+            profile.enable()
+            return True
+        except ValueError:
+            # only one thread can run cProfile at once on python >= 3.12,
+            # the sampler still attributes this thread's time to the stage
+            return False
+
+    @contextmanager
+    def stage(self, name, snapshot=False):
+        """
+        Attribute the time and memory spent in the block to the stage name.
+        With snapshot=True, a tracemalloc snapshot is taken at the end of the
+        block and compared with the previous one; only use it for stages
+        that run a few times per crawl.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        if stack and stack[-1].name == name:
+            # re-entering the current stage, e.g. extract_units run
+            # sequentially inside unit_discovery
+            yield
+            return
+
+        profile = None
+        if self.cpu:
+            profiles = self._local.profiles
+            profile = profiles.get(name)
+            if profile is None:
+                profile = profiles[name] = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append((name, profile))
+
+        if stack and stack[-1].profile is not None:
+            stack[-1].profile.disable()
+        frame = _Frame(name, profile if profile is not None and self._enable(profile) else None)
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            if frame.profile is not None:
+                frame.profile.disable()
+            stack.pop()
+
+            wall = time.perf_counter() - frame.wall
+            cpu = time.thread_time() - frame.cpu
+            memory, peak = tracemalloc.get_traced_memory()
+            allocated = memory - frame.memory
+            if stack:
+                parent = stack[-1]
+                parent.child_wall += wall
+                parent.child_cpu += cpu
+                parent.child_memory += allocated
+                if parent.profile is not None and not self._enable(parent.profile):
+                    parent.profile = None
+
+            diff = None
+            if snapshot and tracemalloc.is_tracing():
+                current = tracemalloc.take_snapshot()
+                with self._lock:
+                    previous, self._last_snapshot = self._last_snapshot, current
+                diff = current.compare_to(previous, 'lineno')[:15]
+
+            with self._lock:
+                stats = self._stats.get(name)
+                if stats is None:
+                    stats = self._stats[name] = _StageStats()
+                stats.calls += 1
+                stats.wall += wall - frame.child_wall
+                stats.cpu += cpu - frame.child_cpu
+                stats.allocated += allocated - frame.child_memory
+                stats.peak = max(stats.peak, peak)
+                if diff is not None:
+                    stats.snapshot_diff = diff
+
+    def _sample(self, interval):
+        own = threading.get_ident()
+        while self.enabled:
+            time.sleep(interval)
+            frames = sys._current_frames()
+            with self._lock:
+                thread_stages = dict(self._thread_stages)
+            for thread_id, frame in frames.items():
+                if thread_id == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('%s (%s:%d)' % (code.co_name,
+                                                 os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stages = [f.name for f in thread_stages.get(thread_id, ())] or [NO_STAGE]
+                key = ';'.join(stages + names[::-1])
+                self._samples[key] = self._samples.get(key, 0) + 1
+
+    def stop(self):
+        """
+        Stop profiling and write the reports.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._sampler.join()
+
+        summary = {}
+        for name in sorted(self._stats):
+            stats = self._stats[name]
+            summary[name] = {'calls': stats.calls,
+                             'wall_seconds': stats.wall,
+                             'cpu_seconds': stats.cpu,
+                             'allocated_bytes': stats.allocated,
+                             'peak_traced_bytes': stats.peak}
+            self._write_stage_report(name, stats)
+
+        with open(os.path.join(self.directory, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+
+        with open(os.path.join(self.directory, 'profile.collapsed'), 'w', encoding='utf-8') as f:
+            for key, count in sorted(self._samples.items()):
+                f.write('%s %d\n' % (key, count))
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        logging.info('Profiling reports written to %s', self.directory)
+
+    def _write_stage_report(self, name, stats):
+        profiles = [profile for stage, profile in self._profiles if stage == name]
+        cpu_stats = None
+        for profile in profiles:
+            try:
+                if cpu_stats is None:
+                    cpu_stats = pstats.Stats(profile)
+                else:
+                    cpu_stats.add(profile)
+            except TypeError:
+                # pstats refuses profiles that never collected anything
+                pass
+
+        report = io.StringIO()
+        report.write('stage: %s\n' % name)
+        report.write('calls: %d\n' % stats.calls)
+        report.write('wall time (exclusive): %.3fs\n' % stats.wall)
+        report.write('cpu time (exclusive): %.3fs\n' % stats.cpu)
+        if tracemalloc.is_tracing():
+            report.write('memory allocated and not freed: %d bytes\n' % stats.allocated)
+            report.write('peak traced memory: %d bytes\n' % stats.peak)
+        report.write('\n')
+
+        if cpu_stats is not None:
+            cpu_stats.dump_stats(os.path.join(self.directory, name + '.pstats'))
+            cpu_stats.stream = report
+            cpu_stats.sort_stats('cumulative').print_stats(30)
+
+        if stats.snapshot_diff:
+            report.write('\nallocations since the previous snapshot:\n')
+            for line in stats.snapshot_diff:
+                report.write('%s\n' % line)
+
+        with open(os.path.join(self.directory, name + '.txt'), 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+
+
+PROFILER = Profiler()
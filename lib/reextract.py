@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline re-extraction of crawled courses from the unit html of their
+archives.
+
+The units kept by previous crawls (the sourcefile archive and metadata.csv of
+a course, or the blob store of --blob-store) hold everything the text,
+problem and component extractors need. This command runs the current
+extractors (lib.extraction) on them again, without network and without
+unpacking the archives to disk, and writes all_textcomp.json,
+all_probcomp.json, all_comp.json and all_prob_type.txt of every course, in
+the course directory or under --output-dir.
+
+The units are extracted by a pool of processes: indexed archives (with an
+.idx, see lib.archive) and blob store courses are split into shards of
+--shard-size units read randomly, the other archives (e.g. the tar.gz of
+older crawls) are streamed by a single process each.
+
+With --block-cache, all_videocomp.json is written too, from the durations
+and transcripts of the videos cached by previous crawls; the videos that
+are not in the cache (or with other transcript languages) are left out,
+since nothing is fetched.
+
+Usage:
+
+  python -m lib.reextract [-j 8] [--shard-size 200] [--output-dir DIR]
+      [--components text,problem,video] [--text-structure]
+      [--block-cache blocks.db] [--transcript-langs en,ja] [--blob-store DIR]
+      [--json-compression gz] [--compact-json] HTMLs/Course_Name ... | HTMLs
+"""
+
+import argparse
+import csv
+import io
+import logging
+import os
+import sys
+import tarfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .archive import ARCHIVE_FORMATS, UnitArchiveReader, archive_filename, has_index
+from .blobstore import BlobStore
+from .blockcache import BlockCache
+from .extraction import COMPONENTS, comma_set, extract_unit, parse_components
+from .jsonio import COMPRESSIONS, write_json
+
+METADATA_FILENAME = 'metadata.csv'
+
+# places of a video in the course, not cached with its data
+_VIDEO_PLACE = ('section', 'subsection', 'unit')
+
+
+def _parse_metadata(content):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return list(csv.DictReader(io.StringIO(content, newline='')))
+
+
+def _metadata_columns(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def course_source(course_dir, blob_store=None):
+    """
+    Return the source of the units of a crawled course directory: a dict
+    with kind (indexed, stream or blob) and path (of the archive or the
+    blob store), None when the directory holds no crawled course.
+    """
+    if 'blob' in _metadata_columns(os.path.join(course_dir, METADATA_FILENAME)):
+        if blob_store is None:
+            logging.warning('%s: the units are in a blob store, pass --blob-store', course_dir)
+            return None
+        return {'kind': 'blob', 'path': blob_store}
+    for archive_format in sorted(ARCHIVE_FORMATS):
+        path = os.path.join(course_dir, archive_filename('sourcefile', archive_format))
+        if os.path.exists(path):
+            return {'kind': 'indexed' if has_index(path) else 'stream', 'path': path}
+    return None
+
+
+def find_courses(paths, blob_store=None):
+    """
+    Return the courses (dicts with course, directory, kind and path) of
+    paths: course directories, archives, or directories of courses.
+    """
+    courses = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isfile(path):
+            # an archive, e.g. a tar.gz of an older crawl
+            source = {'kind': 'indexed' if has_index(path) else 'stream', 'path': path}
+            course_dirs = [(os.path.dirname(path) or '.', source)]
+        else:
+            source = course_source(path, blob_store)
+            if source is not None:
+                course_dirs = [(path, source)]
+            else:
+                course_dirs = [(os.path.join(path, name), course_source(os.path.join(path, name), blob_store))
+                               for name in sorted(os.listdir(path))
+                               if os.path.isdir(os.path.join(path, name))]
+        for course_dir, source in course_dirs:
+            if source is None:
+                continue
+            courses.append(dict(source, course=os.path.basename(os.path.abspath(course_dir)),
+                                directory=course_dir))
+    return courses
+
+
+def _extract(html, options):
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    components, text_structure, video_identities = options
+    record = extract_unit(html, components, text_structure, video_identities=video_identities)
+    # the html is already archived, only the extracted data goes back to
+    # the main process
+    del record['html']
+    return record
+
+
+def extract_members(path, names, options):
+    """
+    Task extracting the units names of the indexed archive path, return
+    (None, {name: record}).
+    """
+    reader = UnitArchiveReader(path)
+    return None, {name: _extract(reader.read(name), options) for name in names}
+
+
+def extract_blobs(root, keys, options):
+    """
+    Task extracting the units keys of the blob store root, return
+    (None, {key: record}).
+    """
+    store = BlobStore(root)
+    return None, {key: _extract(store.get(key), options) for key in keys}
+
+
+def extract_stream(path, options):
+    """
+    Task extracting the units of the archive path in a single pass, return
+    (metadata rows, {htmlfile: record}).
+    """
+    rows = None
+    records = {}
+    # the members are decompressed in order and never written to disk
+    with tarfile.open(path, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            content = tar.extractfile(member).read()
+            if name == METADATA_FILENAME:
+                rows = _parse_metadata(content)
+            elif name.endswith('.html'):
+                records[name] = _extract(content, options)
+    return rows, records
+
+
+def _shards(items, size):
+    items = sorted(set(items))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def course_tasks(course, shard_size):
+    """
+    Return the metadata rows of course (None for the streamed archives,
+    whose metadata is read by their task) and its tasks, (function,
+    arguments) without the extraction options.
+    """
+    if course['kind'] == 'stream':
+        return None, [(extract_stream, (course['path'],))]
+    if course['kind'] == 'blob':
+        with open(os.path.join(course['directory'], METADATA_FILENAME), encoding='utf-8', newline='') as f:
+            rows = list(csv.DictReader(f))
+        # units shared between courses or runs are extracted once
+        return rows, [(extract_blobs, (course['path'], keys))
+                      for keys in _shards([row['blob'] for row in rows if row['blob']], shard_size)]
+    reader = UnitArchiveReader(course['path'])
+    if METADATA_FILENAME not in reader.members:
+        raise ValueError('%s has no %s' % (course['path'], METADATA_FILENAME))
+    rows = _parse_metadata(reader.read(METADATA_FILENAME))
+    return rows, [(extract_members, (course['path'], names))
+                  for names in _shards([row['htmlfile'] for row in rows], shard_size)]
+
+
+def _requested_languages(video_metadata, transcript_langs):
+    return sorted(key for key in video_metadata['transcriptLanguages']
+                  if transcript_langs is None or key in transcript_langs)
+
+
+class CourseOutputs(object):
+    """
+    JSON outputs of a course, numbered like the ones of the crawler.
+    """
+
+    def __init__(self, text_structure=False):
+        self.text_structure = text_structure
+        self.texts = {}
+        self.problems = {}
+        self.videos = {}
+        self.components = {}
+        self.problem_types = []
+        self.uncached_videos = 0
+
+    def add(self, section, subsection, record, videos):
+        """
+        Add a unit record (see lib.extraction.extract_unit) and its videos
+        (dicts of the block cache, None for the uncached ones).
+        """
+        unit = record['unit']
+        if record['text'] is not None:
+            key = 'text_block_' + str(len(self.texts) + 1).zfill(4)
+            self.texts[key] = {'section': section, 'subsection': subsection, 'unit': unit,
+                               'content': record['text']}
+            if self.text_structure:
+                self.texts[key]['structure'] = record['text_structure']
+
+        if len(record['problem']) > 0:
+            for problem_type in record['problem_types']:
+                self.problem_types.append(problem_type + ' \n')
+            key = 'quiz_block_' + str(len(self.problems) + 1).zfill(4)
+            self.problems[key] = {'section': section, 'subsection': subsection, 'unit': unit,
+                                  'content': record['problem']}
+            if self.text_structure:
+                self.problems[key]['structure'] = record['problem_structure']
+
+        for video in videos:
+            if video is None:
+                self.uncached_videos += 1
+                continue
+            key = 'video_block_' + str(len(self.videos) + 1).zfill(4)
+            self.videos[key] = dict(video, section=section, subsection=subsection, unit=unit)
+
+        for comp_type in record['components']:
+            key = str(len(self.components) + 1).zfill(4) + '_' + comp_type
+            self.components[key] = {'section': section, 'subsection': subsection, 'unit': unit,
+                                    'type': comp_type}
+
+    def write(self, directory, compression='none', compact=False, videos=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_json(self.texts, os.path.join(directory, 'all_textcomp.json'), compression, compact)
+        write_json(self.problems, os.path.join(directory, 'all_probcomp.json'), compression, compact)
+        if videos:
+            write_json(self.videos, os.path.join(directory, 'all_videocomp.json'), compression, compact)
+        write_json(self.components, os.path.join(directory, 'all_comp.json'), compression, compact)
+        with open(os.path.join(directory, 'all_prob_type.txt'), 'w') as f:
+            f.writelines(self.problem_types)
+
+
+def cached_videos(record, block_cache, transcript_langs):
+    """
+    Return the cached data (dict, None when not cached) of the videos of a
+    unit record.
+    """
+    if block_cache is None:
+        return []
+    videos = []
+    for video_metadata, ident in record['videos']:
+        cached = block_cache.get(ident, 'video')
+        if cached is not None and cached['languages'] == _requested_languages(video_metadata, transcript_langs):
+            videos.append({key: value for key, value in cached['video'].items() if key not in _VIDEO_PLACE})
+        else:
+            videos.append(None)
+    return videos
+
+
+def write_course(course, rows, records, args, block_cache=None):
+    """
+    Write the outputs of course from its metadata rows and the records of
+    its units, return the CourseOutputs.
+    """
+    outputs = CourseOutputs(args.text_structure)
+    for row in rows:
+        record = records.get(row['blob'] if course['kind'] == 'blob' else row['htmlfile'])
+        if record is None:
+            logging.warning('%s: unit %s is missing from %s', course['course'], row['htmlfile'], course['path'])
+            continue
+        outputs.add(row['section'], row['subsection'], record,
+                    cached_videos(record, block_cache, args.transcript_langs))
+    directory = course['directory']
+    if args.output_dir is not None:
+        directory = os.path.join(args.output_dir, course['course'])
+    outputs.write(directory, args.json_compression, args.compact_json,
+                  videos=block_cache is not None and 'video' in args.components)
+    return outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.reextract',
+                                     description='Extract the outputs of crawled courses again from '
+                                     'their archived units, without network')
+    parser.add_argument('paths', nargs='+',
+                        help='course directories, archives, or directories of courses (e.g. HTMLs)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='extraction processes (default: the number of CPUs)')
+    parser.add_argument('--shard-size', type=int, default=200,
+                        help='units of an indexed archive or blob store course per task')
+    parser.add_argument('--output-dir', default=None,
+                        help='directory of the course outputs (default: the course directories)')
+    parser.add_argument('--components', type=parse_components, default=','.join(sorted(COMPONENTS)),
+                        help='comma separated components to extract among text, problem and video')
+    parser.add_argument('--text-structure', action='store_true',
+                        help='keep the structure of the text and quiz blocks')
+    parser.add_argument('--block-cache', default=None,
+                        help='block cache of previous crawls (--block-cache), the cached videos '
+                        'are written to all_videocomp.json')
+    parser.add_argument('--transcript-langs', type=comma_set, default=None,
+                        help='comma separated transcript languages of the cached videos')
+    parser.add_argument('--blob-store', default=None,
+                        help='blob store of the courses crawled with --blob-store')
+    parser.add_argument('--json-compression', choices=sorted(COMPRESSIONS), default='none',
+                        help='compression of the json outputs')
+    parser.add_argument('--compact-json', action='store_true',
+                        help='write the json outputs without indentation')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+    if args.block_cache is not None and not os.path.exists(args.block_cache):
+        parser.error('%s does not exist' % args.block_cache)
+    courses = find_courses(args.paths, args.blob_store)
+    if not courses:
+        parser.error('no crawled course in %s' % ', '.join(args.paths))
+
+    block_cache = BlockCache(args.block_cache) if args.block_cache is not None else None
+    options = (args.components, args.text_structure, block_cache is not None)
+    failed = 0
+    start = time.time()
+
+    def finish(course):
+        if course['failed'] or course['rows'] is None:
+            if not course['failed']:
+                logging.error('%s: %s has no %s', course['course'], course['path'], METADATA_FILENAME)
+            return False
+        outputs = write_course(course, course['rows'], course['records'], args, block_cache)
+        print('%s: %d units, %d text blocks, %d quiz blocks, %d components, %d videos (%d not cached)'
+              % (course['course'], len(course['rows']), len(outputs.texts), len(outputs.problems),
+                 len(outputs.components), len(outputs.videos), outputs.uncached_videos))
+        # the records of a written course are not needed anymore
+        course['records'] = None
+        return True
+
+    try:
+        with ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+            futures = {}
+            for course in courses:
+                course['records'] = {}
+                course['failed'] = False
+                try:
+                    course['rows'], tasks = course_tasks(course, max(args.shard_size, 1))
+                except (IOError, ValueError, KeyError) as exception:
+                    logging.error('%s: %s', course['course'], exception)
+                    failed += 1
+                    continue
+                course['pending'] = len(tasks)
+                for function, arguments in tasks:
+                    futures[pool.submit(function, *(arguments + (options,)))] = course
+                if not tasks and not finish(course):
+                    failed += 1
+
+            for future in as_completed(futures):
+                course = futures[future]
+                course['pending'] -= 1
+                try:
+                    rows, records = future.result()
+                except Exception as exception:
+                    logging.error('%s: %s', course['course'], exception)
+                    course['failed'] = True
+                else:
+                    if rows is not None:
+                        course['rows'] = rows
+                    course['records'].update(records)
+                if course['pending'] == 0 and not finish(course):
+                    failed += 1
+    finally:
+        if block_cache is not None:
+            block_cache.close()
+    print('%d courses extracted in %.1f s' % (len(courses) - failed, time.time() - start))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Priority scheduler of the crawler work (outline, subsection and video
+tasks) shared by all the selected courses.
+
+Tasks run in a fixed pool of worker threads. A worker takes the task with
+the lowest priority value (then the oldest) among the tasks that would not
+exceed the limit of concurrent tasks of their host (per_host) nor of their
+course (per_course), so that one course with many slow tasks cannot hold
+all the workers, and a slow host does not stall the work on the others.
+The course limit is work-conserving: when no queued task is within the
+limits, the first one only over the limit of its course runs anyway, so a
+course crawled alone (or the last one) uses all the workers.
+
+Usage:
+
+  >>> from lib.scheduler import Scheduler
+  >>> with Scheduler(workers=16, per_course=4) as scheduler:
+  ...     future = scheduler.submit(get_page_contents, url, headers,
+  ...                               priority=len(subsections),
+  ...                               host='courses.edx.org', course='GeoS101x')
+  ...     page = future.result()
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+
+from concurrent.futures import Future
+
+from .metrics import METRICS
+
+
+class _Task(object):
+    __slots__ = ('priority', 'seq', 'host', 'course', 'func', 'args', 'kwargs', 'future')
+
+    def __init__(self, priority, seq, host, course, func, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.host = host
+        self.course = course
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Scheduler(object):
+    """
+    Runs tasks in worker threads by priority, under per-host and per-course
+    concurrency limits.
+    """
+
+    def __init__(self, workers=16, per_host=None, per_course=None):
+        """
+        @param workers: Number of worker threads.
+        @type workers: int
+
+        @param per_host: Maximum concurrent tasks of a host, None for no
+            limit.
+        @type per_host: int or None
+
+        @param per_course: Maximum concurrent tasks of a course while other
+            courses have runnable tasks, None for no limit.
+        @type per_course: int or None
+        """
+        self.per_host = per_host
+        self.per_course = per_course
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._running_hosts = {}
+        self._running_courses = {}
+        self._shutdown = False
+        self._workers = [threading.Thread(target=self._work, name='scheduler-%d' % i, daemon=True)
+                         for i in range(max(1, workers))]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule func(*args, **kwargs), return a concurrent.futures.Future.
+        The keyword arguments priority (lower runs first, default 0), host
+        and course are taken by the scheduler.
+        """
+        priority = kwargs.pop('priority', 0)
+        host = kwargs.pop('host', None)
+        course = kwargs.pop('course', None)
+        # the metrics of the task are those of the submitting job
+        task = _Task(priority, next(self._seq), host, course, METRICS.bind(func), args, kwargs)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('The scheduler is shut down')
+            heapq.heappush(self._queue, task)
+            METRICS.set_gauge('queue_depth', len(self._queue), queue='scheduler')
+            self._cond.notify()
+        return task.future
+
+    def _host_free(self, task):
+        return (self.per_host is None or task.host is None
+                or self._running_hosts.get(task.host, 0) < self.per_host)
+
+    def _course_free(self, task):
+        return (self.per_course is None or task.course is None
+                or self._running_courses.get(task.course, 0) < self.per_course)
+
+    def _pop(self):
+        # called with self._cond held, return the first runnable task, or
+        # else the first one only over the limit of its course: no other
+        # course has runnable work then
+        skipped = []
+        task = None
+        fallback = None
+        while self._queue:
+            candidate = heapq.heappop(self._queue)
+            if self._host_free(candidate):
+                if self._course_free(candidate):
+                    task = candidate
+                    break
+                if fallback is None:
+                    fallback = candidate
+                    continue
+            skipped.append(candidate)
+        if task is None:
+            task = fallback
+        elif fallback is not None:
+            skipped.append(fallback)
+        for candidate in skipped:
+            heapq.heappush(self._queue, candidate)
+        return task
+
+    def _acquire(self, task, delta):
+        # called with self._cond held
+        for running, key in ((self._running_hosts, task.host),
+                             (self._running_courses, task.course)):
+            if key is not None:
+                running[key] = running.get(key, 0) + delta
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._pop()
+                while task is None:
+                    if self._shutdown and not self._queue:
+                        return
+                    self._cond.wait()
+                    task = self._pop()
+                self._acquire(task, 1)
+                METRICS.set_gauge('queue_depth', len(self._queue), queue='scheduler')
+
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    result = task.func(*task.args, **task.kwargs)
+                except BaseException as exception:
+                    task.future.set_exception(exception)
+                else:
+                    task.future.set_result(result)
+
+            with self._cond:
+                self._acquire(task, -1)
+                # a slot of the host and course of the task is free again
+                self._cond.notify_all()
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        Stop the workers once the queue is empty. With cancel=True the
+        queued tasks are cancelled first.
+        """
+        with self._cond:
+            self._shutdown = True
+            if cancel:
+                for task in self._queue:
+                    task.future.cancel()
+                logging.debug('Cancelled %d scheduled tasks', len(self._queue))
+                self._queue = []
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
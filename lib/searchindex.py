@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+Full-text search index over the crawled components.
+
+The crawler can maintain a SQLite database (--search-index) with the text
+blocks, quiz text and video transcripts of every course, keyed by course,
+section, subsection and unit. The blocks are kept in a regular table and
+indexed by an external-content FTS5 table synchronized by triggers. The
+blocks of a course are buffered while it is crawled and replace its previous
+blocks (or those of the subsections of a watch poll) in one transaction. The
+database is in WAL mode and the writers wait for each other (busy timeout),
+so several crawler processes can write into one index.
+
+Query it with:
+
+  python -m lib.searchindex <database> "<fts5 query>" [--course C] [--kind K]
+"""
+
+import argparse
+import sqlite3
+import sys
+import threading
+
+from .sqlstore import _Transaction
+
+
+KINDS = ('text', 'quiz', 'transcript')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    course TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    section TEXT,
+    subsection TEXT,
+    unit TEXT,
+    language TEXT,
+    block_id TEXT,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_course ON blocks (course);
+CREATE VIRTUAL TABLE IF NOT EXISTS blocks_fts USING fts5 (
+    section, subsection, unit, content,
+    content='blocks', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS blocks_insert AFTER INSERT ON blocks BEGIN
+    INSERT INTO blocks_fts (rowid, section, subsection, unit, content)
+    VALUES (new.id, new.section, new.subsection, new.unit, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS blocks_delete AFTER DELETE ON blocks BEGIN
+    INSERT INTO blocks_fts (blocks_fts, rowid, section, subsection, unit, content)
+    VALUES ('delete', old.id, old.section, old.subsection, old.unit, old.content);
+END;
+"""
+
+_INSERT = ('INSERT INTO blocks (course, kind, section, subsection, unit, language, '
+           'block_id, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+class SearchIndex(object):
+    """
+    SQLite FTS5 index of the blocks of the crawled courses.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Path of the SQLite database, created if needed.
+        @type path: str
+        """
+        self.path = path
+        # course -> [replaced subsections (None for all), blocks]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self._conn.executescript(_SCHEMA)
+        except sqlite3.OperationalError as exception:
+            self._conn.close()
+            raise RuntimeError('Cannot create the search index (is SQLite built '
+                               'with FTS5?): %s' % exception)
+
+    def begin_course(self, course, subsections=None):
+        """
+        Start a new crawl of course, its blocks replace the previous ones
+        when it is flushed; only those of subsections ((section, subsection)
+        names) when given, for a crawl of some subsections only.
+        """
+        with self._lock:
+            self._pending[course] = [subsections, []]
+
+    def add(self, kind, course, section, subsection, unit, content, block_id=None,
+            language=None):
+        """
+        Add a block of the course being crawled, it is written when the
+        course is flushed.
+        """
+        if not content:
+            return
+        with self._lock:
+            self._pending.setdefault(course, [[], []])[1].append(
+                (course, kind, section, subsection, unit, language, block_id, content))
+
+    def flush(self, course=None):
+        """
+        Replace the blocks of course (of all the courses by default) by the
+        ones added since its begin_course, in one transaction.
+        """
+        with self._lock:
+            for name in [course] if course is not None else list(self._pending):
+                if name in self._pending:
+                    self._flush(name, *self._pending.pop(name))
+
+    def _flush(self, course, subsections, blocks):
+        # called with self._lock held
+        with _Transaction(self._conn) as conn:
+            if subsections is None:
+                conn.execute('DELETE FROM blocks WHERE course = ?', (course,))
+            else:
+                conn.executemany('DELETE FROM blocks WHERE course = ? AND section = ? AND subsection = ?',
+                                 [(course, section, subsection) for section, subsection in subsections])
+            conn.executemany(_INSERT, blocks)
+
+    def close(self):
+        """
+        Write the pending blocks, merge the index segments and close.
+        """
+        self.flush()
+        with self._lock:
+            with _Transaction(self._conn) as conn:
+                conn.execute("INSERT INTO blocks_fts (blocks_fts) VALUES ('optimize')")
+            self._conn.close()
+
+    def search(self, query, course=None, kind=None, limit=20):
+        """
+        Return the blocks matching the FTS5 query, best first, as dicts with
+        a highlighted snippet of the content.
+        """
+        sql = ("SELECT b.course, b.kind, b.section, b.subsection, b.unit, b.language, "
+               "b.block_id, snippet(blocks_fts, 3, '[', ']', '...', 16) "
+               "FROM blocks_fts JOIN blocks b ON b.id = blocks_fts.rowid "
+               "WHERE blocks_fts MATCH ?")
+        params = [query]
+        if course is not None:
+            sql += ' AND b.course = ?'
+            params.append(course)
+        if kind is not None:
+            sql += ' AND b.kind = ?'
+            params.append(kind)
+        sql += ' ORDER BY bm25(blocks_fts) LIMIT ?'
+        params.append(limit)
+        columns = ('course', 'kind', 'section', 'subsection', 'unit', 'language',
+                   'block_id', 'snippet')
+        with self._lock:
+            return [dict(zip(columns, row)) for row in self._conn.execute(sql, params)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.searchindex',
+                                     description='Search the crawled components')
+    parser.add_argument('database', help='search index built with --search-index')
+    parser.add_argument('query', help='FTS5 query, e.g. \'"plate tectonics" OR magma\'')
+    parser.add_argument('--course', help='only search this course')
+    parser.add_argument('--kind', choices=KINDS, help='only search this kind of block')
+    parser.add_argument('--limit', type=int, default=20, help='maximum number of results')
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.database)
+    try:
+        results = index.search(args.query, course=args.course, kind=args.kind,
+                               limit=args.limit)
+    except sqlite3.OperationalError as exception:
+        sys.exit('Invalid query: %s' % exception)
+    for result in results:
+        location = ' > '.join(part.strip() for part in (result['section'], result['subsection'],
+                                                        result['unit']) if part)
+        kind = result['kind']
+        if result['language']:
+            kind += ' (%s)' % result['language']
+        print('%s | %s | %s' % (result['course'], kind, location))
+        print('    %s' % result['snippet'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""
+Authenticated session management.
+
+SessionManager keeps the cookies and the request headers (with the CSRF
+token) of the crawler session. It can save them into an encrypted local
+store so that the next runs skip the initial token fetch and the login while
+the session is valid, and it re-authenticates transparently when the session
+expires during a crawl (see lib.utils.get_page_contents).
+
+The store is encrypted and authenticated with a key derived from the edX
+password (PBKDF2-HMAC-SHA256), using HMAC-SHA256 in counter mode as the
+keystream and an HMAC-SHA256 tag over the ciphertext; only the standard
+library is needed. The store also records the account and the edX host it
+was made for, a store of another account or site is not reused.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from six.moves.http_cookiejar import Cookie, CookieJar
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import (
+    build_opener,
+    install_opener,
+    HTTPCookieProcessor,
+)
+
+
+_MAGIC = b'EDXSESS1'
+_KDF_ITERATIONS = 200000
+
+# attributes of http.cookiejar.Cookie kept in the store
+_COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified',
+                  'domain', 'domain_specified', 'domain_initial_dot', 'path',
+                  'path_specified', 'secure', 'expires', 'discard', 'comment',
+                  'comment_url', 'rfc2109')
+
+
+class SessionStoreError(Exception):
+    """
+    The session store cannot be read (corrupted, or another password).
+    """
+
+
+class LoginError(Exception):
+    """
+    The edX site refused the credentials.
+    """
+
+
+def _derive_keys(password, salt):
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                              _KDF_ITERATIONS, dklen=64)
+    return key[:32], key[32:]
+
+
+def _keystream_xor(key, nonce, data):
+    output = bytearray(len(data))
+    for block in range(0, len(data), 32):
+        pad = hmac.new(key, nonce + struct.pack('>Q', block // 32), hashlib.sha256).digest()
+        chunk = data[block:block + 32]
+        output[block:block + len(chunk)] = bytes(a ^ b for a, b in zip(chunk, pad))
+    return bytes(output)
+
+
+def encrypt(password, plaintext):
+    """
+    Encrypt and authenticate plaintext (bytes) with password.
+    """
+    salt = os.urandom(16)
+    nonce = os.urandom(16)
+    enc_key, mac_key = _derive_keys(password, salt)
+    ciphertext = _keystream_xor(enc_key, nonce, plaintext)
+    tag = hmac.new(mac_key, salt + nonce + ciphertext, hashlib.sha256).digest()
+    return _MAGIC + salt + nonce + tag + ciphertext
+
+
+def decrypt(password, data):
+    """
+    Decrypt data produced by encrypt, raise SessionStoreError if it was
+    tampered with or encrypted with another password.
+    """
+    if not data.startswith(_MAGIC):
+        raise SessionStoreError('Not a session store')
+    data = data[len(_MAGIC):]
+    salt, nonce, tag, ciphertext = data[:16], data[16:32], data[32:64], data[64:]
+    enc_key, mac_key = _derive_keys(password, salt)
+    expected = hmac.new(mac_key, salt + nonce + ciphertext, hashlib.sha256).digest()
+    if not hmac.compare_digest(tag, expected):
+        raise SessionStoreError('Wrong password or corrupted session store')
+    return _keystream_xor(enc_key, nonce, ciphertext)
+
+
+def _cookie_to_dict(cookie):
+    values = {field: getattr(cookie, field) for field in _COOKIE_FIELDS}
+    values['rest'] = dict(cookie._rest)
+    return values
+
+
+def _cookie_from_dict(values):
+    return Cookie(**values)
+
+
+def is_login_url(url):
+    """
+    Tell whether url is the login page edX redirects to when the session
+    has expired.
+    """
+    return urlparse(url).path.rstrip('/') in ('/login', '/signin')
+
+
+class SessionManager(object):
+    """
+    Holds the authenticated session (cookies and headers) of the crawler.
+
+    The headers returned by open() are the ones to pass to every request.
+    When the session is renewed, the new headers (with the new CSRF token)
+    replace the current dict, which is never updated in place; the requests
+    of the session are sent with a copy of the current one, see headers()
+    and lib.utils.get_page_contents.
+    """
+
+    def __init__(self, authenticate, username, password, host, store_path=None,
+                 session_cookie='sessionid'):
+        """
+        @param authenticate: Function performing the full login with the
+            given CookieJar, returning the request headers. It raises
+            LoginError when the credentials are refused.
+        @type authenticate: callable(CookieJar) -> dict
+
+        @param username: edX account, the store of another one is not
+            reused.
+        @type username: str
+
+        @param password: edX password, used to encrypt the store.
+        @type password: str
+
+        @param host: Host (netloc) of the edX site, only the requests to this
+            host can renew the session.
+        @type host: str
+
+        @param store_path: Path of the encrypted store, None to keep the
+            session in memory only.
+        @type store_path: str or None
+
+        @param session_cookie: Name of the cookie that must be present and
+            not expired for a stored session to be reused.
+        @type session_cookie: str
+        """
+        self._authenticate = authenticate
+        self.username = username
+        self._password = password
+        self.host = host
+        self.store_path = store_path
+        self.session_cookie = session_cookie
+        self.cookiejar = CookieJar()
+        self._headers = {}
+        self.generation = 0
+        # held during a renewal, _headers_lock only while the dict is swapped
+        self._lock = threading.Lock()
+        self._headers_lock = threading.Lock()
+        install_opener(build_opener(HTTPCookieProcessor(self.cookiejar)))
+
+    is_login_url = staticmethod(is_login_url)
+
+    def owns(self, url):
+        """
+        Tell whether url is a request of the authenticated session.
+        """
+        return urlparse(url).netloc == self.host
+
+    def headers(self):
+        """
+        Return a copy of the current request headers.
+        """
+        with self._headers_lock:
+            return dict(self._headers)
+
+    def _set_headers(self, headers):
+        with self._headers_lock:
+            self._headers = dict(headers)
+
+    def open(self):
+        """
+        Reuse the stored session if it is still valid, log in otherwise.
+        Returns the request headers.
+        """
+        if self._load():
+            logging.info('Reusing the stored edX session.')
+        else:
+            self._login()
+        return self.headers()
+
+    def renew(self, generation):
+        """
+        Log in again after the session expired. generation is the value of
+        self.generation when the failed request was sent: if another thread
+        renewed the session since then, nothing is done.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            logging.warning('The edX session has expired, logging in again.')
+            self._login()
+
+    def _login(self):
+        self.cookiejar.clear()
+        self._set_headers(self._authenticate(self.cookiejar))
+        self.generation += 1
+        self.save()
+
+    def _load(self):
+        if not self.store_path or not os.path.exists(self.store_path):
+            return False
+        try:
+            with open(self.store_path, 'rb') as f:
+                state = json.loads(decrypt(self._password, f.read()).decode('utf-8'))
+        except (SessionStoreError, ValueError) as exception:
+            logging.warning('Ignoring the session store: %s', exception)
+            return False
+        # the same password can be used by several accounts and sites
+        if (state.get('username'), state.get('host')) != (self.username, self.host):
+            logging.warning('Ignoring the session store of another account or site.')
+            return False
+
+        now = time.time()
+        cookies = [_cookie_from_dict(values) for values in state['cookies']]
+        cookies = [cookie for cookie in cookies if not cookie.is_expired(now)]
+        if not any(cookie.name == self.session_cookie for cookie in cookies):
+            return False
+
+        for cookie in cookies:
+            self.cookiejar.set_cookie(cookie)
+        self._set_headers(state['headers'])
+        self.generation += 1
+        return True
+
+    def save(self):
+        """
+        Save the cookies and headers into the store.
+        """
+        if not self.store_path:
+            return
+        state = {'saved': time.time(),
+                 'username': self.username,
+                 'host': self.host,
+                 'headers': self.headers(),
+                 'cookies': [_cookie_to_dict(cookie) for cookie in self.cookiejar]}
+        data = encrypt(self._password, json.dumps(state).encode('utf-8'))
+
+        directory = os.path.dirname(os.path.abspath(self.store_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.store_path)
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+
+"""
+Relational output backend of the crawler.
+
+With --sql-store, the records of the crawled courses are written into a
+SQLite database of normalized tables:
+
+  courses -> sections -> subsections -> units -> components
+                                              -> texts
+                                              -> problems -> problem_types
+                                              -> videos -> transcripts -> transcript_segments
+
+The database is in WAL mode and every write transaction waits for the
+others (busy timeout), so several crawler processes can write their courses
+into one store concurrently. Units are buffered and inserted in batches, one
+transaction per batch. A course crawled again replaces its previous rows,
+and the subsections crawled again by a watch poll replace theirs. The
+subsections are found by their urls and ordered by their positions in the
+outline of the course, those removed from it are deleted.
+
+The legacy output files (all_textcomp.json, all_probcomp.json,
+all_videocomp.json, all_comp.json, all_prob_type.txt and metadata.csv) can
+be regenerated from the store:
+
+  python -m lib.sqlstore export <database> <output_dir> [--course C]
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    url TEXT,
+    crawled_at REAL
+);
+CREATE TABLE IF NOT EXISTS sections (
+    id INTEGER PRIMARY KEY,
+    course_id INTEGER NOT NULL REFERENCES courses (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    position INTEGER,
+    UNIQUE (course_id, name)
+);
+CREATE TABLE IF NOT EXISTS subsections (
+    id INTEGER PRIMARY KEY,
+    section_id INTEGER NOT NULL REFERENCES sections (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    url TEXT,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subsections_section ON subsections (section_id);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    subsection_id INTEGER NOT NULL REFERENCES subsections (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    htmlfile TEXT,
+    blob TEXT
+);
+CREATE INDEX IF NOT EXISTS units_subsection ON units (subsection_id);
+CREATE TABLE IF NOT EXISTS components (
+    unit_id INTEGER NOT NULL REFERENCES units (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS components_unit ON components (unit_id);
+CREATE TABLE IF NOT EXISTS texts (
+    unit_id INTEGER NOT NULL REFERENCES units (id) ON DELETE CASCADE,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS texts_unit ON texts (unit_id);
+CREATE TABLE IF NOT EXISTS problems (
+    id INTEGER PRIMARY KEY,
+    unit_id INTEGER NOT NULL REFERENCES units (id) ON DELETE CASCADE,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS problems_unit ON problems (unit_id);
+CREATE TABLE IF NOT EXISTS problem_types (
+    problem_id INTEGER NOT NULL REFERENCES problems (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS problem_types_problem ON problem_types (problem_id);
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    unit_id INTEGER NOT NULL REFERENCES units (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    youtube_url TEXT,
+    video_source TEXT,
+    duration TEXT,
+    speech_period TEXT
+);
+CREATE INDEX IF NOT EXISTS videos_unit ON videos (unit_id);
+CREATE TABLE IF NOT EXISTS transcripts (
+    id INTEGER PRIMARY KEY,
+    video_id INTEGER NOT NULL REFERENCES videos (id) ON DELETE CASCADE,
+    language TEXT NOT NULL,
+    available INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transcripts_video ON transcripts (video_id);
+CREATE TABLE IF NOT EXISTS transcript_segments (
+    transcript_id INTEGER NOT NULL REFERENCES transcripts (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transcript_segments_transcript ON transcript_segments (transcript_id);
+"""
+
+_TRANSCRIPT_PREFIX = 'transcript_'
+# value of the transcripts that could not be downloaded in all_videocomp.json
+_MISSING_TRANSCRIPT = {"start": '', "end": '', "text": ''}
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+def _migrate(conn):
+    """
+    Add the outline positions and the urls of the subsections to a store
+    written before they were kept. Its rows keep their insertion order and
+    are replaced by the next crawl of their course.
+    """
+    if 'url' in [row[1] for row in conn.execute('PRAGMA table_info(subsections)')]:
+        return
+    # the subsections table is rebuilt without its (section_id, name)
+    # constraint, dropping it must not cascade to the units
+    conn.execute('PRAGMA foreign_keys=OFF')
+    try:
+        with _Transaction(conn):
+            if 'url' in [row[1] for row in conn.execute('PRAGMA table_info(subsections)')]:
+                return
+            conn.execute('ALTER TABLE sections ADD COLUMN position INTEGER')
+            conn.execute('UPDATE sections SET position = id')
+            conn.execute('CREATE TABLE subsections_new ('
+                         'id INTEGER PRIMARY KEY, '
+                         'section_id INTEGER NOT NULL REFERENCES sections (id) ON DELETE CASCADE, '
+                         'position INTEGER NOT NULL, '
+                         'url TEXT, '
+                         'name TEXT NOT NULL)')
+            conn.execute('INSERT INTO subsections_new (id, section_id, position, name) '
+                         'SELECT id, section_id, id, name FROM subsections')
+            conn.execute('DROP TABLE subsections')
+            conn.execute('ALTER TABLE subsections_new RENAME TO subsections')
+            conn.execute('CREATE INDEX subsections_section ON subsections (section_id)')
+    finally:
+        conn.execute('PRAGMA foreign_keys=ON')
+
+
+class _Transaction(object):
+    """
+    Write transaction taking the database lock at once (BEGIN IMMEDIATE),
+    so that concurrent writers wait instead of failing on lock upgrades.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class SqlStore(object):
+    """
+    Writer of the crawled records into the relational store.
+    """
+
+    def __init__(self, path, batch_size=200):
+        """
+        @param path: Path of the SQLite database, created if needed.
+        @type path: str
+
+        @param batch_size: Number of units inserted per transaction.
+        @type batch_size: int
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._conn = _connect(path)
+        self._conn.executescript(_SCHEMA)
+        _migrate(self._conn)
+        self._lock = threading.Lock()
+        self._pending = []
+        # (course id, section name) -> id and (section id, subsection url)
+        # -> id
+        self._sections = {}
+        self._subsections = {}
+
+    def begin_course(self, name, url=None, subsections=None):
+        """
+        Replace the rows of the course name, return its id. With subsections
+        (urls), only the rows of these subsections are replaced, for a crawl
+        of some subsections only.
+        """
+        with self._lock:
+            self._flush()
+            with _Transaction(self._conn) as conn:
+                if subsections is None:
+                    conn.execute('DELETE FROM courses WHERE name = ?', (name,))
+                    return conn.execute('INSERT INTO courses (name, url, crawled_at) VALUES (?, ?, ?)',
+                                        (name, url, time.time())).lastrowid
+                conn.execute('INSERT OR IGNORE INTO courses (name) VALUES (?)', (name,))
+                conn.execute('UPDATE courses SET url = COALESCE(?, url), crawled_at = ? WHERE name = ?',
+                             (url, time.time(), name))
+                course_id = conn.execute('SELECT id FROM courses WHERE name = ?', (name,)).fetchone()[0]
+                conn.executemany('DELETE FROM subsections WHERE url = ? AND section_id IN '
+                                 '(SELECT id FROM sections WHERE course_id = ?)',
+                                 [(subsection, course_id) for subsection in subsections])
+            # the ids of the deleted subsections are not valid anymore
+            self._subsections.clear()
+            return course_id
+
+    def update_outline(self, name, outline):
+        """
+        Move the stored subsections of the course name to their place in
+        its current outline, given as (section, section position, subsection,
+        subsection position, subsection url) for all its subsections, and
+        delete those not in it anymore, with the sections left empty.
+        """
+        with self._lock:
+            self._flush()
+            with _Transaction(self._conn) as conn:
+                row = conn.execute('SELECT id FROM courses WHERE name = ?', (name,)).fetchone()
+                if row is None:
+                    return
+                course_id = row[0]
+                urls = set()
+                for section, section_position, subsection, subsection_position, url in outline:
+                    urls.add(url)
+                    conn.execute('UPDATE subsections SET section_id = ?, position = ?, name = ? WHERE url = ? AND '
+                                 'section_id IN (SELECT id FROM sections WHERE course_id = ?)',
+                                 (self._section_id(conn, course_id, section, section_position),
+                                  subsection_position, subsection, url, course_id))
+                # the rows of a store written without the urls are left to
+                # the next crawl of the course
+                conn.executemany('DELETE FROM subsections WHERE id = ?', [
+                    (subsection_id,) for subsection_id, url in conn.execute(
+                        'SELECT id, url FROM subsections WHERE url IS NOT NULL AND section_id IN '
+                        '(SELECT id FROM sections WHERE course_id = ?)', (course_id,)).fetchall()
+                    if url not in urls])
+                conn.execute('DELETE FROM sections WHERE course_id = ? AND id NOT IN '
+                             '(SELECT section_id FROM subsections)', (course_id,))
+            # the ids of the moved and deleted rows are not valid anymore
+            self._sections.clear()
+            self._subsections.clear()
+
+    def add_unit(self, course_id, section, subsection, unit, outline, htmlfile=None, blob=None,
+                 text=None, problem=None, problem_types=(), videos=(), components=()):
+        """
+        Add a unit and its records, they are written with the next batch.
+
+        @param outline: Place of the subsection in the outline of the
+            course, (section position, subsection position, subsection url).
+        @param text: Text of the html components, None if there are none.
+        @param problem: Text of the problem components, None if there are
+            none.
+        @param problem_types: Types of the problems of the unit.
+        @param videos: Video records (as in all_videocomp.json).
+        @param components: Types of the components of the unit, in order.
+        """
+        with self._lock:
+            self._pending.append((course_id, section, subsection, unit, outline, htmlfile, blob,
+                                  text, problem, list(problem_types), list(videos),
+                                  list(components)))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the pending units.
+        """
+        with self._lock:
+            self._flush()
+
+    def _section_id(self, conn, course_id, name, position):
+        key = (course_id, name)
+        section_id = self._sections.get(key)
+        if section_id is None:
+            conn.execute('INSERT OR IGNORE INTO sections (course_id, name) VALUES (?, ?)', key)
+            conn.execute('UPDATE sections SET position = ? WHERE course_id = ? AND name = ?', (position,) + key)
+            section_id = self._sections[key] = conn.execute(
+                'SELECT id FROM sections WHERE course_id = ? AND name = ?', key).fetchone()[0]
+        return section_id
+
+    def _subsection_id(self, conn, section_id, name, position, url):
+        key = (section_id, url)
+        subsection_id = self._subsections.get(key)
+        if subsection_id is None:
+            row = conn.execute('SELECT id FROM subsections WHERE section_id = ? AND url = ?', key).fetchone()
+            if row is None:
+                row = (conn.execute('INSERT INTO subsections (section_id, position, url, name) VALUES (?, ?, ?, ?)',
+                                    (section_id, position, url, name)).lastrowid,)
+            subsection_id = self._subsections[key] = row[0]
+        return subsection_id
+
+    def _flush(self):
+        # called with self._lock held
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self._write(pending)
+        except Exception:
+            # the ids cached during a rolled back transaction do not exist
+            self._sections.clear()
+            self._subsections.clear()
+            raise
+
+    def _write(self, pending):
+        components = []
+        texts = []
+        problem_types = []
+        segments = []
+        with _Transaction(self._conn) as conn:
+            for (course_id, section, subsection, unit, (section_position, subsection_position, url), htmlfile,
+                 blob, text, problem, types, videos, unit_components) in pending:
+                section_id = self._section_id(conn, course_id, section, section_position)
+                subsection_id = self._subsection_id(conn, section_id, subsection, subsection_position, url)
+                unit_id = conn.execute(
+                    'INSERT INTO units (subsection_id, position, name, htmlfile, blob) '
+                    'SELECT ?, COUNT(*), ?, ?, ? FROM units WHERE subsection_id = ?',
+                    (subsection_id, unit, htmlfile, blob, subsection_id)).lastrowid
+                components.extend((unit_id, position, kind)
+                                  for position, kind in enumerate(unit_components))
+                if text is not None:
+                    texts.append((unit_id, text))
+                if problem is not None:
+                    problem_id = conn.execute('INSERT INTO problems (unit_id, content) VALUES (?, ?)',
+                                              (unit_id, problem)).lastrowid
+                    problem_types.extend((problem_id, position, kind)
+                                         for position, kind in enumerate(types))
+                for position, video in enumerate(videos):
+                    video_id = conn.execute(
+                        'INSERT INTO videos (unit_id, position, youtube_url, video_source, '
+                        'duration, speech_period) VALUES (?, ?, ?, ?, ?, ?)',
+                        (unit_id, position, video.get('youtube_url'), video.get('video_source'),
+                         json.dumps(video.get('video_duration')),
+                         json.dumps(video.get('speech_period')))).lastrowid
+                    for key, value in video.items():
+                        if not key.startswith(_TRANSCRIPT_PREFIX):
+                            continue
+                        available = isinstance(value, list)
+                        transcript_id = conn.execute(
+                            'INSERT INTO transcripts (video_id, language, available) VALUES (?, ?, ?)',
+                            (video_id, key[len(_TRANSCRIPT_PREFIX):], int(available))).lastrowid
+                        if available:
+                            segments.extend((transcript_id, i, line) for i, line in enumerate(value))
+            conn.executemany('INSERT INTO components (unit_id, position, type) VALUES (?, ?, ?)',
+                             components)
+            conn.executemany('INSERT INTO texts (unit_id, content) VALUES (?, ?)', texts)
+            conn.executemany('INSERT INTO problem_types (problem_id, position, type) VALUES (?, ?, ?)',
+                             problem_types)
+            conn.executemany('INSERT INTO transcript_segments (transcript_id, position, text) '
+                             'VALUES (?, ?, ?)', segments)
+
+    def close(self):
+        """
+        Write the pending units and close the store.
+        """
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def export_course(conn, course_id, directory):
+    """
+    Write the legacy output files of the course into directory. The block
+    ids are numbered from 1 in the course.
+    """
+    os.makedirs(directory, exist_ok=True)
+    units = conn.execute(
+        'SELECT u.id, s.name, ss.name, u.name, u.htmlfile, u.blob '
+        'FROM units u JOIN subsections ss ON ss.id = u.subsection_id '
+        'JOIN sections s ON s.id = ss.section_id '
+        'WHERE s.course_id = ? ORDER BY s.position, ss.position, u.position', (course_id,)).fetchall()
+
+    texts, problems, videos, comps = {}, {}, {}, {}
+    prob_types = []
+    metadata = []
+    for unit_id, section, subsection, unit, htmlfile, blob in units:
+        place = {'section': section, 'subsection': subsection, 'unit': unit}
+        metadata.append((section, subsection, unit, htmlfile, blob))
+        for (content,) in conn.execute('SELECT content FROM texts WHERE unit_id = ?', (unit_id,)):
+            texts['text_block_' + str(len(texts) + 1).zfill(4)] = dict(place, content=content)
+        for problem_id, content in conn.execute('SELECT id, content FROM problems WHERE unit_id = ?',
+                                                (unit_id,)):
+            problems['quiz_block_' + str(len(problems) + 1).zfill(4)] = dict(place, content=content)
+            prob_types.extend(kind + ' \n' for (kind,) in conn.execute(
+                'SELECT type FROM problem_types WHERE problem_id = ? ORDER BY position', (problem_id,)))
+        for video_id, youtube_url, video_source, duration, speech_period in conn.execute(
+                'SELECT id, youtube_url, video_source, duration, speech_period FROM videos '
+                'WHERE unit_id = ? ORDER BY position', (unit_id,)).fetchall():
+            video = dict(place, youtube_url=youtube_url, video_source=video_source,
+                         video_duration=json.loads(duration))
+            for transcript_id, language, available in conn.execute(
+                    'SELECT id, language, available FROM transcripts WHERE video_id = ? ORDER BY id',
+                    (video_id,)).fetchall():
+                if available:
+                    video[_TRANSCRIPT_PREFIX + language] = [text for (text,) in conn.execute(
+                        'SELECT text FROM transcript_segments WHERE transcript_id = ? ORDER BY position',
+                        (transcript_id,))]
+                else:
+                    video[_TRANSCRIPT_PREFIX + language] = dict(_MISSING_TRANSCRIPT)
+            speech_period = json.loads(speech_period)
+            if speech_period is not None:
+                video['speech_period'] = speech_period
+            videos['video_block_' + str(len(videos) + 1).zfill(4)] = video
+        for (kind,) in conn.execute('SELECT type FROM components WHERE unit_id = ? ORDER BY position',
+                                    (unit_id,)):
+            comps[str(len(comps) + 1).zfill(4) + '_' + kind] = dict(place, type=kind)
+
+    for filename, records in (('all_textcomp.json', texts), ('all_probcomp.json', problems),
+                              ('all_videocomp.json', videos), ('all_comp.json', comps)):
+        with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+            f.write(_dumps(records))
+    with open(os.path.join(directory, 'all_prob_type.txt'), 'w') as f:
+        f.writelines(prob_types)
+
+    # same layout as the pandas export of the crawler
+    with_blob = any(row[4] for row in metadata)
+    with open(os.path.join(directory, 'metadata.csv'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['', 'section', 'subsection', 'unit', 'htmlfile'] + (['blob'] if with_blob else []))
+        for i, row in enumerate(metadata):
+            writer.writerow([i] + list(row[:4]) + ([row[4]] if with_blob else []))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib.sqlstore',
+                                     description='Read the relational store of the crawler')
+    subparsers = parser.add_subparsers(dest='command')
+
+    list_parser = subparsers.add_parser('list', help='list the stored courses')
+    list_parser.add_argument('database', help='store written with --sql-store')
+
+    export_parser = subparsers.add_parser('export', help='regenerate the legacy json, '
+                                          'txt and csv files of the courses')
+    export_parser.add_argument('database', help='store written with --sql-store')
+    export_parser.add_argument('output_dir', help='the files of each course are written '
+                               'into output_dir/<course>')
+    export_parser.add_argument('--course', action='append',
+                               help='only export this course (can be repeated)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command is None:
+        parser.print_help()
+        return
+
+    conn = _connect(args.database)
+    courses = conn.execute('SELECT id, name, crawled_at FROM courses ORDER BY name').fetchall()
+    if args.command == 'list':
+        for _, name, crawled_at in courses:
+            logging.info('%s (crawled %s)', name, 'never' if crawled_at is None else
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(crawled_at)))
+    elif args.command == 'export':
+        for course_id, name, _ in courses:
+            if args.course and name not in args.course:
+                continue
+            export_course(conn, course_id, os.path.join(args.output_dir, name))
+            logging.info('exported %s', name)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
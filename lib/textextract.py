@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Text extraction from the parse trees of html and problem blocks.
+
+Each block is walked once. The text of every segment element (headings,
+paragraphs, list items, ... see HTML_TAGS and PROBLEM_TAGS) is collected
+into a list of parts and joined at the end, so the cost is linear in the size
+of the block. A segment nested in another one (e.g. a list inside a list
+item) is its own segment, its text is not repeated in the outer one. Runs of
+whitespace are collapsed into a single space.
+
+Usage:
+
+  >>> from lib.textextract import extract_text, extract_structure, HTML_TAGS
+  >>> text = extract_text(soup.findAll('div', {'data-block-type': 'html'}), HTML_TAGS)
+  >>> extract_structure([block], HTML_TAGS)
+  [{'type': 'heading', 'level': 2, 'text': 'Introduction'},
+   {'type': 'list_item', 'level': 1, 'text': 'First point'}, ...]
+"""
+
+from bs4.element import CData, NavigableString, Tag
+
+
+HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+# segment elements of html blocks and of problem blocks
+HTML_TAGS = frozenset(HEADING_TAGS + ('p', 'li'))
+PROBLEM_TAGS = frozenset(HEADING_TAGS + ('p', 'label', 'legend', 'option'))
+
+LIST_TAGS = frozenset(['ul', 'ol'])
+SKIPPED_TAGS = frozenset(['script', 'style', 'template'])
+
+_SEGMENT_TYPES = {'p': 'paragraph', 'li': 'list_item'}
+_SEGMENT_TYPES.update((tag, 'heading') for tag in HEADING_TAGS)
+
+
+def _segments(root, tags):
+    """
+    Return the segments of root as (tag name, list level, parts) in
+    document order. The tree is walked depth first with a stack of
+    (children iterator, list level, parts of the open segment) frames, one
+    per element; strings are appended to the parts of the innermost open
+    segment, or dropped outside segments.
+    """
+    segments = []
+    stack = [(iter((root,)), 0, None)]
+    while stack:
+        children, level, parts = stack[-1]
+        for child in children:
+            cls = type(child)
+            if cls is NavigableString or cls is CData:
+                if parts is not None:
+                    parts.append(child)
+            elif isinstance(child, Tag):
+                name = child.name
+                if name in SKIPPED_TAGS:
+                    continue
+                child_parts = parts
+                if name in tags:
+                    child_parts = []
+                    segments.append((name, level, child_parts))
+                child_level = level + 1 if name in LIST_TAGS else level
+                stack.append((iter(child.contents), child_level, child_parts))
+                break
+        else:
+            stack.pop()
+    return segments
+
+
+def _normalize(parts):
+    return ' '.join(''.join(parts).split())
+
+
+def extract_text(roots, tags=HTML_TAGS):
+    """
+    Return the normalized text of the segments of roots (parse tree
+    elements), separated by single spaces.
+    """
+    texts = []
+    for root in roots:
+        for _, _, parts in _segments(root, tags):
+            text = _normalize(parts)
+            if text:
+                texts.append(text)
+    return ' '.join(texts)
+
+
+def extract_structure(roots, tags=HTML_TAGS):
+    """
+    Return the segments of roots as dicts with their type (heading,
+    paragraph, list_item or the tag name), level (of the heading, or of the
+    list nesting for list items) and normalized text.
+    """
+    structure = []
+    for root in roots:
+        for name, level, parts in _segments(root, tags):
+            text = _normalize(parts)
+            if not text:
+                continue
+            kind = _SEGMENT_TYPES.get(name, name)
+            if kind == 'heading':
+                level = int(name[1])
+            structure.append({'type': kind, 'level': level, 'text': text})
+    return structure
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timeline tracing of the crawler in the Chrome trace-event format.
+
+Spans (fetch, parse, extract, subprocess, write) are recorded with the
+process and thread that ran them, together with the course, subsection and
+unit being crawled, so that the concurrency of the crawl can be inspected in
+Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+
+Spans are kept in an in-memory buffer and written in bulk when the buffer is
+full and when the tracer stops. A disabled tracer costs one attribute check
+per span.
+
+Usage:
+
+  >>> from lib.tracing import TRACER, traced
+  >>> TRACER.start('trace.json')
+  >>> TRACER.set_context(course='GeoS101x')
+  >>> with TRACER.span('fetch', 'fetch', url=url):
+  ...     ...
+  >>> @traced('subprocess')
+  ... def videolen(yt_link):
+  ...     ...
+  >>> TRACER.stop()
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+CATEGORIES = ('fetch', 'parse', 'extract', 'subprocess', 'write')
+
+
+class Tracer(object):
+    """
+    Records spans and writes them as a Chrome trace-event JSON file. Use the
+    module level TRACER instance.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self._file = None
+        self._first = True
+        self._buffer = []
+        self._buffer_size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._named_threads = set()
+        self._epoch = 0.0
+        self._origin = 0.0
+
+    def start(self, path, buffer_size=10000):
+        """
+        Start recording spans into path, writing them every buffer_size
+        spans.
+        """
+        self.path = path
+        self._buffer_size = buffer_size
+        self._file = open(path, 'w', encoding='utf-8')
+        self._file.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        self._first = True
+        # timestamps are wall clock microseconds, so that the traces of
+        # several crawler processes can be merged, measured with the
+        # monotonic clock
+        self._epoch = time.time() * 1e6
+        self._origin = time.perf_counter()
+        self.enabled = True
+
+    def _now(self):
+        return self._epoch + (time.perf_counter() - self._origin) * 1e6
+
+    def set_context(self, **attributes):
+        """
+        Set attributes (e.g. course, subsection, unit) attached to all the
+        following spans of the calling thread. None removes an attribute.
+        """
+        if not self.enabled:
+            return
+        context = self._context()
+        for key, value in attributes.items():
+            if value is None:
+                context.pop(key, None)
+            else:
+                context[key] = value
+
+    def _context(self):
+        context = getattr(self._local, 'context', None)
+        if context is None:
+            context = self._local.context = {}
+        return context
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """
+        Record the block as a span called name of the category cat, with the
+        thread context and args as attributes.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = self._now()
+        try:
+            yield
+        except Exception as exception:
+            args['error'] = type(exception).__name__
+            raise
+        finally:
+            end = self._now()
+            attributes = dict(self._context())
+            attributes.update(args)
+            thread = threading.current_thread()
+            event = {'name': name, 'cat': cat, 'ph': 'X',
+                     'ts': start, 'dur': end - start,
+                     'pid': os.getpid(), 'tid': thread.ident,
+                     'args': attributes}
+            self._record(event, thread)
+
+    def _record(self, event, thread):
+        events = [event]
+        if thread.ident not in self._named_threads:
+            self._named_threads.add(thread.ident)
+            events.insert(0, {'name': 'thread_name', 'ph': 'M',
+                              'pid': event['pid'], 'tid': thread.ident,
+                              'args': {'name': thread.name}})
+        with self._lock:
+            self._buffer.extend(events)
+            if len(self._buffer) < self._buffer_size:
+                return
+            buffered, self._buffer = self._buffer, []
+            self._write(buffered)
+
+    def _write(self, events):
+        # called with self._lock held
+        if not events or self._file is None:
+            return
+        chunk = ',\n'.join(json.dumps(event, separators=(',', ':')) for event in events)
+        if not self._first:
+            chunk = ',\n' + chunk
+        self._first = False
+        self._file.write(chunk)
+
+    def stop(self):
+        """
+        Write the buffered spans and close the trace file.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        with self._lock:
+            buffered, self._buffer = self._buffer, []
+            self._write(buffered)
+            self._file.write('\n]}\n')
+            self._file.close()
+            self._file = None
+
+
+TRACER = Tracer()
+
+
+def traced(cat, name=None):
+    """
+    Decorator recording every call of the decorated function as a span of
+    the category cat, named after the function unless name is given.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(span_name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP transports of the crawler requests (--transport).
+
+  urllib  one connection per request (urlopen), the default
+  pooled  HTTP/1.1 keep-alive connections reused by host
+  http2   HTTP/2 through httpx (pip install 'httpx[http2]'): the concurrent
+          requests to a host are multiplexed over a few connections, and
+          the repeated headers (cookies, CSRF token) are compressed (HPACK).
+          Hosts that do not negotiate HTTP/2 are spoken to in HTTP/1.1 over
+          pooled connections, and without httpx the pooled transport is used.
+
+Almost every request of a crawl goes to courses.edx.org, so reusing the
+connections saves a TCP and TLS handshake per page, transcript and xblock.
+The transports keep the cookies of the session in its cookie jar, follow the
+redirections and raise HTTPError and URLError like urlopen, whose responses
+they mimic (read, geturl, info and headers).
+
+Usage:
+
+  >>> from lib.transport import make_transport
+  >>> transport = make_transport('http2', session.cookiejar, per_host=8)
+  >>> response = transport.open(Request(url, None, headers))
+  >>> page = response.read()
+
+A benchmark comparing them is in benchmarks/bench_transport.py.
+"""
+
+import io
+import logging
+import socket
+import ssl
+import threading
+
+from six.moves import http_client
+from six.moves.http_cookiejar import CookieJar
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urljoin, urlsplit
+from six.moves.urllib.request import Request, urlopen
+
+from .metrics import METRICS
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+TRANSPORTS = ('urllib', 'pooled', 'http2')
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 10
+
+
+class Response(object):
+    """
+    Response read by a transport, with the interface of the responses of
+    urlopen used by the crawler.
+    """
+
+    def __init__(self, url, status, reason, headers, body, http_version='HTTP/1.1'):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.http_version = http_version
+        self._body = io.BytesIO(body)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _message(items):
+    # the headers as an http.client.HTTPMessage, like the ones of urlopen
+    message = http_client.HTTPMessage()
+    for name, value in items:
+        message[name] = value
+    return message
+
+
+def _check(request, response):
+    """
+    Raise HTTPError for the error statuses (and 304), like urlopen.
+    """
+    if response.status >= 400 or response.status == 304:
+        raise HTTPError(request.full_url, response.status, response.reason,
+                        response.headers, io.BytesIO(response.read()))
+    return response
+
+
+class UrllibTransport(object):
+    """
+    One connection per request, with the opener installed by the session.
+    """
+
+    name = 'urllib'
+
+    def open(self, request):
+        return urlopen(request)
+
+    def close(self):
+        pass
+
+
+class PooledTransport(object):
+    """
+    HTTP/1.1 with keep-alive connections, at most per_host idle ones kept by
+    host. A request failing on a reused connection (closed by the server) is
+    sent again on a new one.
+    """
+
+    name = 'pooled'
+
+    def __init__(self, cookiejar=None, per_host=8, timeout=60, context=None):
+        """
+        @param cookiejar: Cookies of the session, a new jar if None.
+        @type cookiejar: CookieJar or None
+
+        @param per_host: Maximum idle connections kept by host.
+        @type per_host: int
+
+        @param timeout: Socket timeout in seconds.
+        @type timeout: float
+
+        @param context: SSL context of the https connections.
+        @type context: ssl.SSLContext or None
+        """
+        self.cookiejar = cookiejar if cookiejar is not None else CookieJar()
+        self.per_host = per_host
+        self.timeout = timeout
+        self.context = context or ssl.create_default_context()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        METRICS.inc('connections_total', transport=self.name, host=netloc)
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=self.timeout, context=self.context), False
+        return http_client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, request):
+        parts = urlsplit(request.full_url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        self.cookiejar.add_cookie_header(request)
+        headers = dict(request.header_items())
+        headers.setdefault('Host', parts.netloc)
+        for attempt in (0, 1):
+            connection, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request(request.get_method(), path, request.data, headers)
+                result = connection.getresponse()
+                body = result.read()
+            except (http_client.HTTPException, socket.error) as exception:
+                connection.close()
+                if reused and attempt == 0:
+                    # the server closed the idle connection
+                    continue
+                raise URLError(exception)
+            if result.will_close:
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            response = Response(request.full_url, result.status, result.reason, result.msg, body)
+            self.cookiejar.extract_cookies(response, request)
+            return response
+
+    def open(self, request):
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._send(request)
+            METRICS.inc('transport_requests_total', transport=self.name, version=response.http_version)
+            location = response.headers.get('Location')
+            if response.status not in _REDIRECTS or not location:
+                return _check(request, response)
+            # the redirected request keeps the headers but not the cookies,
+            # which are those of the new url
+            url = urljoin(request.full_url, location)
+            headers = {name: value for name, value in request.header_items() if name != 'Cookie'}
+            if response.status in (307, 308):
+                request = Request(url, request.data, headers, method=request.get_method())
+            else:
+                request = Request(url, None, headers)
+        raise HTTPError(request.full_url, response.status, 'Too many redirections',
+                        response.headers, None)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class Http2Transport(object):
+    """
+    HTTP/2 (and HTTP/1.1 for the hosts without it) through an httpx client.
+    """
+
+    name = 'http2'
+
+    def __init__(self, cookiejar=None, per_host=8, timeout=60, verify=True):
+        """
+        @param cookiejar: Cookies of the session, a new jar if None.
+        @type cookiejar: CookieJar or None
+
+        @param per_host: Maximum connections kept by host; an HTTP/2
+            connection carries many requests at a time.
+        @type per_host: int
+
+        @param timeout: Timeout of the requests in seconds.
+        @type timeout: float
+
+        @param verify: Verify the certificates (False for a local test
+            server).
+        @type verify: bool
+        """
+        if httpx is None:
+            raise ImportError('httpx is not installed')
+        self.cookiejar = cookiejar if cookiejar is not None else CookieJar()
+        # raises ImportError without the h2 package
+        self._client = httpx.Client(http2=True, cookies=self.cookiejar, follow_redirects=True,
+                                    max_redirects=_MAX_REDIRECTS, timeout=timeout, verify=verify,
+                                    limits=httpx.Limits(max_connections=None,
+                                                        max_keepalive_connections=per_host))
+
+    def open(self, request):
+        try:
+            result = self._client.request(request.get_method(), request.full_url,
+                                          content=request.data, headers=dict(request.header_items()))
+        except httpx.TooManyRedirects as exception:
+            raise HTTPError(request.full_url, 310, str(exception), _message([]), None)
+        except httpx.HTTPError as exception:
+            raise URLError(exception)
+        METRICS.inc('transport_requests_total', transport=self.name, version=result.http_version)
+        response = Response(str(result.url), result.status_code, result.reason_phrase,
+                            _message(result.headers.multi_items()), result.content, result.http_version)
+        return _check(request, response)
+
+    def close(self):
+        self._client.close()
+
+
+def make_transport(name, cookiejar=None, per_host=8):
+    """
+    Return the transport name (see TRANSPORTS) using the cookies of
+    cookiejar; http2 falls back to pooled when httpx or h2 is missing.
+    """
+    if name == 'urllib':
+        return UrllibTransport()
+    if name == 'http2':
+        try:
+            return Http2Transport(cookiejar, per_host)
+        except ImportError as exception:
+            logging.warning('HTTP/2 is not available (%s), using pooled HTTP/1.1 connections', exception)
+    elif name != 'pooled':
+        raise ValueError('Unknown transport %s' % name)
+    return PooledTransport(cookiejar, per_host)
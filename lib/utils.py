@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 # This module contains generic functions, ideally useful to any other module
-from six.moves.urllib.request import urlopen, Request
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request
+from six.moves.urllib.parse import urlparse
 from six.moves import html_parser
 
 import errno
@@ -12,6 +14,11 @@ import os
 import string
 import html
 import subprocess
+import time
+
+from .metrics import METRICS
+from .tracing import TRACER
+from .transport import UrllibTransport
 
 
 def get_filename_from_prefix(target_dir, filename_prefix):
@@ -51,18 +58,170 @@ def directory_name(initial_name):
     return result if result != "" else "course_folder"
 
 
+# lib.session.SessionManager renewing the session when it expires, see
+# set_session
+_SESSION = None
+
+
+def set_session(session):
+    """
+    Make get_page_contents renew the session (a lib.session.SessionManager)
+    and retry when a request of the session is redirected to the login page
+    or refused with 401/403. The requests of the session are sent with the
+    current headers of the session over those passed. None disables it.
+    """
+    global _SESSION
+    _SESSION = session
+
+
+# lib.transport transport of the requests, see set_transport
+_TRANSPORT = UrllibTransport()
+
+
+def set_transport(transport):
+    """
+    Send the requests of get_page_contents with transport (see
+    lib.transport.make_transport), closing the previous one.
+    """
+    global _TRANSPORT
+    previous, _TRANSPORT = _TRANSPORT, transport
+    previous.close()
+
+
+def _fetch(url, headers, extra_headers=None):
+    """
+    Make the request and return the decoded contents, the final url (after
+    redirections) and the response headers. extra_headers are added to the
+    headers of this request only.
+    """
+    host = urlparse(url).netloc
+    if extra_headers:
+        headers = dict(headers, **extra_headers)
+    start = time.perf_counter()
+    METRICS.inc('requests_total', host=host)
+    try:
+        with TRACER.span('fetch', 'fetch', url=url):
+            result = _TRANSPORT.open(Request(url, None, headers))
+            try:
+                # for python3
+                charset = result.headers.get_content_charset(failobj="utf-8")
+            except:
+                charset = result.info().getparam('charset') or 'utf-8'
+            content = result.read()
+    except HTTPError as exception:
+        # 304 Not Modified answers a conditional request, it is no error
+        if exception.code != 304:
+            METRICS.error('fetch', exception)
+        raise
+    except Exception as exception:
+        METRICS.error('fetch', exception)
+        raise
+    finally:
+        METRICS.observe('request_seconds', time.perf_counter() - start, host=host)
+    METRICS.inc('response_bytes_total', len(content), host=host)
+    return content.decode(charset), result.geturl(), result.headers
+
+
+def _get(url, headers, extra_headers=None):
+    """
+    Return the contents and the response headers of url, renewing the
+    session if needed (see set_session).
+    """
+    session = _SESSION
+    if session is None or not session.owns(url):
+        return _fetch(url, headers, extra_headers)[::2]
+
+    generation = session.generation
+    try:
+        content, final_url, response_headers = _fetch(url, dict(headers, **session.headers()), extra_headers)
+    except HTTPError as exception:
+        if exception.code not in (401, 403):
+            raise
+        expired = exception
+    else:
+        if not session.is_login_url(final_url) or session.is_login_url(url):
+            return content, response_headers
+        expired = 'redirected to %s' % final_url
+
+    METRICS.inc('session_renewals_total')
+    logging.info('Session expired while fetching %s (%s)', url, expired)
+    session.renew(generation)
+    # retry once, with the headers of the new session
+    return _fetch(url, dict(headers, **session.headers()), extra_headers)[::2]
+
+
+def open_url(url, headers, extra_headers=None, method=None):
+    """
+    Return the response of url sent with the transport (see set_transport),
+    for the callers reading it by chunks (lib.downloader). A request of the
+    session redirected to the login page or refused with 401/403 renews the
+    session and is sent once again, like get_page_contents.
+    """
+    session = _SESSION
+    owned = session is not None and session.owns(url)
+
+    def send():
+        # the headers of the session are read at every try, a renewal
+        # replaces them
+        request_headers = dict(headers, **session.headers()) if owned else dict(headers)
+        request_headers.update(extra_headers or {})
+        return _TRANSPORT.open(Request(url, None, request_headers, method=method))
+
+    if not owned:
+        return send()
+
+    generation = session.generation
+    try:
+        response = send()
+    except HTTPError as exception:
+        if exception.code not in (401, 403):
+            raise
+        expired = exception
+    else:
+        if not session.is_login_url(response.geturl()) or session.is_login_url(url):
+            return response
+        response.close()
+        expired = 'redirected to %s' % response.geturl()
+
+    METRICS.inc('session_renewals_total')
+    logging.info('Session expired while fetching %s (%s)', url, expired)
+    session.renew(generation)
+    return send()
+
+
 def get_page_contents(url, headers):
     """
     Get the contents of the page at the URL given by url. While making the
     request, we use the headers given in the dictionary in headers.
     """
-    result = urlopen(Request(url, None, headers))
+    return _get(url, headers)[0]
+
+
+def get_page_contents_if_modified(url, headers, validators):
+    """
+    Conditional get_page_contents: validators is a dict keeping the ETag
+    and Last-Modified of the previous response of url (empty at first), sent
+    back as If-None-Match and If-Modified-Since and updated in place.
+    Returns None when the server answers 304 Not Modified.
+    """
+    extra_headers = {}
+    if validators.get('etag'):
+        extra_headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        extra_headers['If-Modified-Since'] = validators['last_modified']
     try:
-        # for python3
-        charset = result.headers.get_content_charset(failobj="utf-8")
-    except:
-        charset = result.info().getparam('charset') or 'utf-8'
-    return result.read().decode(charset)
+        content, response_headers = _get(url, headers, extra_headers)
+    except HTTPError as exception:
+        if exception.code != 304:
+            raise
+        METRICS.inc('not_modified_total', host=urlparse(url).netloc)
+        return None
+    validators.clear()
+    for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+        value = response_headers.get(header)
+        if value:
+            validators[key] = value
+    return content
 
 
 def get_page_contents_as_json(url, headers):
@@ -75,7 +234,7 @@ def get_page_contents_as_json(url, headers):
     return json_object
 
 
-def remove_duplicates(orig_list, seen=set()):
+def remove_duplicates(orig_list, seen=None):
     """
     Returns a new list based on orig_list with elements from the (optional)
     set seen and elements of orig_list removed.
@@ -84,10 +243,11 @@ def remove_duplicates(orig_list, seen=set()):
     much as possible, only "removing" a given element if it appeared earlier
     in orig_list or if it was already a member of seen.
 
-    This function does *not* modify any of its input parameters.
+    This function does *not* modify any of its input parameters, it copies
+    seen on every call. To deduplicate many lists, use lib.dedup.UrlIndex.
     """
     new_list = []
-    new_seen = set(seen)
+    new_seen = set(seen) if seen is not None else set()
 
     for elem in orig_list:
         if elem not in new_seen:
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+
+"""
+WARC record and replay of the crawls (--record, --replay).
+
+In record mode every HTTP exchange of the crawler (dashboard, outlines,
+subsection pages, transcripts) is written into WARC/1.0 files as a request
+and a response record, and the results of the external tools (the durations
+and subtitles of youtube-dl, the durations of the MP4 videos probed with
+ffmpeg) as JSON resource records with urn:edx-crawler:<kind>:<key> uris, so
+that the videos themselves are not stored. In replay mode the crawler runs
+its whole pipeline against these records, without network nor login: a
+crawl can be extracted again with a newer version of the crawler, and many
+replays of the same files can run in parallel.
+
+Like the unit archives (see lib.archive), every record is an independent
+gzip member, so the files are regular .warc.gz files, and an index sidecar
+(<file>.idx) records the offset and length of every record; files without
+it (e.g. written by another tool, or by a crawl that crashed) are scanned.
+The index is written again every few MiB while a file is recorded, with the
+size it covers, and only the records after that size are scanned.
+
+Usage:
+
+  >>> from lib.warc import WARC
+  >>> WARC.record('warcs')                       # or WARC.replay(['warcs'])
+  >>> set_transport(WARC.transport(make_transport('pooled', cookiejar)))
+  >>> duration = WARC.call('videolen', yt_link, videolen, yt_link)
+  >>> WARC.close()
+"""
+
+import base64
+import functools
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError, URLError
+
+from .metrics import METRICS
+from .transport import Response
+
+
+WARC_SUFFIX = '.warc.gz'
+INDEX_SUFFIX = '.idx'
+RESOURCE_URI = 'urn:edx-crawler:%s:%s'
+
+# headers of the session which are not recorded, in the requests and in the
+# responses
+_PRIVATE_HEADERS = ('cookie', 'x-csrftoken', 'authorization')
+_PRIVATE_RESPONSE_HEADERS = ('set-cookie', 'set-cookie2')
+# headers describing the transfer, not the recorded body
+_TRANSFER_HEADERS = ('transfer-encoding', 'content-length', 'connection', 'keep-alive')
+
+# bytes of records between two writes of the index of a file
+_INDEX_INTERVAL = 8 << 20
+_SCAN_CHUNK_SIZE = 1 << 16
+
+
+class ReplayMissError(URLError):
+    """
+    The replayed request or tool call is not in the WARC files.
+    """
+
+
+def _record(warc_type, uri, content_type, block, fields=()):
+    headers = [('WARC-Type', warc_type),
+               ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+               ('WARC-Date', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))]
+    if uri is not None:
+        headers.append(('WARC-Target-URI', uri))
+    headers.extend(fields)
+    headers.extend([('Content-Type', content_type), ('Content-Length', str(len(block)))])
+    head = 'WARC/1.0\r\n' + ''.join('%s: %s\r\n' % header for header in headers) + '\r\n'
+    return headers[1][1], gzip.compress(head.encode('utf-8') + block + b'\r\n\r\n')
+
+
+def _payload_digest(body):
+    return 'sha1:' + base64.b32encode(hashlib.sha1(body).digest()).decode('ascii')
+
+
+def _http_head(first_line, items):
+    return (first_line + '\r\n' + ''.join('%s: %s\r\n' % item for item in items) + '\r\n').encode('utf-8')
+
+
+def _response_key(method, url):
+    return '%s %s' % (method, url)
+
+
+class WarcWriter(object):
+    """
+    Appends the records to WARC files of a directory, starting a new file
+    every max_size bytes.
+    """
+
+    def __init__(self, directory, prefix='edx-crawler', max_size=1 << 30):
+        """
+        @param directory: Directory of the WARC files, created if needed.
+        @type directory: str
+
+        @param prefix: Prefix of the file names, followed by the time, the
+            process id and the number of the file.
+        @type prefix: str
+
+        @param max_size: Size (compressed) from which a new file is started.
+        @type max_size: int
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self._name = '%s-%s-%d' % (prefix, time.strftime('%Y%m%d%H%M%S'), os.getpid())
+        self._lock = threading.Lock()
+        self._file = None
+        self.paths = []
+
+    def _open(self):
+        # called with self._lock held
+        path = os.path.join(self.directory, '%s-%05d%s' % (self._name, len(self.paths), WARC_SUFFIX))
+        self._file = open(path, 'wb')
+        self._offset = 0
+        self._indexed = 0
+        self._index = {}
+        self.paths.append(path)
+        info = 'software: edx-crawler\r\nformat: WARC File Format 1.0\r\n'.encode('utf-8')
+        self._write(None, _record('warcinfo', None, 'application/warc-fields', info,
+                                  [('WARC-Filename', os.path.basename(path))])[1])
+
+    def _write(self, key, data):
+        # called with self._lock held
+        if key is not None:
+            self._index[key] = [self._offset, len(data)]
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _write_index(self):
+        # called with self._lock held, once the records are flushed; a
+        # replay scans the records after size
+        path = self.paths[-1] + INDEX_SUFFIX
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'records': self._index, 'size': self._offset}, f)
+        os.replace(path + '.tmp', path)
+        self._indexed = self._offset
+
+    def _close_file(self):
+        # called with self._lock held
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._write_index()
+
+    def _append(self, records):
+        # the records of an exchange are written together, in one file
+        with self._lock:
+            if self._file is not None and self._offset >= self.max_size:
+                self._close_file()
+            if self._file is None:
+                self._open()
+            for key, data in records:
+                self._write(key, data)
+            if self._offset - self._indexed >= _INDEX_INTERVAL:
+                self._file.flush()
+                self._write_index()
+        METRICS.inc('warc_records_total', len(records), mode='record')
+
+    def write_exchange(self, method, url, request_headers, status, reason, response_headers, body,
+                       final_url=None):
+        """
+        Record a request and its response (the response headers are pairs,
+        body is bytes). final_url is the url after the redirections.
+        """
+        response_block = _http_head('HTTP/1.1 %d %s' % (status, reason),
+                                    [(name, value) for name, value in response_headers
+                                     if name.lower() not in _TRANSFER_HEADERS
+                                     and name.lower() not in _PRIVATE_RESPONSE_HEADERS]
+                                    + [('Content-Length', str(len(body)))]) + body
+        fields = [('WARC-Payload-Digest', _payload_digest(body))]
+        if final_url and final_url != url:
+            fields.append(('WARC-X-Final-URI', final_url))
+        response_id, response = _record('response', url, 'application/http; msgtype=response',
+                                        response_block, fields)
+        request_block = _http_head('%s %s HTTP/1.1' % (method, url),
+                                   [(name, value) for name, value in request_headers
+                                    if name.lower() not in _PRIVATE_HEADERS])
+        _, request = _record('request', url, 'application/http; msgtype=request', request_block,
+                             [('WARC-Concurrent-To', response_id)])
+        self._append([(_response_key(method, url), response), (None, request)])
+
+    def write_resource(self, uri, data):
+        """
+        Record data (JSON serializable), e.g. the result of a tool.
+        """
+        block = json.dumps(data, sort_keys=True).encode('utf-8')
+        self._append([(uri, _record('resource', uri, 'application/json', block)[1])])
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+
+def _parse_record(data):
+    """
+    Return the WARC headers (dict with lower case names) and the block of a
+    decompressed record.
+    """
+    head, _, rest = data.partition(b'\r\n\r\n')
+    lines = head.decode('utf-8').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers, rest[:int(headers.get('content-length', len(rest)))]
+
+
+def _scan(path, offset=0):
+    """
+    Return the index {key: [offset, length]} of the records of a WARC file
+    from offset, reading one gzip member (record) at a time. A truncated
+    last record (of a crawl that crashed) is left out.
+    """
+    index = {}
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(_SCAN_CHUNK_SIZE)
+        while data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            parts = []
+            length = 0
+            while True:
+                parts.append(decompressor.decompress(data))
+                if decompressor.eof:
+                    length += len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data
+                    break
+                length += len(data)
+                data = f.read(_SCAN_CHUNK_SIZE)
+                if not data:
+                    logging.warning('%s: the last record is truncated', path)
+                    return index
+            headers, _ = _parse_record(b''.join(parts))
+            uri = headers.get('warc-target-uri')
+            if headers.get('warc-type') == 'response' and uri:
+                # the crawler only records GET requests
+                index[_response_key('GET', uri)] = [offset, length]
+            elif headers.get('warc-type') == 'resource' and uri:
+                index[uri] = [offset, length]
+            offset += length
+            if not data:
+                data = f.read(_SCAN_CHUNK_SIZE)
+    return index
+
+
+class WarcIndex(object):
+    """
+    Responses and resources of WARC files, for replay. When a url was
+    recorded several times, the last file (by name) wins.
+    """
+
+    def __init__(self, paths):
+        """
+        @param paths: WARC files or directories of WARC files.
+        @type paths: [str]
+        """
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in os.listdir(path)
+                             if name.endswith(WARC_SUFFIX) or name.endswith('.warc'))
+            else:
+                files.append(path)
+        self.paths = sorted(files)
+        self._records = {}
+        for path in self.paths:
+            records = {}
+            size = 0
+            if os.path.exists(path + INDEX_SUFFIX):
+                with open(path + INDEX_SUFFIX, encoding='utf-8') as f:
+                    index = json.load(f)
+                records = index['records']
+                size = index.get('size', os.path.getsize(path))
+            if size < os.path.getsize(path):
+                logging.info('Indexing %s', path)
+                records.update(_scan(path, size))
+            for key, (offset, length) in records.items():
+                self._records[key] = (path, offset, length)
+        logging.info('Replaying %d records of %d WARC files', len(self._records), len(self.paths))
+
+    def __len__(self):
+        return len(self._records)
+
+    def _read(self, key):
+        location = self._records.get(key)
+        if location is None:
+            METRICS.inc('warc_records_total', mode='miss')
+            raise ReplayMissError('%s is not in the WARC files' % key)
+        path, offset, length = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        METRICS.inc('warc_records_total', mode='replay')
+        return _parse_record(gzip.decompress(data))
+
+    def response(self, method, url):
+        """
+        Return the recorded Response of method url (its status may be an
+        error), raise ReplayMissError when it was not recorded.
+        """
+        headers, block = self._read(_response_key(method, url))
+        stream = io.BytesIO(block)
+        status_line = stream.readline().decode('iso-8859-1').rstrip('\r\n')
+        _, status, reason = (status_line.split(' ', 2) + [''])[:3]
+        response_headers = http_client.parse_headers(stream)
+        body = stream.read()
+        return Response(headers.get('warc-x-final-uri', url), int(status), reason, response_headers, body)
+
+    def resource(self, uri):
+        """
+        Return the recorded data of uri.
+        """
+        return json.loads(self._read(uri)[1].decode('utf-8'))
+
+
+class RecordingTransport(object):
+    """
+    Records the exchanges of another transport (see lib.transport).
+    """
+
+    def __init__(self, transport, writer):
+        self.name = transport.name
+        self._transport = transport
+        self._writer = writer
+
+    def open(self, request):
+        method = request.get_method()
+        try:
+            result = self._transport.open(request)
+        except HTTPError as exception:
+            # 304 answers the conditional requests of a page already recorded
+            if exception.code != 304:
+                body = exception.read() if exception.fp is not None else b''
+                self._writer.write_exchange(method, request.full_url, request.header_items(),
+                                            exception.code, exception.reason,
+                                            exception.headers.items() if exception.headers else [], body)
+                raise HTTPError(request.full_url, exception.code, exception.reason,
+                                exception.headers, io.BytesIO(body))
+            raise
+        body = result.read()
+        status = getattr(result, 'status', None) or result.getcode()
+        self._writer.write_exchange(method, request.full_url, request.header_items(), status,
+                                    getattr(result, 'reason', ''), result.headers.items(), body,
+                                    result.geturl())
+        return Response(result.geturl(), status, getattr(result, 'reason', ''), result.headers, body)
+
+    def close(self):
+        self._transport.close()
+
+
+class ReplayTransport(object):
+    """
+    Serves the requests from the WARC files, raising HTTPError for the
+    recorded errors and ReplayMissError for the requests not recorded.
+    """
+
+    name = 'replay'
+
+    def __init__(self, index):
+        self._index = index
+
+    def open(self, request):
+        response = self._index.response(request.get_method(), request.full_url)
+        if response.status >= 400:
+            raise HTTPError(request.full_url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.read()))
+        return response
+
+    def close(self):
+        pass
+
+
+class Warc(object):
+    """
+    Record or replay mode of the process, see WARC.
+    """
+
+    def __init__(self):
+        self.writer = None
+        self.index = None
+
+    def record(self, directory, max_size=1 << 30):
+        """
+        Record the exchanges and tool results into WARC files of directory.
+        """
+        self.writer = WarcWriter(directory, max_size=max_size)
+
+    def replay(self, paths):
+        """
+        Replay the WARC files (or directories) of paths.
+        """
+        self.index = WarcIndex(paths)
+
+    @property
+    def replaying(self):
+        return self.index is not None
+
+    def transport(self, transport=None):
+        """
+        Return the transport of the mode: the recorded one replaying,
+        transport recorded recording, transport otherwise.
+        """
+        if self.index is not None:
+            return ReplayTransport(self.index)
+        if self.writer is not None:
+            return RecordingTransport(transport, self.writer)
+        return transport
+
+    def call(self, kind, key, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), a tool call identified by kind and
+        key: its result is recorded recording, and read from the WARC files
+        (without calling func) replaying.
+        """
+        uri = RESOURCE_URI % (kind, key)
+        if self.index is not None:
+            return self.index.resource(uri)
+        result = func(*args, **kwargs)
+        if self.writer is not None:
+            self.writer.write_resource(uri, result)
+        return result
+
+    def replayable(self, kind, key=None):
+        """
+        Decorator making the calls of a function recorded and replayed (see
+        call), identified by key(*args), by default the first argument.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                call_key = key(*args, **kwargs) if key is not None else args[0]
+                return self.call(kind, call_key, func, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WARC = Warc()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+Change detection of the watched courses (--watch).
+
+Every poll fingerprints the subsections of a course: the units of a
+subsection page (their titles) and the blocks of every unit (usage id, type
+and hash of the markup, see lib.blockcache.content_hash). Subsections whose
+fingerprint differs from the one of the previous poll are crawled again, and
+the components added, removed or modified since the previous poll are
+appended to the change log, one JSON object per line:
+
+  {"time": "2026-10-19T10:00:00", "course": "GeoS101x", "change": "modified",
+   "block": "block-v1:...+type@html+block@4f1e...", "type": "html",
+   "section": "02-Plate tectonics", "subsection": "Quiz", "unit": "Unit 3",
+   "output": "HTMLs/changes/20261019T100000"}
+
+The fingerprints are kept in a JSON state file, so that a restarted watch
+only crawls what changed while it was stopped.
+
+Usage:
+
+  >>> from lib.watch import ChangeLog, WatchState, diff_blocks, subsection_entry, unit_fingerprint
+  >>> state = WatchState('HTMLs/watch_state.json')
+  >>> entry = subsection_entry(section, subsection, [unit_fingerprint(title, blocks), ...])
+  >>> changes = diff_blocks(state.subsections(course), {url: entry})
+  >>> ChangeLog('HTMLs/changes.jsonl').append(course, changes, output)
+  >>> state.update(course, {url: entry}); state.save()
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .blockcache import content_hash
+from .metrics import METRICS
+
+
+STATE_FILENAME = 'watch_state.json'
+CHANGES_FILENAME = 'changes.jsonl'
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+
+def unit_fingerprint(title, blocks):
+    """
+    Return the fingerprint of a unit: its title and [usage id, type, hash]
+    of its blocks (parse tree elements with a data-block-type).
+    """
+    return {'unit': title,
+            'blocks': [[block.get('data-usage-id') or '', block['data-block-type'], content_hash(str(block))]
+                       for block in blocks]}
+
+
+def subsection_entry(section, subsection, units):
+    """
+    Return the state entry of a subsection from its section and subsection
+    names and the fingerprints of its units.
+    """
+    entry = {'section': section, 'subsection': subsection, 'units': units}
+    entry['fingerprint'] = hashlib.sha256(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+    return entry
+
+
+def _index_blocks(subsections):
+    blocks = {}
+    for entry in subsections.values():
+        for unit in entry['units']:
+            for position, (usage_id, kind, digest) in enumerate(unit['blocks']):
+                # the blocks without usage id are identified by their place
+                key = usage_id or '%s/%s/%s/%s#%d' % (entry['section'], entry['subsection'],
+                                                     unit['unit'], kind, position)
+                blocks[key] = {'section': entry['section'], 'subsection': entry['subsection'],
+                               'unit': unit['unit'], 'type': kind, 'hash': digest}
+    return blocks
+
+
+def diff_blocks(old, new):
+    """
+    Return the changes (dicts with change, block, type, section, subsection
+    and unit) between the blocks of two {subsection url: entry} states of a
+    course. A block moved to another unit is modified.
+    """
+    old_blocks = _index_blocks(old)
+    new_blocks = _index_blocks(new)
+    changes = []
+    for key, block in new_blocks.items():
+        previous = old_blocks.get(key)
+        if previous is None:
+            change = ADDED
+        elif previous != block:
+            change = MODIFIED
+        else:
+            continue
+        changes.append(dict(block, block=key, change=change))
+    for key, block in old_blocks.items():
+        if key not in new_blocks:
+            changes.append(dict(block, block=key, change=REMOVED))
+    for change in changes:
+        del change['hash']
+    changes.sort(key=lambda change: (change['section'], change['subsection'], change['unit'], change['block']))
+    return changes
+
+
+class WatchState(object):
+    """
+    Fingerprints of the subsections of the watched courses, in a JSON file.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Path of the state file, read if it exists.
+        @type path: str
+        """
+        self.path = path
+        self._courses = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._courses = json.load(f).get('courses', {})
+
+    def __contains__(self, course):
+        return course in self._courses
+
+    def subsections(self, course):
+        """
+        Return the {subsection url: entry} of the previous poll of course.
+        """
+        return self._courses.get(course, {})
+
+    def update(self, course, subsections):
+        self._courses[course] = subsections
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # a watch stopped while saving keeps its previous state
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'updated': time.strftime('%Y-%m-%dT%H:%M:%S'), 'courses': self._courses},
+                      f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class ChangeLog(object):
+    """
+    Append-only JSONL log of the component changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, course, changes, output=None):
+        """
+        Log the changes (see diff_blocks) of course, crawled into the output
+        directory.
+        """
+        if not changes:
+            return
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        lines = []
+        for change in changes:
+            METRICS.inc('watch_changes_total', change=change['change'])
+            lines.append(json.dumps(dict(change, time=now, course=course, output=output),
+                                    sort_keys=True, ensure_ascii=False) + '\n')
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)